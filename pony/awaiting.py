@@ -0,0 +1,132 @@
+# coding=utf-8
+import heapq
+import threading
+
+
+class AwaitingReports(object):
+    """Index of users who have not reported yet on a given day.
+
+    Users are kept in a heap by the time they become askable next, users
+    who are offline are parked until they come online. Safe to be used
+    from several threads.
+    """
+    def __init__(self, day=None):
+        self.day = day
+        self.teams = {}
+        self.due_at = {}
+        self.offline = set()
+        self._heap = []
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.teams)
+
+    def __contains__(self, user_id):
+        return user_id in self.teams
+
+    def add(self, user_id, teams, due_at=0):
+        with self._lock:
+            self.teams[user_id] = teams
+            self.defer(user_id, due_at)
+
+    def defer(self, user_id, due_at):
+        """Makes user askable again at `due_at`."""
+        with self._lock:
+            if user_id not in self.teams:
+                return
+
+            self.offline.discard(user_id)
+            self.due_at[user_id] = due_at
+            heapq.heappush(self._heap, (due_at, user_id))
+
+    def park(self, user_id):
+        """Parks offline user until they come online."""
+        with self._lock:
+            if user_id not in self.teams:
+                return
+
+            self.due_at.pop(user_id, None)
+            self.offline.add(user_id)
+
+    def online(self, user_id, now=0):
+        with self._lock:
+            if user_id in self.offline:
+                self.defer(user_id, now)
+
+    def parked(self):
+        with self._lock:
+            return list(self.offline)
+
+    def get_teams(self, user_id):
+        with self._lock:
+            return self.teams.get(user_id)
+
+    def reported(self, user_id):
+        with self._lock:
+            self.teams.pop(user_id, None)
+            self.due_at.pop(user_id, None)
+            self.offline.discard(user_id)
+
+    def pop_due(self, now):
+        """Removes and returns users who are askable at `now`."""
+        with self._lock:
+            due = []
+            while self._heap and self._heap[0][0] <= now:
+                due_at, user_id = heapq.heappop(self._heap)
+                # skip stale entries of deferred, parked or reported users
+                if self.due_at.get(user_id) != due_at:
+                    continue
+
+                del self.due_at[user_id]
+                due.append(user_id)
+
+            return due
+
+
+class PendingAsks(object):
+    """Asks which are queued but have not run yet, one per user.
+
+    An ask is only upgraded to a last call while it is pending, so the
+    upgrade is either seen by the ask or a new ask is needed. Safe to be
+    used from several threads.
+    """
+    def __init__(self):
+        self._asks = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, user_id):
+        with self._lock:
+            return user_id in self._asks
+
+    def get(self, user_id):
+        with self._lock:
+            return self._asks.get(user_id)
+
+    def add(self, ask):
+        """Adds ask, returns False if one is pending for the user already.
+
+        The pending ask becomes a last call then, if the new one is.
+        """
+        with self._lock:
+            pending = self._asks.get(ask.user_id)
+            if pending is not None:
+                pending.last_call = pending.last_call or ask.last_call
+                return False
+
+            self._asks[ask.user_id] = ask
+            return True
+
+    def cancel(self, ask):
+        """Removes ask which is not going to run."""
+        with self._lock:
+            ask.cancelled = True
+            if self._asks.get(ask.user_id) is ask:
+                del self._asks[ask.user_id]
+
+    def take(self, ask):
+        """Removes ask which is about to run, returns its last call flag."""
+        with self._lock:
+            if self._asks.get(ask.user_id) is ask:
+                del self._asks[ask.user_id]
+
+            return ask.last_call
@@ -0,0 +1,130 @@
+# coding=utf-8
+import time
+import logging
+
+
+class User(object):
+    """Compact user record, keeps only the bits of profile Pony uses."""
+    __slots__ = ('id', 'name', 'real_name', 'image_192', 'color', 'presence')
+
+    def __init__(self, id, name=None, real_name=None, image_192=None,
+                 color=None, presence=None):
+        self.id = id
+        self.name = name
+        self.real_name = real_name
+        self.image_192 = image_192
+        self.color = color
+        self.presence = presence
+
+    @classmethod
+    def from_slack(cls, member):
+        """Builds a record out of a member entry of users.list."""
+        profile = member.get('profile', {})
+        return cls(
+            id=member['id'],
+            name=member.get('name'),
+            real_name=profile.get('real_name'),
+            image_192=profile.get('image_192'),
+            color=member.get('color'),
+            presence=member.get('presence')
+        )
+
+    def __getstate__(self):
+        return tuple(getattr(self, field) for field in self.__slots__)
+
+    def __setstate__(self, state):
+        for field, value in zip(self.__slots__, state):
+            setattr(self, field, value)
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, User)
+            and self.__getstate__() == other.__getstate__()
+        )
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<User {} @{}>'.format(self.id, self.name)
+
+
+class UserDirectory(object):
+    """Team users indexed by id and by name."""
+    def __init__(self, users=None):
+        self.users = users
+        self.by_id = dict()
+        self.by_name = dict()
+
+        for user in users or []:
+            # databases written before compact records hold plain dicts
+            if isinstance(user, dict):
+                user = User.from_slack(user)
+
+            self.by_id[user.id] = user
+            if user.name is not None:
+                self.by_name[user.name] = user
+
+    def get_by_id(self, user_id):
+        return self.by_id.get(user_id)
+
+    def get_by_name(self, user_name):
+        return self.by_name.get(user_name)
+
+
+class IMDirectory(object):
+    """Direct message channels indexed by id and by user."""
+    def __init__(self, ims=None):
+        self.ims = ims
+        self.ids = set()
+        self.by_user = dict()
+
+        for im in ims or []:
+            self.add(im)
+
+    def add(self, im):
+        self.ids.add(im['id'])
+        if im.get('user') is not None:
+            self.by_user[im['user']] = im['id']
+
+    def is_im(self, channel_id):
+        return channel_id in self.ids
+
+    def get_channel(self, user_id):
+        return self.by_user.get(user_id)
+
+
+class ProfileCache(object):
+    """Avatars of users, kept for `ttl` seconds.
+
+    Fed from user list updates, a miss costs a single users.info call, made
+    through `dispatcher` (if given) to stay within its rate limit.
+    """
+    def __init__(self, ttl=60 * 60, dispatcher=None):
+        self.ttl = ttl
+        self.dispatcher = dispatcher
+        self._avatars = dict()
+
+    def update(self, users):
+        now = time.time()
+        for user in users:
+            if user.image_192 is not None:
+                self._avatars[user.id] = (user.image_192, now)
+
+    def get_avatar(self, slack, user_id):
+        avatar, cached_at = self._avatars.get(user_id, (None, 0))
+        if time.time() - cached_at < self.ttl:
+            return avatar
+
+        if self.dispatcher is not None:
+            response = self.dispatcher.call(slack, 'users.info', user=user_id)
+        else:
+            response = slack.api_call('users.info', user=user_id)
+        if not response.get('ok'):
+            logging.error('Unable to fetch profile of {}: {}'.format(
+                user_id, response.get('error')))
+            return
+
+        avatar = response['user'].get('profile', {}).get('image_192')
+        self._avatars[user_id] = (avatar, time.time())
+        return avatar
@@ -0,0 +1,289 @@
+# coding=utf-8
+import time
+import heapq
+import logging
+import itertools
+import threading
+import collections
+
+from .runtime import Condition
+
+# calls per minute and burst size for Slack API methods (tiers), messages
+# are limited per channel, see https://api.slack.com/docs/rate-limits
+RATE_LIMITS = {
+    'chat.postMessage': (60, 3),
+    'users.info': (100, 10),
+    'users.list': (20, 2),
+    'im.list': (20, 2),
+}
+DEFAULT_RATE_LIMIT = (50, 5)
+PER_CHANNEL_RATE_LIMITS = ('chat.postMessage', )
+
+
+class TokenBucket(object):
+    """Allows `rate` calls per minute, in bursts of up to `burst` calls."""
+    def __init__(self, rate, burst):
+        self.rate = rate / 60.0
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.time()
+        self.paused_till = 0
+
+    def take(self, now):
+        """Takes a token, returns seconds to wait if there is none left."""
+        if now < self.paused_till:
+            return self.paused_till - now
+
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+
+        return (1 - self.tokens) / self.rate
+
+    def pause(self, now, seconds):
+        self.paused_till = max(self.paused_till, now + seconds)
+        self.tokens = 0
+
+
+class Dispatcher(object):
+    """Runs outbound calls (Slack API, websocket events) on worker threads.
+
+    Calls are scheduled with a delay, so imitating human typing does not
+    hold up the task queues. Slack API calls are throttled to the rate
+    limits of their method and retried after being rate limited. Messages
+    to a channel are posted one at a time, in order they were scheduled in.
+    """
+    def __init__(self, workers=4, max_retries=5, metrics=None):
+        self.workers = workers
+        self.max_retries = max_retries
+        self.metrics = metrics
+        self._condition = Condition()
+        self._calls = []
+        self._sequence = itertools.count()
+        self._threads = []
+        self._buckets = dict()
+        self._channels = dict()
+        self._stats = dict(
+            throttled_seconds=0.0,
+            rate_limited=0,
+            retried=0,
+            dropped=0
+        )
+
+    def start(self):
+        for x in range(self.workers):
+            thread = threading.Thread(
+                target=self._work, name='Dispatcher-{}'.format(x))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+        logging.info('Started {} outbound workers'.format(self.workers))
+
+    def call_later(self, delay, func, *args, **kwargs):
+        with self._condition:
+            heapq.heappush(self._calls, (
+                time.time() + delay, next(self._sequence),
+                func, args, kwargs
+            ))
+            self._condition.notify()
+
+    def api_call(self, slack, method, delay=0, callback=None, **kwargs):
+        """Schedules a Slack API call, within rate limits of its method.
+
+        Callback is called once the call succeeds.
+        """
+        call = (slack, method, kwargs, 0, callback)
+        if method in PER_CHANNEL_RATE_LIMITS:
+            key = self._get_key(method, kwargs)
+            with self._condition:
+                # a call to this channel is in flight, queue up behind it
+                if key in self._channels:
+                    self._channels[key].append((time.time() + delay, call))
+                    return
+
+                self._channels[key] = collections.deque()
+
+        self.call_later(delay, self._api_call, *call)
+
+    def _call_next(self, method, kwargs):
+        """Schedules the call queued next to the same channel, if any."""
+        if method not in PER_CHANNEL_RATE_LIMITS:
+            return
+
+        key = self._get_key(method, kwargs)
+        with self._condition:
+            calls = self._channels[key]
+            if not calls:
+                del self._channels[key]
+                return
+
+            due, call = calls.popleft()
+
+        self.call_later(max(due - time.time(), 0), self._api_call, *call)
+
+    def call(self, slack, method, **kwargs):
+        """Makes a Slack API call on the calling thread, waiting for a token
+        of its method if it has to. Rate limited calls are retried, the last
+        response is returned once retries are used up.
+        """
+        attempt = 0
+        while True:
+            with self._condition:
+                bucket = self._get_bucket(method, kwargs)
+                wait = bucket.take(time.time())
+                self._stats['throttled_seconds'] += wait
+
+            if wait > 0:
+                logging.debug(
+                    'Throttling {} for {:.2f} sec'.format(method, wait))
+                time.sleep(wait)
+                continue
+
+            response = self._timed_call(slack, method, kwargs)
+            if response.get('error') != 'ratelimited':
+                return response
+
+            retry_after = self.get_retry_after(response, attempt)
+            with self._condition:
+                # bucket is paused, next attempt waits for it
+                bucket.pause(time.time(), retry_after)
+                self._stats['rate_limited'] += 1
+
+                if attempt >= self.max_retries:
+                    self._stats['dropped'] += 1
+                    logging.error('Giving up on {} after {} retries'.format(
+                        method, attempt))
+                    return response
+
+                self._stats['retried'] += 1
+
+            logging.warning('Rate limited on {}, retrying in {} sec'.format(
+                method, retry_after))
+            attempt += 1
+
+    def _timed_call(self, slack, method, kwargs):
+        started_at = time.time()
+        response = slack.api_call(method, **kwargs)
+        if self.metrics is not None:
+            self.metrics.observe(
+                'pony_slack_api_seconds', time.time() - started_at,
+                method=method)
+
+        return response
+
+    @staticmethod
+    def _get_key(method, kwargs):
+        if method in PER_CHANNEL_RATE_LIMITS:
+            return method, kwargs.get('channel')
+
+        return method
+
+    def _get_bucket(self, method, kwargs):
+        key = self._get_key(method, kwargs)
+        if key not in self._buckets:
+            self._buckets[key] = TokenBucket(
+                *RATE_LIMITS.get(method, DEFAULT_RATE_LIMIT))
+
+        return self._buckets[key]
+
+    @staticmethod
+    def get_retry_after(response, attempt):
+        for header, value in response.get('headers', {}).items():
+            if header.lower() == 'retry-after':
+                return float(value)
+
+        return min(2 ** attempt, 60)
+
+    def _api_call(self, slack, method, kwargs, attempt, callback=None):
+        with self._condition:
+            bucket = self._get_bucket(method, kwargs)
+            wait = bucket.take(time.time())
+            self._stats['throttled_seconds'] += wait
+
+        if wait > 0:
+            logging.debug('Throttling {} for {:.2f} sec'.format(method, wait))
+            self.call_later(
+                wait, self._api_call, slack, method, kwargs, attempt,
+                callback)
+            return
+
+        retrying = False
+        try:
+            response = self._timed_call(slack, method, kwargs)
+            if response.get('error') != 'ratelimited':
+                if not response.get('ok'):
+                    logging.error('Slack API call {} failed: {}'.format(
+                        method, response.get('error')))
+                elif callback is not None:
+                    callback()
+                return
+
+            retry_after = self.get_retry_after(response, attempt)
+            with self._condition:
+                bucket.pause(time.time(), retry_after)
+                self._stats['rate_limited'] += 1
+
+                if attempt >= self.max_retries:
+                    self._stats['dropped'] += 1
+                    logging.error('Giving up on {} after {} retries'.format(
+                        method, attempt))
+                    return
+
+                self._stats['retried'] += 1
+                retrying = True
+        finally:
+            # unless the call is retried, the next one to its channel may go
+            if not retrying:
+                self._call_next(method, kwargs)
+
+        logging.warning('Rate limited on {}, retrying in {} sec'.format(
+            method, retry_after))
+        self.call_later(
+            retry_after, self._api_call, slack, method, kwargs, attempt + 1,
+            callback)
+
+    def pending(self):
+        with self._condition:
+            return len(self._calls) + sum(
+                len(calls) for calls in self._channels.values())
+
+    def stats(self):
+        """Returns queue depth and throttling counters."""
+        with self._condition:
+            return dict(self._stats, pending=self.pending())
+
+    def run_pending(self):
+        """Runs scheduled calls right away, on the calling thread.
+
+        Calls scheduled while running (retries) are left pending.
+        """
+        for x in range(len(self._calls)):
+            with self._condition:
+                call = heapq.heappop(self._calls)
+            self._run(call)
+
+    def _run(self, call):
+        due, sequence, func, args, kwargs = call
+        try:
+            func(*args, **kwargs)
+        except Exception:
+            logging.exception('Outbound call failed')
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while True:
+                    now = time.time()
+                    if self._calls and self._calls[0][0] <= now:
+                        break
+
+                    timeout = self._calls[0][0] - now if self._calls else None
+                    self._condition.wait(timeout)
+
+                call = heapq.heappop(self._calls)
+
+            self._run(call)
@@ -1,19 +1,80 @@
 # coding=utf-8
-from rtmbot.core import Job
+import time
+import logging
 
+from .profiling import Profiler
 
-class WorldTick(Job):
-    """World tick."""
-    def __init__(self, bot, queue, interval):
-        super(WorldTick, self).__init__(interval)
+
+class WorldTick(object):
+    """World tick, runs tasks of a queue which are due.
+
+    Tasks with an ordering key are handed to `executor` when given, the
+    rest run in the tick itself. While the executor is saturated no task
+    is taken, these wait in the queue, where its bound and priorities
+    apply. Task and tick durations are recorded to
+    `metrics` when given, both are profiled by `profiler` while it is on.
+    """
+    def __init__(self, bot, queue, executor=None, metrics=None,
+                 profiler=None):
         self.bot = bot
         self.queue = queue
+        self.executor = executor
+        self.metrics = metrics
+        # never started profiler, for profiling to cost a single check
+        self.profiler = profiler or Profiler()
+
+    def execute(self, task, slack):
+        started_at = time.time()
+        try:
+            with self.profiler.profile(task.__class__.__name__):
+                task.execute(bot=self.bot, slack=slack)
+        except Exception:
+            logging.exception('Task {} failed'.format(
+                task.__class__.__name__))
+        finally:
+            if self.metrics is not None:
+                self.metrics.observe(
+                    'pony_task_seconds', time.time() - started_at,
+                    task=task.__class__.__name__)
+
+    def ready(self, now=None):
+        """Counts due tasks, none while the executor is saturated."""
+        if self.executor is not None and self.executor.saturated():
+            return 0
+
+        return self.queue.ready(now)
+
+    def next_due(self):
+        # woken up by the executor once it has a worker free
+        if self.executor is not None and self.executor.saturated():
+            return None
+
+        return self.queue.next_due()
 
     def run(self, slack):
-        visible_tasks = len(self.queue)
+        tick_name = 'tick:{}'.format(self.queue.name)
+        with self.profiler.profile(tick_name, cprofile=False):
+            return self.run_tasks(slack)
+
+    def run_tasks(self, slack):
+        started_at = time.time()
+        ran_tasks = 0
+
+        for x in range(self.queue.ready()):
+            if self.executor is not None and self.executor.saturated():
+                break
 
-        for x in range(visible_tasks):
             task = self.queue.popleft()
-            task.execute(bot=self.bot, slack=slack)
+            ran_tasks += 1
+            ordering_key = getattr(task, 'ordering_key', None)
+            if self.executor is not None and ordering_key is not None:
+                self.executor.submit(ordering_key, self.execute, task, slack)
+            else:
+                self.execute(task, slack)
+
+        if self.metrics is not None:
+            self.metrics.observe(
+                'pony_tick_seconds', time.time() - started_at,
+                queue=self.queue.name)
 
-        return []
+        return ran_tasks
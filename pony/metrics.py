@@ -0,0 +1,262 @@
+# coding=utf-8
+import os
+import math
+import time
+import bisect
+import random
+import logging
+import tempfile
+import threading
+import contextlib
+import collections
+import BaseHTTPServer
+
+from datetime import datetime
+
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# replies go out after a typing delay, summaries are minutes late
+REPORT_STAGE_BUCKETS = (
+    0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 1800.0, 3600.0)
+
+
+def percentile(samples, quantile):
+    """Nearest-rank percentile of sorted samples."""
+    rank = max(int(math.ceil(quantile * len(samples))) - 1, 0)
+    return samples[min(rank, len(samples) - 1)]
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(
+            name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in labels
+    ))
+
+
+class Histogram(object):
+    """Counts of observed values per bucket, with their sum and count."""
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        lines, cumulative = [], 0
+        for bound, count in zip(self.buckets + ('+Inf', ), self.counts):
+            cumulative += count
+            lines.append('{}_bucket{} {}'.format(
+                name, format_labels(labels + (('le', bound), )), cumulative))
+
+        lines.append('{}_sum{} {}'.format(
+            name, format_labels(labels), self.sum))
+        lines.append('{}_count{} {}'.format(
+            name, format_labels(labels), self.count))
+        return lines
+
+
+class Metrics(object):
+    """Registry of histograms and gauges, rendered in Prometheus format.
+
+    Observing a value is a dictionary lookup under a lock, gauges (and
+    counters) are callbacks evaluated only when metrics are rendered.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = dict()
+        self._help = dict()
+        self._buckets = dict()
+        self._gauges = []
+
+    def describe(self, name, help_text, buckets=None):
+        self._help[name] = help_text
+        if buckets is not None:
+            self._buckets[name] = buckets
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(
+                    self._buckets.get(name, DEFAULT_BUCKETS))
+            histogram.observe(value)
+
+    @contextlib.contextmanager
+    def timed(self, name, **labels):
+        started_at = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - started_at, **labels)
+
+    def add_gauge(self, name, callback, help_text=None):
+        """Registers gauge, callback returns [(labels dict, value), ...]."""
+        self._gauges.append((name, 'gauge', callback))
+        if help_text:
+            self.describe(name, help_text)
+
+    def add_counter(self, name, callback, help_text=None):
+        """Registers counter, a gauge whose values only ever increase."""
+        self._gauges.append((name, 'counter', callback))
+        if help_text:
+            self.describe(name, help_text)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            lines_by_name = dict()
+            for (name, labels), histogram in histograms:
+                lines_by_name.setdefault(name, []).extend(
+                    histogram.render(name, labels))
+
+        for name in sorted(lines_by_name):
+            if name in self._help:
+                lines.append('# HELP {} {}'.format(name, self._help[name]))
+            lines.append('# TYPE {} histogram'.format(name))
+            lines.extend(lines_by_name[name])
+
+        for name, metric_type, callback in self._gauges:
+            try:
+                values = callback()
+            except Exception:
+                logging.exception('Unable to collect {}'.format(name))
+                continue
+
+            if name in self._help:
+                lines.append('# HELP {} {}'.format(name, self._help[name]))
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+            for labels, value in values:
+                lines.append('{}{} {}'.format(
+                    name, format_labels(tuple(sorted(labels.items()))), value))
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, file_name):
+        """Writes rendered metrics to file atomically."""
+        directory = os.path.dirname(os.path.abspath(file_name))
+        fd, temp_name = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.render())
+        os.rename(temp_name, file_name)
+
+    def serve(self, port, host='127.0.0.1'):
+        """Serves metrics over HTTP from a daemon thread."""
+        metrics = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render()
+                self.send_response(200)
+                self.send_header(
+                    'Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug('Metrics request: ' + format % args)
+
+        server = BaseHTTPServer.HTTPServer((host, port), Handler)
+        thread = threading.Thread(target=server.serve_forever, name='Metrics')
+        thread.daemon = True
+        thread.start()
+        logging.info('Serving metrics on {}:{}'.format(host, port))
+        return server
+
+
+class LatencyTracker(object):
+    """Latencies of report handling stages, from the event to the reply.
+
+    Samples go to histograms of `metrics` and are kept for the current day
+    (at most `max_samples` per stage, sampled uniformly beyond that), their
+    percentiles are exposed as gauges and logged once the day is over.
+    """
+    QUANTILES = (0.5, 0.9, 0.99)
+
+    def __init__(self, metrics, max_samples=10000):
+        self.metrics = metrics
+        self.max_samples = max_samples
+        self.day = None
+        self._lock = threading.Lock()
+        self._samples = collections.defaultdict(list)
+        self._counts = collections.Counter()
+
+        metrics.describe(
+            'pony_report_stage_seconds',
+            'Seconds from a report message event to a stage of its handling, '
+            'summaries are measured from report_by',
+            buckets=REPORT_STAGE_BUCKETS)
+        metrics.add_gauge(
+            'pony_report_latency_seconds',
+            self.gauges,
+            'Percentiles of report handling stages for the current day')
+
+    def record(self, stage, seconds):
+        self.metrics.observe('pony_report_stage_seconds', seconds, stage=stage)
+
+        with self._lock:
+            if self.day is None:
+                self.day = datetime.utcnow().date()
+
+            samples = self._samples[stage]
+            self._counts[stage] += 1
+            if len(samples) < self.max_samples:
+                samples.append(seconds)
+            else:
+                index = random.randint(0, self._counts[stage] - 1)
+                if index < self.max_samples:
+                    samples[index] = seconds
+
+    def percentiles(self):
+        """Returns {stage: ({quantile: seconds}, count)} for the day."""
+        with self._lock:
+            samples = {
+                stage: sorted(values)
+                for stage, values in self._samples.items() if values
+            }
+            counts = dict(self._counts)
+
+        return {
+            stage: (
+                {q: percentile(values, q) for q in self.QUANTILES},
+                counts[stage]
+            )
+            for stage, values in samples.items()
+        }
+
+    def gauges(self):
+        return [
+            ({'stage': stage, 'quantile': quantile}, value)
+            for stage, (quantiles, count) in sorted(self.percentiles().items())
+            for quantile, value in sorted(quantiles.items())
+        ]
+
+    def rollover(self, today):
+        """Logs percentiles of the previous day and starts a new one."""
+        if self.day is None or self.day == today:
+            return
+
+        percentiles = self.percentiles()
+        logging.info('Report latency for {}: {}'.format(self.day, '; '.join(
+            '{} {} (n={})'.format(stage, ' '.join(
+                'p{:g}={:.2f}s'.format(quantile * 100, value)
+                for quantile, value in sorted(quantiles.items())
+            ), count)
+            for stage, (quantiles, count) in sorted(percentiles.items())
+        ) or 'no reports'))
+
+        with self._lock:
+            self.day = today
+            self._samples.clear()
+            self._counts.clear()
@@ -1,13 +1,23 @@
 # coding=utf-8
 import time
+import signal
 import logging
-import collections
+import calendar
+
+from datetime import datetime
 
 from rtmbot.core import Plugin
 
 import tasks
 from .jobs import WorldTick
+from .awaiting import AwaitingReports, PendingAsks
+from .runtime import Runtime, TaskQueue, KeyedExecutor
+from .schedule import compile_schedules
+from .metrics import Metrics, LatencyTracker
+from .profiling import Profiler
 from .storage import Storage
+from .dispatcher import Dispatcher
+from .directory import UserDirectory, IMDirectory, ProfileCache
 
 
 class StandupPonyPlugin(Plugin):
@@ -15,16 +25,108 @@ class StandupPonyPlugin(Plugin):
     def __init__(self, name=None, slack_client=None, plugin_config=None):
         super(StandupPonyPlugin, self).__init__(
             name, slack_client, plugin_config)
-        self.slow_queue = collections.deque()
-        self.fast_queue = collections.deque()
+        self.metrics = Metrics()
+        self.latency = LatencyTracker(self.metrics)
+        self.profiler = Profiler(
+            directory=plugin_config.get('profile_dir', 'profiles'),
+            window=plugin_config.get('profile_window', 60))
+        self.runtime = Runtime()
+        # slow queue, tasks are due some minutes after being queued
+        self.slow_queue = TaskQueue(
+            delay=2 * 60, condition=self.runtime.condition, name='slow')
+        # fast queue, tasks are due as soon as they are queued, on overflow
+        # least important tasks are dropped or deferred to the slow queue,
+        # tasks users wait for are always deferred
+        self.fast_queue = TaskQueue(
+            condition=self.runtime.condition,
+            maxlen=plugin_config.get('fast_queue_size', 5000),
+            overflow=plugin_config.get('fast_queue_overflow', 'shed'),
+            overflow_queue=self.slow_queue,
+            on_overflow=self.on_task_overflow,
+            name='fast'
+        )
 
-        self.storage = Storage(plugin_config.get('db_file'))
+        self.storage = Storage(
+            plugin_config.get('db_file'),
+            engine=plugin_config.get('db_engine', 'pickle'),
+            partitioned=('report',),
+            cache_size=plugin_config.get('db_cache_days', 7)
+        )
+        self.dispatcher = Dispatcher(
+            workers=plugin_config.get('outbound_workers', 4),
+            metrics=self.metrics)
+        self.user_directory = UserDirectory()
+        # replaced by UpdateIMList, checked on every event without storage
+        self.im_directory = IMDirectory(self.storage.get('ims'))
+        self.profile_cache = ProfileCache(
+            ttl=plugin_config.get('profile_cache_ttl', 60 * 60),
+            dispatcher=self.dispatcher)
+        self.pending_asks = PendingAsks()
+        self.awaiting_reports = AwaitingReports()
+        self.schedules = None
+        self.schedules_day = None
+        self.executor = KeyedExecutor(
+            workers=plugin_config.get('task_workers', 4),
+            condition=self.runtime.condition)
+        self.register_metrics()
 
         # world updates
-        self.slow_queue.append(tasks.UpdateUserList())
-        self.slow_queue.append(tasks.UpdateIMList())
-        self.slow_queue.append(tasks.CheckReports())
-        self.slow_queue.append(tasks.SyncDB())
+        self.slow_queue.append(tasks.UpdateUserList(), delay=0)
+        self.slow_queue.append(tasks.UpdateIMList(), delay=0)
+        self.slow_queue.append(tasks.CheckReports(), delay=0)
+        self.slow_queue.append(tasks.ScheduleDeadlines(), delay=0)
+        if plugin_config.get('metrics_file'):
+            self.slow_queue.append(tasks.WriteMetrics(), delay=0)
+        self.slow_queue.append(tasks.SyncDB(), delay=0)
+
+    def register_metrics(self):
+        self.metrics.describe(
+            'pony_task_seconds', 'Task execution time by task type')
+        self.metrics.describe(
+            'pony_tick_seconds', 'Time to run due tasks of a queue')
+        self.metrics.describe(
+            'pony_slack_api_seconds', 'Slack API call latency by method')
+
+        queues = (self.slow_queue, self.fast_queue)
+        self.metrics.add_gauge(
+            'pony_queue_depth',
+            lambda: [({'queue': queue.name}, len(queue)) for queue in queues],
+            'Tasks waiting in a queue')
+        self.metrics.add_gauge(
+            'pony_queue_oldest_seconds',
+            lambda: [
+                ({'queue': queue.name}, queue.oldest_age())
+                for queue in queues
+            ],
+            'How long the longest waiting due task is overdue')
+        self.metrics.add_counter(
+            'pony_queue_tasks_total',
+            lambda: [
+                ({'queue': queue.name, 'outcome': outcome}, count)
+                for queue in queues
+                for outcome, count in sorted(queue.stats().items())
+                if outcome != 'size'
+            ],
+            'Tasks coalesced, dropped or deferred by a queue')
+        self.metrics.add_gauge(
+            'pony_executor_pending',
+            lambda: [({}, self.executor.pending())],
+            'Keyed tasks waiting for a worker')
+        self.metrics.add_gauge(
+            'pony_dispatcher_pending',
+            lambda: [({}, self.dispatcher.pending())],
+            'Outbound calls waiting to be made')
+        self.metrics.add_counter(
+            'pony_dispatcher_calls_total',
+            lambda: [
+                ({'outcome': outcome}, self.dispatcher.stats()[outcome])
+                for outcome in ('dropped', 'rate_limited', 'retried')
+            ],
+            'Slack API calls rate limited, retried and dropped')
+        self.metrics.add_counter(
+            'pony_dispatcher_throttled_seconds_total',
+            lambda: [({}, self.dispatcher.stats()['throttled_seconds'])],
+            'Time Slack API calls waited for their rate limit')
 
     def get_channel(self, channel_id):
         channels = self.storage.get('channels', dict())
@@ -35,45 +137,89 @@ class StandupPonyPlugin(Plugin):
 
         return channels[channel_id]
 
-    def get_user_by_id(self, user_id):
+    def get_user_directory(self):
         users = self.storage.get('users')
-        for user in users:
-            if user['id'] == user_id:
-                return user
+
+        # user list is replaced as a whole on update, index it once per list
+        if users is not self.user_directory.users:
+            self.user_directory = UserDirectory(users)
+
+        return self.user_directory
+
+    def get_schedules(self, day=None):
+        # days start at UTC midnight, same as days of reports
+        day = day or datetime.utcnow().date()
+
+        # team schedules are compiled once a day, on first use
+        if self.schedules_day != day:
+            self.schedules = compile_schedules(self.plugin_config, day)
+            self.schedules_day = day
+
+        return self.schedules
+
+    def get_im_directory(self):
+        return self.im_directory
+
+    def get_user_by_id(self, user_id):
+        return self.get_user_directory().get_by_id(user_id)
 
     def get_user_by_name(self, user_name):
         user_name = user_name.strip('@')
-        users = self.storage.get('users')
-        for user in users:
-            if user['name'] == user_name:
-                return user
+        return self.get_user_directory().get_by_name(user_name)
 
     def user_is_online(self, user_id):
         user = self.get_user_by_id(user_id)
-        if user is not None and user.get('presence') == 'active':
+        if user is not None and user.presence == 'active':
             return True
 
         return False
 
     def send_typing(self, to, over_time=1.25):
-        time.sleep(over_time * 0.25)
-        self.slack_client.server.send_to_websocket(
-            dict(type='typing', channel=to))
-        time.sleep(over_time * 0.75)
+        self.dispatcher.call_later(
+            over_time * 0.25,
+            self.slack_client.server.send_to_websocket,
+            dict(type='typing', channel=to)
+        )
 
     def lock_user(self, user_id, teams, expire_in):
         lock_key = '{}_lock'.format(user_id)
         self.storage.set(lock_key, teams, expire_in=expire_in)
+        self.awaiting_reports.defer(user_id, time.time() + expire_in)
         logging.info('Locked user {} for {} sec'.format(user_id, expire_in))
 
     def get_user_lock(self, user_id):
         lock_key = '{}_lock'.format(user_id)
         return self.storage.get(lock_key)
 
+    def on_task_overflow(self, task):
+        logging.warning('Fast queue is full, overflowed {}'.format(
+            task.__class__.__name__))
+        task.overflowed(self)
+
+    def get_user_lock_expiry(self, user_id):
+        lock_key = '{}_lock'.format(user_id)
+        expires_at = self.storage.expires_at(lock_key)
+        if expires_at is not None:
+            return calendar.timegm(expires_at.utctimetuple())
+
     def process_message(self, data):
-        self.fast_queue.append(tasks.ReadMessage(data=data))
+        # only direct messages and their edits might be reports, skip the
+        # rest of the traffic before anything gets queued
+        is_relevant = (
+            'bot_id' not in data
+            and data.get('subtype') in (None, 'message_changed')
+            and self.im_directory.is_im(data.get('channel'))
+        )
+        if is_relevant:
+            self.fast_queue.append(
+                tasks.ReadMessage(data=data, received_at=time.time()))
 
     def process_im_created(self, data):
+        # make new channel known right away, full list is refreshed later
+        channel = data.get('channel')
+        if channel:
+            self.get_im_directory().add(channel)
+
         self.fast_queue.append(tasks.UpdateIMList())
 
     def process_presence_change(self, data):
@@ -81,22 +227,25 @@ class StandupPonyPlugin(Plugin):
             data.get('user'), data.get('presence')))
 
     def register_jobs(self):
-        # slow queue, some minutes between runs (slow world queue)
-        self.jobs.append(
-            WorldTick(
-                bot=self,
-                queue=self.slow_queue,
-                interval=2 * 60
-            )
-        )
-        logging.info('Registered slow queue')
-
-        # fast queue, super small delay before tasks flushed (fast world queue)
-        self.jobs.append(
-            WorldTick(
-                bot=self,
-                queue=self.fast_queue,
-                interval=0.5
-            )
-        )
-        logging.info('Registered fast queue')
+        self.dispatcher.start()
+        self.executor.start()
+
+        # tasks deferred from the fast queue keep their order on the executor
+        self.runtime.add_job(WorldTick(
+            bot=self, queue=self.slow_queue, executor=self.executor,
+            metrics=self.metrics, profiler=self.profiler))
+        self.runtime.add_job(WorldTick(
+            bot=self, queue=self.fast_queue, executor=self.executor,
+            metrics=self.metrics, profiler=self.profiler))
+        self.runtime.start(self.slack_client)
+        logging.info('Started runtime')
+
+        if self.plugin_config.get('metrics_port'):
+            self.metrics.serve(self.plugin_config['metrics_port'])
+
+        # kill -USR1 <pid> starts profiling, or stops it before the window
+        # is over, profiles are written as soon as it stops
+        signal.signal(
+            signal.SIGUSR1, lambda signum, frame: self.profiler.toggle())
+        if self.plugin_config.get('profile_on_start'):
+            self.profiler.start()
@@ -0,0 +1,154 @@
+# coding=utf-8
+import os
+import sys
+import time
+import thread
+import pstats
+import cProfile
+import logging
+import threading
+import contextlib
+import collections
+
+
+def format_frame(frame):
+    code = frame.f_code
+    return '{} ({}:{})'.format(
+        code.co_name, os.path.basename(code.co_filename), frame.f_lineno)
+
+
+class Profiler(object):
+    """Profiles ticks and tasks for a window of time, on demand.
+
+    While active, every profiled task runs under cProfile and stacks of
+    the threads running ticks and tasks are sampled each `interval`
+    seconds. Once the window is over, stats are written one file per task
+    type (`<name>.prof`, for pstats or snakeviz) along with sampled stacks
+    in collapsed format (`stacks.folded`, for flamegraph.pl), to a new
+    directory under `directory`. Inactive profiler costs a single check.
+    """
+    def __init__(self, directory='profiles', window=60, interval=0.005):
+        self.directory = directory
+        self.window = window
+        self.interval = interval
+        self.active = False
+        self._lock = threading.Lock()
+        self._labels = collections.defaultdict(list)
+        self._local = threading.local()
+        self._stats = dict()
+        self._stacks = collections.Counter()
+        self._started_at = None
+        self._deadline = None
+        self._sampler = None
+
+    def start(self, window=None):
+        with self._lock:
+            if self.active:
+                return
+
+            self._stats = dict()
+            self._stacks = collections.Counter()
+            self._started_at = time.time()
+            self._deadline = self._started_at + (window or self.window)
+            self.active = True
+
+            self._sampler = threading.Thread(
+                target=self._sample, args=(self._started_at, ),
+                name='Profiler')
+            self._sampler.daemon = True
+            self._sampler.start()
+
+        logging.info('Profiling for {} sec'.format(window or self.window))
+
+    def stop(self):
+        """Stops profiling, returns directory profiles were written to."""
+        with self._lock:
+            if not self.active:
+                return
+
+            self.active = False
+            stats, self._stats = self._stats, dict()
+            stacks, self._stacks = self._stacks, collections.Counter()
+
+        return self.dump(stats, stacks)
+
+    def toggle(self):
+        if self.active:
+            self.stop()
+        else:
+            self.start()
+
+    def dump(self, stats, stacks):
+        directory = os.path.join(
+            self.directory,
+            time.strftime('%Y%m%d-%H%M%S', time.localtime(self._started_at)))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        for name, task_stats in stats.items():
+            task_stats.dump_stats(
+                os.path.join(directory, '{}.prof'.format(name)))
+
+        with open(os.path.join(directory, 'stacks.folded'), 'w') as f:
+            for stack, count in sorted(stacks.items()):
+                f.write('{} {}\n'.format(stack, count))
+
+        logging.info('Profiles written to {}'.format(directory))
+        return directory
+
+    @contextlib.contextmanager
+    def profile(self, name, cprofile=True):
+        """Labels sampled stacks with name, runs block under cProfile."""
+        if not self.active:
+            yield
+            return
+
+        labels = self._labels[thread.get_ident()]
+        labels.append(name)
+
+        # cProfile is per thread and does not nest
+        profile = None
+        if cprofile and not getattr(self._local, 'profiling', False):
+            profile = cProfile.Profile()
+            self._local.profiling = True
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+                self._local.profiling = False
+            labels.pop()
+
+            # profiling might have stopped meanwhile, stats are dumped then
+            if profile is not None:
+                with self._lock:
+                    if self.active and name in self._stats:
+                        self._stats[name].add(profile)
+                    elif self.active:
+                        self._stats[name] = pstats.Stats(profile)
+
+    def _sample(self, started_at):
+        own_id = thread.get_ident()
+        while self.active and time.time() < self._deadline:
+            # profiling was restarted, the new session has its own sampler
+            if self._started_at != started_at:
+                return
+
+            for thread_id, frame in sys._current_frames().items():
+                labels = self._labels.get(thread_id)
+                if thread_id == own_id or not labels:
+                    continue
+
+                labels, stack = list(labels), []
+                while frame is not None:
+                    stack.append(format_frame(frame))
+                    frame = frame.f_back
+
+                with self._lock:
+                    self._stacks[';'.join(labels + stack[::-1])] += 1
+
+            time.sleep(self.interval)
+
+        if self._started_at == started_at:
+            self.stop()
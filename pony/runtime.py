@@ -0,0 +1,460 @@
+# coding=utf-8
+import os
+import time
+import errno
+import fcntl
+import heapq
+import select
+import logging
+import itertools
+import threading
+import collections
+
+
+# task priorities, lower goes first
+HIGH, NORMAL, LOW = 0, 1, 2
+
+OVERFLOW_POLICIES = ('shed', 'defer')
+
+
+class Condition(object):
+    """Condition variable, which sleeps in select() while waiting.
+
+    On Python 2 a timed `threading.Condition.wait` polls, waking up to
+    20 times a second, this one blocks till it is notified or the timeout
+    passes. Notifying wakes up every waiting thread. Both must be called
+    with the lock held, waiting with it held once.
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._pipe = None
+
+    def __enter__(self):
+        self._lock.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._lock.release()
+
+    def __del__(self):
+        if self._pipe is not None:
+            for fd in self._pipe:
+                os.close(fd)
+
+    def notify(self):
+        # nobody has ever waited, nobody is waiting now
+        if self._pipe is None:
+            return
+
+        try:
+            os.write(self._pipe[1], b'.')
+        except OSError as e:
+            # pipe is full, waiting threads are woken up anyway
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def wait(self, timeout=None):
+        if self._pipe is None:
+            self._pipe = os.pipe()
+            for fd in self._pipe:
+                flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+                fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+        self._lock.release()
+        try:
+            select.select([self._pipe[0]], [], [], timeout)
+            os.read(self._pipe[0], 4096)
+        except (OSError, select.error) as e:
+            # nothing to read (timed out) or interrupted by a signal
+            if e.args[0] not in (errno.EAGAIN, errno.EINTR):
+                raise
+        finally:
+            self._lock.acquire()
+
+
+class TaskQueue(object):
+    """Queue of tasks, each one due `delay` seconds after being appended.
+
+    Appending notifies `condition`, which wakes up the runtime. Tasks
+    with an idempotency key are queued once, while an equal one is pending.
+
+    Tasks are kept in order of being due within their priority, due tasks
+    of higher priority are taken first. A queue bounded by `maxlen` makes
+    room by taking the task due first of the lowest priority, which is
+    dropped (`shed` policy) or moved to `overflow_queue` (`defer` policy).
+    Incoming task overflows instead unless it is more important. Tasks
+    which are not `sheddable` are deferred under either policy, these are
+    only dropped if there is no overflow queue. Tasks which overflow are
+    passed to `on_overflow`.
+
+    Tasks sharing an `ordering_key` are deferred together and right away,
+    tasks of that key appended while some are deferred follow them, so
+    none of them runs ahead of a task appended before.
+    """
+    def __init__(self, delay=0, condition=None, maxlen=None,
+                 overflow='shed', overflow_queue=None, on_overflow=None,
+                 name=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy {}'.format(overflow))
+
+        self.name = name
+        self.delay = delay
+        self.condition = condition or Condition()
+        self.maxlen = maxlen
+        self.overflow = overflow
+        self.overflow_queue = overflow_queue
+        self.on_overflow = on_overflow
+        self._lanes = collections.defaultdict(list)
+        self._seq = itertools.count()
+        self._size = 0
+        self._keys = set()
+        self._ordering = collections.Counter()
+        self.coalesced = 0
+        self.dropped = 0
+        self.deferred = 0
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        with self.condition:
+            entries = sorted(
+                entry for lane in self._lanes.values() for entry in lane)
+        return iter([task for due, seq, task in entries])
+
+    def append(self, task, delay=None):
+        """Appends task, returns False if it was coalesced or dropped."""
+        if delay is None:
+            delay = self.delay
+
+        key = getattr(task, 'key', None)
+        priority = getattr(task, 'priority', NORMAL)
+        ordering_key = getattr(task, 'ordering_key', None)
+        with self.condition:
+            if key is not None and key in self._keys:
+                self.coalesced += 1
+                return False
+
+            overflowed = None
+            if (self.maxlen is not None and self._size >= self.maxlen
+                    and not self._follows_deferred(ordering_key)):
+                overflowed = self._make_room(task, priority)
+
+            if overflowed is not task and self._follows_deferred(ordering_key):
+                # earlier tasks of its key are deferred, keep behind them
+                self.deferred += 1
+                self.overflow_queue.append(task, delay=0)
+            elif overflowed is not task:
+                if key is not None:
+                    self._keys.add(key)
+                if ordering_key is not None:
+                    self._ordering[ordering_key] += 1
+                heapq.heappush(
+                    self._lanes[priority],
+                    (time.time() + delay, next(self._seq), task))
+                self._size += 1
+                self.condition.notify()
+
+        if overflowed is not None and self.on_overflow is not None:
+            self.on_overflow(overflowed)
+
+        return overflowed is not task
+
+    def _follows_deferred(self, ordering_key):
+        return (
+            ordering_key is not None
+            and self.overflow_queue is not None
+            and self.overflow_queue._ordering[ordering_key] > 0
+        )
+
+    def _make_room(self, task, priority):
+        """Overflows the least important task, returns it."""
+        lowest = max(
+            lane_priority for lane_priority, lane in self._lanes.items()
+            if lane
+        )
+        if priority >= lowest:
+            # appended last, goes after any queued task of its key
+            self._overflow(task, next(self._seq))
+            return task
+
+        due, seq, taken = self._lanes[lowest][0]
+        self._take(self._lanes[lowest])
+        self._overflow(taken, seq)
+        return taken
+
+    def _overflow(self, task, seq):
+        deferrable = (
+            self.overflow == 'defer' or not getattr(task, 'sheddable', False)
+        )
+        if not deferrable or self.overflow_queue is None:
+            self.dropped += 1
+            return
+
+        ordering_key = getattr(task, 'ordering_key', None)
+        if ordering_key is None:
+            self.deferred += 1
+            self.overflow_queue.append(task)
+            return
+
+        # the rest of its key goes along, all of it in order appended
+        entries = [(seq, task)]
+        for lane in self._lanes.values():
+            following = [
+                entry for entry in lane
+                if getattr(entry[2], 'ordering_key', None) == ordering_key
+            ]
+            for due, other_seq, other in following:
+                self._take(lane, lane.index((due, other_seq, other)))
+                entries.append((other_seq, other))
+
+        for seq, task in sorted(entries):
+            self.deferred += 1
+            self.overflow_queue.append(task, delay=0)
+
+    def _take(self, lane, index=0):
+        if index == 0:
+            due, seq, task = heapq.heappop(lane)
+        else:
+            due, seq, task = lane[index]
+            lane[index] = lane[-1]
+            lane.pop()
+            heapq.heapify(lane)
+
+        self._size -= 1
+        self._keys.discard(getattr(task, 'key', None))
+
+        ordering_key = getattr(task, 'ordering_key', None)
+        if ordering_key is not None:
+            self._ordering[ordering_key] -= 1
+            if not self._ordering[ordering_key]:
+                del self._ordering[ordering_key]
+        return task
+
+    def popleft(self):
+        """Takes due task of the highest priority, or the one due first."""
+        now = time.time()
+        with self.condition:
+            lanes = [lane for priority, lane in sorted(self._lanes.items())
+                     if lane]
+            if not lanes:
+                raise IndexError('pop from an empty queue')
+
+            for lane in lanes:
+                if lane[0][0] <= now:
+                    return self._take(lane)
+
+            return self._take(min(lanes, key=lambda lane: lane[0]))
+
+    def pop(self):
+        """Takes the task appended last."""
+        with self.condition:
+            lanes = [lane for lane in self._lanes.values() if lane]
+            if not lanes:
+                raise IndexError('pop from an empty queue')
+
+            newest = max(
+                (lane[index][1], index, lane) for lane in lanes
+                for index in range(len(lane))
+            )
+            seq, index, lane = newest
+            return self._take(lane, index)
+
+    def ready(self, now=None):
+        """Counts tasks which are due."""
+        now = now or time.time()
+        with self.condition:
+            count = 0
+            for lane in self._lanes.values():
+                # walk the heap down to the first tasks which are not due
+                indexes = [0] if lane else []
+                while indexes:
+                    index = indexes.pop()
+                    if lane[index][0] > now:
+                        continue
+
+                    count += 1
+                    indexes.extend(
+                        child for child in (2 * index + 1, 2 * index + 2)
+                        if child < len(lane)
+                    )
+
+            return count
+
+    def next_due(self):
+        with self.condition:
+            heads = [lane[0][0] for lane in self._lanes.values() if lane]
+            if heads:
+                return min(heads)
+
+    def oldest_age(self, now=None):
+        """Seconds the longest waiting task is overdue, 0 if none is."""
+        next_due = self.next_due()
+        if next_due is None:
+            return 0
+
+        return max((now or time.time()) - next_due, 0)
+
+    def stats(self):
+        return dict(
+            size=len(self),
+            coalesced=self.coalesced,
+            dropped=self.dropped,
+            deferred=self.deferred
+        )
+
+
+class Runtime(object):
+    """Runs jobs as soon as tasks on their queues are due.
+
+    Instead of polling the queues, the runtime thread sleeps till the
+    earliest due task and is woken up when a task is appended.
+
+    Timers hold tasks which should be queued at an exact instant, these are
+    kept in a heap ordered by deadline.
+    """
+    def __init__(self):
+        self.condition = Condition()
+        self.jobs = []
+        self.timers = []
+        self._seq = itertools.count()
+        self._thread = None
+
+    def add_job(self, job):
+        self.jobs.append(job)
+
+    def call_at(self, at, queue, task):
+        """Appends task to the queue once timestamp `at` is reached."""
+        with self.condition:
+            heapq.heappush(self.timers, (at, next(self._seq), queue, task))
+            self.condition.notify()
+
+    def fire_timers(self, now):
+        with self.condition:
+            while self.timers and self.timers[0][0] <= now:
+                at, seq, queue, task = heapq.heappop(self.timers)
+                queue.append(task, delay=0)
+
+    def start(self, slack):
+        self._thread = threading.Thread(
+            target=self.run, args=(slack, ), name='Runtime')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def wait_for_jobs(self):
+        """Blocks till some jobs have tasks due, returns these jobs."""
+        with self.condition:
+            while True:
+                now = time.time()
+                self.fire_timers(now)
+                due_jobs = [job for job in self.jobs if job.ready(now)]
+                if due_jobs:
+                    return due_jobs
+
+                next_due = [
+                    due for due in (job.next_due() for job in self.jobs)
+                    if due is not None
+                ]
+                if self.timers:
+                    next_due.append(self.timers[0][0])
+                self.condition.wait(
+                    min(next_due) - now if next_due else None)
+
+    def run(self, slack):
+        while True:
+            # a failing job must not stop the others, nor the thread
+            try:
+                for job in self.wait_for_jobs():
+                    job.run(slack)
+            except Exception:
+                logging.exception('Problem in job run')
+
+
+class KeyedExecutor(object):
+    """Runs tasks on worker threads, in order of submission within a key.
+
+    Tasks of different keys run in parallel, keys take turns on the
+    workers. Until started, tasks are run right away by the caller.
+
+    The executor is `saturated` once there are as many tasks pending as
+    workers, `condition` is notified as soon as it is not anymore.
+    """
+    def __init__(self, workers=4, condition=None):
+        self.workers = workers
+        self.condition = condition
+        self._condition = threading.Condition()
+        self._ready = collections.deque()
+        self._pending = dict()
+        self._size = 0
+        self._threads = []
+
+    def start(self):
+        for x in range(self.workers):
+            thread = threading.Thread(
+                target=self._work, name='Executor-{}'.format(x))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+        logging.info('Started {} task workers'.format(self.workers))
+
+    def submit(self, key, func, *args, **kwargs):
+        call = (func, args, kwargs)
+        if not self._threads:
+            self._run(call)
+            return
+
+        with self._condition:
+            self._size += 1
+
+            # key already in flight, its worker picks the call up in turn
+            if key in self._pending:
+                self._pending[key].append(call)
+                return
+
+            self._pending[key] = collections.deque([call])
+            self._ready.append(key)
+            self._condition.notify()
+
+    def pending(self):
+        with self._condition:
+            return self._size
+
+    def saturated(self):
+        """Checks if tasks submitted now would wait for a worker."""
+        with self._condition:
+            return bool(self._threads) and self._size >= self.workers
+
+    def _run(self, call):
+        func, args, kwargs = call
+        try:
+            func(*args, **kwargs)
+        except Exception:
+            logging.exception('Task failed')
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while not self._ready:
+                    self._condition.wait()
+
+                key = self._ready.popleft()
+                call = self._pending[key][0]
+
+            self._run(call)
+
+            with self._condition:
+                calls = self._pending[key]
+                calls.popleft()
+                if calls:
+                    self._ready.append(key)
+                    self._condition.notify()
+                else:
+                    del self._pending[key]
+
+                self._size -= 1
+                freed = self._size == self.workers - 1
+
+            if freed and self.condition is not None:
+                with self.condition:
+                    self.condition.notify()
@@ -0,0 +1,66 @@
+# coding=utf-8
+import calendar
+import collections
+import dateutil.tz
+import dateutil.parser
+
+from datetime import datetime, timedelta
+
+
+def parse_time(value):
+    return dateutil.parser.parse(value).time()
+
+
+def parse_duration(value):
+    duration = dateutil.parser.parse(value)
+    return timedelta(hours=duration.hour, minutes=duration.minute)
+
+
+def to_timestamp(day, time, tz):
+    instant = datetime.combine(day, time).replace(tzinfo=tz)
+    return calendar.timegm(instant.utctimetuple())
+
+
+class TeamSchedule(collections.namedtuple(
+        'TeamSchedule', 'team day ask_earliest last_call report_by')):
+    """Team schedule for a single day, instants are UTC timestamps.
+
+    Last call is None when last call is disabled.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def compile(cls, team, team_config, day, tz, last_call):
+        ask_earliest = to_timestamp(
+            day, parse_time(team_config['ask_earliest']), tz)
+        report_by = to_timestamp(
+            day, parse_time(team_config['report_by']), tz)
+
+        return cls(
+            team=team,
+            day=day,
+            ask_earliest=ask_earliest,
+            last_call=(
+                report_by - int(last_call.total_seconds())
+                if last_call else None
+            ),
+            report_by=report_by
+        )
+
+    def deadlines(self):
+        return sorted(
+            instant for instant in
+            (self.ask_earliest, self.last_call, self.report_by)
+            if instant is not None
+        )
+
+
+def compile_schedules(config, day):
+    """Compiles schedules of all active teams for a given day."""
+    tz = dateutil.tz.gettz(config['timezone'])
+    last_call = parse_duration(config['last_call'])
+
+    return {
+        team: TeamSchedule.compile(team, config[team], day, tz, last_call)
+        for team in config['active_teams']
+    }
@@ -1,36 +1,844 @@
 # coding=utf-8
 import os
+import copy
+import json
+import heapq
+import Queue
 import pickle
+import sqlite3
 import pprint
+import weakref
 import threading
+import functools
+import contextlib
+import collections
 import logging
 
 from datetime import datetime, timedelta
 
 
+class Partitions(collections.MutableMapping):
+    """Dictionary stored on disk one item (partition) per file.
+
+    Only the index of items is pickled along with the database, items are
+    loaded on first access. Apart from the newest item and the ones not
+    written to disk yet at most `cache_size` items stay in memory.
+    """
+    def __init__(self, items=None, cache_size=7):
+        self.loader = None
+        self.cache_size = cache_size
+        self._lock = threading.RLock()
+        self._index = set()
+        self._newest = None
+        self._resident = collections.OrderedDict()
+        self._dirty = set()
+        self._pending = collections.Counter()
+        self._source = None
+
+        # given items are not on disk yet, keep them till they are written
+        for subkey, value in (items or {}).items():
+            self._add(subkey)
+            self._resident[subkey] = value
+            self._dirty.add(subkey)
+
+    def __getstate__(self):
+        return {'index': self._index, 'cache_size': self.cache_size}
+
+    def __setstate__(self, state):
+        self.__init__(cache_size=state['cache_size'])
+        for subkey in state['index']:
+            self._add(subkey)
+
+    def __repr__(self):
+        return '<Partitions: {} items, {} loaded>'.format(
+            len(self._index), len(self._resident))
+
+    def _add(self, subkey):
+        self._index.add(subkey)
+        if self._newest is None or subkey > self._newest:
+            self._newest = subkey
+
+    def _evict(self):
+        evictable = [
+            subkey for subkey in self._resident
+            if subkey != self._newest
+            and subkey not in self._dirty
+            and not self._pending[subkey]
+        ]
+        for subkey in evictable[:max(len(evictable) - self.cache_size, 0)]:
+            del self._resident[subkey]
+
+    def __contains__(self, subkey):
+        return subkey in self._index
+
+    def __iter__(self):
+        return iter(sorted(self._index))
+
+    def __len__(self):
+        return len(self._index)
+
+    def __getitem__(self, subkey):
+        with self._lock:
+            if subkey not in self._index:
+                raise KeyError(subkey)
+
+            if subkey in self._resident:
+                value = self._resident.pop(subkey)
+            elif self.loader is not None:
+                value = self.loader(subkey)
+            else:
+                raise KeyError(subkey)
+
+            self._resident[subkey] = value
+            self._evict()
+            return value
+
+    def __setitem__(self, subkey, value):
+        with self._lock:
+            self._add(subkey)
+            self._resident.pop(subkey, None)
+            self._resident[subkey] = value
+            self._evict()
+
+    def __delitem__(self, subkey):
+        with self._lock:
+            self._index.remove(subkey)
+            self._resident.pop(subkey, None)
+            if subkey == self._newest:
+                self._newest = max(self._index) if self._index else None
+
+    def resident(self):
+        """Returns items currently held in memory."""
+        return dict(self._resident)
+
+    def mark(self, subkey=None):
+        """Keeps changed item (all the loaded ones if None) in memory."""
+        with self._lock:
+            if subkey is None:
+                self._dirty.update(self._resident)
+            else:
+                self._dirty.add(subkey)
+
+    def snapshot(self, subkeys=None):
+        """Copies index and changed items for writing to disk."""
+        with self._lock:
+            if subkeys is None:
+                subkeys = set(self._resident) | self._dirty
+
+            snapshot = Partitions(cache_size=self.cache_size)
+            snapshot._source = self
+            for subkey in self._index:
+                snapshot._add(subkey)
+
+            for subkey in subkeys:
+                if subkey in self._resident:
+                    snapshot._resident[subkey] = copy.deepcopy(
+                        self._resident[subkey])
+                    self._pending[subkey] += 1
+
+            self._dirty.difference_update(subkeys)
+            return snapshot
+
+    def written(self):
+        """Lets source items be evicted once the snapshot is on disk."""
+        source, self._source = self._source, None
+        if source is None:
+            return
+
+        with source._lock:
+            for subkey in self._resident:
+                source._pending[subkey] -= 1
+            source._evict()
+
+
+class PickleEngine(object):
+    """Persists the whole database as a single pickle file.
+
+    Values kept as `Partitions` are written one file per changed item into
+    a directory next to the database file.
+    """
+    def __init__(self, file_name):
+        self.file_name = file_name
+
+    def load(self):
+        if not os.path.exists(self.file_name):
+            return dict()
+
+        with open(self.file_name, 'rb') as f:
+            logging.info('Loaded db from disk')
+            return pickle.load(f)
+
+    def partition_file_name(self, key, subkey):
+        return os.path.join(
+            '{}.{}'.format(self.file_name, key), str(subkey))
+
+    def load_partition(self, key, subkey):
+        file_name = self.partition_file_name(key, subkey)
+        if not os.path.exists(file_name):
+            raise KeyError(subkey)
+
+        with open(file_name, 'rb') as f:
+            logging.debug('Loaded {} {} from disk'.format(key, subkey))
+            return pickle.load(f)
+
+    def dump(self, data, file_name=None):
+        file_name = file_name or self.file_name
+
+        # write aside and rename over, so a crash never leaves a partial file
+        temp_file_name = '{}.tmp'.format(file_name)
+        with open(temp_file_name, 'wb') as f:
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.rename(temp_file_name, file_name)
+
+        dir_fd = os.open(
+            os.path.dirname(os.path.abspath(file_name)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    def flush_partitions(self, data, changes):
+        for key, subkeys in changes.items():
+            partitions = data.get(key)
+            if not isinstance(partitions, Partitions):
+                continue
+
+            resident = partitions.resident()
+            for subkey in resident if subkeys is None else subkeys:
+                file_name = self.partition_file_name(key, subkey)
+                if subkey in resident:
+                    if not os.path.exists(os.path.dirname(file_name)):
+                        os.makedirs(os.path.dirname(file_name))
+                    self.dump(resident[subkey], file_name)
+                elif subkey not in partitions and os.path.exists(file_name):
+                    os.remove(file_name)
+
+    def flush(self, data, changes):
+        self.flush_partitions(data, changes)
+        self.dump(data)
+
+
+class JournalEngine(PickleEngine):
+    """Persists changes to an append-only journal next to a checkpoint.
+
+    Every flush appends one compact record per changed key (or per changed
+    item of a dictionary value, see `Storage.touch`), so flush cost follows
+    the amount of changes instead of the database size. Once the journal
+    outgrows the checkpoint it is compacted into a fresh checkpoint.
+    """
+    def __init__(self, file_name, compact_at=64 * 1024):
+        super(JournalEngine, self).__init__(file_name)
+        self.journal_file_name = '{}.journal'.format(file_name)
+        self.compact_at = compact_at
+        self.checkpoint_size = 0
+        self.journal_size = 0
+
+    def load(self):
+        data = super(JournalEngine, self).load()
+        if os.path.exists(self.file_name):
+            self.checkpoint_size = os.path.getsize(self.file_name)
+
+        if not os.path.exists(self.journal_file_name):
+            return data
+
+        replayed = 0
+        with open(self.journal_file_name, 'r+b') as f:
+            while True:
+                offset = f.tell()
+                try:
+                    record = pickle.load(f)
+                except EOFError:
+                    break
+                except Exception:
+                    # partially written tail after a crash, drop it so new
+                    # records are not appended after garbage
+                    logging.warning(
+                        'Dropping broken journal tail at {}'.format(offset))
+                    f.truncate(offset)
+                    break
+
+                self.apply(data, record)
+                replayed += 1
+
+            self.journal_size = f.tell()
+
+        logging.info('Replayed {} journal records'.format(replayed))
+        return data
+
+    @staticmethod
+    def apply(data, record):
+        op, key = record[:2]
+        if op == 'set':
+            data[key] = record[2]
+        elif op == 'unset':
+            data.pop(key, None)
+        elif op == 'set_item':
+            data.setdefault(key, dict())[record[2]] = record[3]
+        elif op == 'unset_item':
+            data.get(key, dict()).pop(record[2], None)
+
+    @staticmethod
+    def records(data, changes):
+        for key, subkeys in changes.items():
+            if key not in data:
+                yield ('unset', key)
+            elif subkeys is None or isinstance(data[key], Partitions):
+                # partitions pickle their index only
+                yield ('set', key, data[key])
+            else:
+                for subkey in subkeys:
+                    if subkey in data[key]:
+                        yield ('set_item', key, subkey, data[key][subkey])
+                    else:
+                        yield ('unset_item', key, subkey)
+
+    def flush(self, data, changes):
+        if not changes:
+            return
+
+        self.flush_partitions(data, changes)
+        with open(self.journal_file_name, 'ab') as f:
+            for record in self.records(data, changes):
+                pickle.dump(record, f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+            self.journal_size = f.tell()
+
+        if self.journal_size > max(self.checkpoint_size, self.compact_at):
+            self.compact(data)
+
+    def compact(self, data):
+        self.dump(data)
+        self.checkpoint_size = os.path.getsize(self.file_name)
+
+        # checkpoint already contains everything journaled so far
+        with open(self.journal_file_name, 'wb'):
+            self.journal_size = 0
+
+        logging.info('Compacted db journal into checkpoint')
+
+
+class SQLiteEngine(object):
+    """Persists the database into SQLite (in WAL mode).
+
+    Values are pickled into a key value table along with their expiration.
+    Report partitions are split into a row per team and a row per user
+    report, only rows which have changed are written on flush and history
+    can be queried without unpickling anything.
+
+    The database lives in `<file_name>.sqlite`, when it is created a database
+    written by the pickle or journal engine to `file_name` is imported.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS kv (
+            key TEXT PRIMARY KEY,
+            value BLOB,
+            expire_at timestamp
+        );
+        CREATE TABLE IF NOT EXISTS team_report (
+            day date,
+            team TEXT,
+            data BLOB,
+            PRIMARY KEY (day, team)
+        );
+        CREATE TABLE IF NOT EXISTS user_report (
+            day date,
+            team TEXT,
+            user TEXT,
+            reported_at timestamp,
+            report TEXT,
+            data BLOB,
+            PRIMARY KEY (day, team, user)
+        );
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        if file_name != ':memory:':
+            self.file_name = '{}.sqlite'.format(file_name)
+        self._lock = threading.Lock()
+
+        # rows of the last written day, as pickled when last written
+        self._rows_day = None
+        self._rows = dict()
+
+        source = JournalEngine(file_name)
+        migrate = (
+            self.file_name != file_name
+            and not os.path.exists(self.file_name)
+            and (os.path.exists(source.file_name)
+                 or os.path.exists(source.journal_file_name))
+        )
+        self.connection = sqlite3.connect(
+            self.file_name,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            check_same_thread=False
+        )
+        with self._lock:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.executescript(self.SCHEMA)
+
+        if migrate:
+            self.migrate(source)
+
+    def migrate(self, source):
+        """Imports database written by the pickle or journal engine."""
+        data = source.load()
+        with self._lock:
+            with self.connection:
+                for key, value in data.items():
+                    if not isinstance(value, Partitions):
+                        continue
+                    for day in value:
+                        self.write_report(
+                            day, source.load_partition(key, day))
+            self.write(data, dict.fromkeys(data))
+            self._rows_day = None
+
+        logging.info('Imported db from {}'.format(source.file_name))
+
+    @staticmethod
+    def dumps(value):
+        return sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    @staticmethod
+    def loads(value):
+        return pickle.loads(str(value))
+
+    def load(self):
+        data = dict(_expire=dict())
+        with self._lock:
+            rows = self.connection.execute(
+                'SELECT key, value, expire_at FROM kv').fetchall()
+
+        for key, value, expire_at in rows:
+            data[str(key)] = self.loads(value)
+            if expire_at is not None:
+                data['_expire'][str(key)] = expire_at
+
+        logging.info('Loaded db from disk')
+        return data
+
+    def load_partition(self, key, day):
+        with self._lock:
+            teams = self.connection.execute(
+                'SELECT team, data FROM team_report WHERE day = ?',
+                (day, )).fetchall()
+            users = self.connection.execute(
+                'SELECT team, user, data FROM user_report WHERE day = ?',
+                (day, )).fetchall()
+
+        day_report = {
+            team: self.loads(data) for team, data in teams
+        }
+        for team, user, data in users:
+            team_report = day_report.setdefault(team, dict(reports={}))
+            team_report['reports'][user] = self.loads(data)
+
+        logging.debug('Loaded {} {} from disk'.format(key, day))
+        return day_report
+
+    def write_report(self, day, day_report):
+        if day_report is None or day != self._rows_day:
+            # rows of this day are not known, rewrite them all
+            self._rows_day, self._rows = day, dict()
+            self.connection.execute(
+                'DELETE FROM team_report WHERE day = ?', (day, ))
+            self.connection.execute(
+                'DELETE FROM user_report WHERE day = ?', (day, ))
+
+        if day_report is None:
+            self._rows_day = None
+            return
+
+        rows = dict()
+        for team, team_report in day_report.items():
+            team_data = dict(team_report)
+            if 'reports' in team_data:
+                team_data['reports'] = dict()
+            rows[team, None] = team_data
+
+            for user, user_report in team_report.get('reports', {}).items():
+                rows[team, user] = user_report
+
+        for (team, user), value in rows.items():
+            data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            if self._rows.get((team, user)) == data:
+                continue
+
+            if user is None:
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO team_report (day, team, data) '
+                    'VALUES (?, ?, ?)',
+                    (day, team, sqlite3.Binary(data)))
+            else:
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO user_report '
+                    '(day, team, user, reported_at, report, data) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (day, team, user, value.get('reported_at'),
+                     json.dumps(value.get('report', [])),
+                     sqlite3.Binary(data)))
+            self._rows[team, user] = data
+
+        for team, user in set(self._rows) - set(rows):
+            if user is None:
+                self.connection.execute(
+                    'DELETE FROM team_report WHERE day = ? AND team = ?',
+                    (day, team))
+            else:
+                self.connection.execute(
+                    'DELETE FROM user_report '
+                    'WHERE day = ? AND team = ? AND user = ?',
+                    (day, team, user))
+            del self._rows[team, user]
+
+    def flush(self, data, changes):
+        with self._lock:
+            try:
+                self.write(data, changes)
+            except Exception:
+                # transaction is rolled back, forget rows written within
+                self._rows_day = None
+                raise
+
+    def write(self, data, changes):
+        expire = data.get('_expire', {})
+        with self.connection:
+            for key, subkeys in changes.items():
+                if key == '_expire':
+                    continue
+
+                if key not in data:
+                    self.connection.execute(
+                        'DELETE FROM kv WHERE key = ?', (key, ))
+                    continue
+
+                if isinstance(data[key], Partitions):
+                    resident = data[key].resident()
+                    for day in resident if subkeys is None else subkeys:
+                        if day in resident:
+                            self.write_report(day, resident[day])
+                        elif day not in data[key]:
+                            self.write_report(day, None)
+
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO kv (key, value, expire_at) '
+                    'VALUES (?, ?, ?)',
+                    (key, self.dumps(data[key]), expire.get(key)))
+
+            if '_expire' in changes:
+                for key in changes['_expire'] or expire.keys():
+                    self.connection.execute(
+                        'UPDATE kv SET expire_at = ? WHERE key = ?',
+                        (expire.get(key), key))
+
+
+ENGINES = {
+    'pickle': PickleEngine,
+    'journal': JournalEngine,
+    'sqlite': SQLiteEngine,
+}
+
+
+class SharedLock(object):
+    """Lock held either by any number of shared holders or by a single
+    exclusive one. Not reentrant.
+    """
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._shared = 0
+        self._exclusive = False
+
+    @contextlib.contextmanager
+    def shared(self):
+        with self._condition:
+            while self._exclusive:
+                self._condition.wait()
+            self._shared += 1
+
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._shared -= 1
+                if not self._shared:
+                    self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def exclusive(self):
+        with self._condition:
+            while self._exclusive or self._shared:
+                self._condition.wait()
+            self._exclusive = True
+
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._exclusive = False
+                self._condition.notify_all()
+
+
+def freeze(value):
+    if isinstance(value, collections.Mapping):
+        return ReadOnlyView(value)
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+
+    return value
+
+
+class ReadOnlyView(collections.Mapping):
+    """Read-only view of a dictionary, nested values are read-only too."""
+    def __init__(self, data):
+        self._data = data
+
+    def __getitem__(self, key):
+        return freeze(self._data[key])
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.__class__.__name__, self._data)
+
+
 class Storage(object):
-    """Simple key value storage."""
-    def __init__(self, file_name=None):
+    """Simple key value storage.
+
+    Saving takes a copy-on-write snapshot under the lock and hands it over
+    to a background writer thread, so callers never wait for the disk.
+
+    Dictionaries stored under `partitioned` keys are kept as `Partitions`,
+    with at most `cache_size` of their older items loaded at a time.
+
+    Expiring keys are indexed by a heap ordered by expiration time, `sweep`
+    evicts the expired ones without looking at the rest.
+
+    Values changed in place are changed within a `transaction`, which
+    serializes changes of the same item (or of the same scopes of it) and
+    keeps snapshots from seeing a change half done.
+    """
+    def __init__(self, file_name=None, engine='pickle', partitioned=(),
+                 cache_size=7):
         self._lock = threading.Lock()
         self._file_name = file_name
+        self._engine = ENGINES[engine](file_name)
+        self._partitioned = partitioned
+        self._cache_size = cache_size
+        self._changes = dict()
         self._data = self.load()
 
         # get or set expiration dictionary
         if self._data.get('_expire') is None:
             self._data['_expire'] = dict()
 
+        self._index_expiry()
+        self._swept = 0
+
+        for key in self._partitioned:
+            if key in self._data:
+                self._data[key] = self._partition(key, self._data[key])
+
+                # migrate items kept in place by older database files
+                self._mark(key)
+
+        # last snapshot, its values are private copies never changed again
+        self._frozen = copy.deepcopy(self._data)
+
+        self._queue = Queue.Queue()
+        self._writer = None
+
+        # snapshots are exclusive to transactions, transactions share items
+        # and take a lock per scope they change
+        self._gate = SharedLock()
+        self._item_locks = weakref.WeakValueDictionary()
+        self._scope_locks = weakref.WeakValueDictionary()
+
+    def _index_expiry(self):
+        # (expire at, key) pairs, stale once key is unset or set again
+        self._expiry = [
+            (expire_at, key)
+            for key, expire_at in self._data['_expire'].items()
+        ]
+        heapq.heapify(self._expiry)
+
+    def _partition(self, key, value):
+        if not isinstance(value, Partitions):
+            value = Partitions(value, cache_size=self._cache_size)
+
+        value.loader = functools.partial(self._engine.load_partition, key)
+        return value
+
+    def _mark(self, key, subkey=None):
+        """Records a change of key (or of a single item of its value)."""
+        if isinstance(self._data.get(key), Partitions):
+            self._data[key].mark(subkey)
+
+        if subkey is None:
+            self._changes[key] = None
+        elif key not in self._changes:
+            self._changes[key] = {subkey}
+        elif self._changes[key] is not None:
+            self._changes[key].add(subkey)
+
     def set(self, key, value, expire_in=None):
         with self._lock:
+            if key in self._partitioned:
+                value = self._partition(key, value)
+
+            # same object might have been changed in place, equal one not
+            current = self._data.get(key)
+            is_changed = (
+                key not in self._data
+                or value is current
+                or isinstance(value, Partitions)
+                or value != current
+            )
+
             self._data[key] = value
+            if is_changed:
+                self._mark(key)
             if expire_in is not None:
-                self._data['_expire'][key] = datetime.utcnow() + timedelta(
-                    seconds=expire_in)
+                expire_at = datetime.utcnow() + timedelta(seconds=expire_in)
+                self._data['_expire'][key] = expire_at
+                self._mark('_expire', key)
+                heapq.heappush(self._expiry, (expire_at, key))
+
+                # do not let stale entries of extended keys pile up
+                if len(self._expiry) > 2 * len(self._data['_expire']) + 64:
+                    self._index_expiry()
 
     def unset(self, key):
         with self._lock:
             del self._data[key]
+            self._mark(key)
             if key in self._data['_expire']:
                 del self._data['_expire'][key]
+                self._mark('_expire', key)
+
+    def is_dirty(self):
+        """Tells if there are changes not flushed to disk yet."""
+        return bool(self._changes)
+
+    def touch(self, key, subkey=None):
+        """Marks value of key as changed in place.
+
+        Values returned by `get` are mutable and tasks update them directly,
+        this lets storage know they have to be persisted. For dictionary
+        values pass a subkey to persist only the item that has changed.
+        Changes made by several threads should use `transaction` instead.
+        """
+        with self._lock:
+            self._mark(key, subkey)
+
+    def _get_lock(self, locks, lock_id, factory):
+        with self._lock:
+            lock = locks.get(lock_id)
+            if lock is None:
+                lock = locks[lock_id] = factory()
+            return lock
+
+    @contextlib.contextmanager
+    def transaction(self, key, subkey=None, scopes=None, default=None):
+        """Changes value of key (or its item under subkey) in place.
+
+        Yields the value, which is marked as changed when the block exits.
+        Pass `scopes` to only lock the parts of the value being changed,
+        e.g. teams of a daily report, transactions with other scopes of the
+        same item run at the same time.
+        """
+        item_lock = self._get_lock(
+            self._item_locks, (key, subkey), SharedLock)
+        scope_locks = [
+            self._get_lock(
+                self._scope_locks, (key, subkey, scope), threading.Lock)
+            for scope in sorted(set(scopes or []))
+        ]
+
+        with self._gate.shared():
+            if scopes is None:
+                item_context = item_lock.exclusive()
+            else:
+                item_context = item_lock.shared()
+
+            with item_context:
+                for lock in scope_locks:
+                    lock.acquire()
+                try:
+                    value = self.get(key)
+                    if subkey is not None:
+                        if subkey not in value and default is not None:
+                            value[subkey] = default
+                        value = value.get(subkey)
+
+                    yield value
+                finally:
+                    for lock in reversed(scope_locks):
+                        lock.release()
+                    self.touch(key, subkey)
+
+    def update(self, key, fn, subkey=None, scopes=None, default=None):
+        """Applies fn to value of key within a transaction, returns result.
+        """
+        with self.transaction(key, subkey, scopes, default) as value:
+            return fn(value)
+
+    def view(self, key, default=None):
+        """Returns a read-only view of value of key."""
+        return freeze(self.get(key, default))
+
+    def _expire(self, key):
+        self._data.pop(key, None)
+        del self._data['_expire'][key]
+        self._mark(key)
+        self._mark('_expire', key)
+
+    def sweep(self):
+        """Evicts expired keys, returns number of evicted ones."""
+        now, swept = datetime.utcnow(), 0
+        with self._lock:
+            while self._expiry and self._expiry[0][0] < now:
+                expire_at, key = heapq.heappop(self._expiry)
+                if self._data['_expire'].get(key) != expire_at:
+                    continue
+
+                self._expire(key)
+                swept += 1
+
+            self._swept += swept
+
+        if swept:
+            logging.debug('Swept {} expired keys'.format(swept))
+
+        return swept
+
+    def expiry_stats(self):
+        """Counts expiring keys which are still live and already expired."""
+        now = datetime.utcnow()
+        with self._lock:
+            expired = sum(
+                1 for expire_at in self._data['_expire'].values()
+                if expire_at < now
+            )
+            return dict(
+                live=len(self._data['_expire']) - expired,
+                expired=expired,
+                swept=self._swept
+            )
+
+    def expires_at(self, key):
+        """Returns expiration time of a key, None if key does not expire."""
+        with self._lock:
+            return self._data['_expire'].get(key)
 
     def get(self, key, default=None):
         with self._lock:
@@ -39,39 +847,98 @@ class Storage(object):
                 and datetime.utcnow() > self._data['_expire'][key]
             )
             if is_expired_key:
-                del self._data[key]
-                del self._data['_expire'][key]
+                self._expire(key)
 
             if key not in self._data and default is not None:
+                if key in self._partitioned:
+                    default = self._partition(key, default)
+
                 self._data[key] = default
+                self._mark(key)
 
             return self._data.get(key)
 
+    def _snapshot(self, changes):
+        """Copies changed values (or changed items only) into a snapshot."""
+        frozen = dict(self._frozen)
+        for key, subkeys in changes.items():
+            if key not in self._data:
+                frozen.pop(key, None)
+            elif isinstance(self._data[key], Partitions):
+                frozen[key] = self._data[key].snapshot(subkeys)
+            elif subkeys is None or not isinstance(frozen.get(key), dict):
+                frozen[key] = copy.deepcopy(self._data[key])
+            else:
+                value = dict(frozen[key])
+                for subkey in subkeys:
+                    if subkey in self._data[key]:
+                        value[subkey] = copy.deepcopy(self._data[key][subkey])
+                    else:
+                        value.pop(subkey, None)
+                frozen[key] = value
+
+        self._frozen = frozen
+        return frozen
+
     def save(self):
-        with open(self._file_name, 'wb') as f:
-            pickle.dump(self._data, f)
+        with self._lock:
+            if not self._changes:
+                logging.debug('Nothing changed since last flush')
+                return
 
-        self.debug()
-        logging.debug('Flushed db to disk')
+        # wait for transactions in progress, then hold new ones off
+        with self._gate.exclusive(), self._lock:
+            changes, self._changes = self._changes, dict()
+            snapshot = self._snapshot(changes)
 
-    def load(self):
-        if not os.path.exists(self._file_name):
-            return dict()
+            if self._writer is None:
+                self._writer = threading.Thread(
+                    target=self._write, name='StorageWriter')
+                self._writer.daemon = True
+                self._writer.start()
 
-        with open(self._file_name, 'rb') as f:
-            logging.info('Loaded db from disk')
-            return pickle.load(f)
+            # snapshots are written in the order they were taken
+            self._queue.put((snapshot, changes))
+
+    def wait(self):
+        """Blocks until all saved snapshots are written to disk."""
+        self._queue.join()
+
+    def _write(self):
+        while True:
+            snapshot, changes = self._queue.get()
+            try:
+                self._engine.flush(snapshot, changes)
+                self.debug(snapshot)
+                logging.debug('Flushed db to disk')
+            except Exception:
+                logging.exception('Unable to flush db to disk')
+
+                # keep changes around for the next save
+                with self._lock:
+                    for key, subkeys in changes.items():
+                        for subkey in subkeys or [None]:
+                            self._mark(key, subkey)
+            finally:
+                for key in changes:
+                    if isinstance(snapshot.get(key), Partitions):
+                        snapshot[key].written()
+
+                self._queue.task_done()
+
+    def load(self):
+        return self._engine.load()
 
-    def debug(self):
+    def debug(self, data=None):
         data = {
-            key: value for key, value in self._data.items()
+            key: value for key, value in (data or self._data).items()
             if key not in ['ims', 'users']
 
         }
 
         today = datetime.today().date()
         if 'report' in data and today in data['report']:
-            data['report'] = {today: data['report'][today]}
+            data['report'] = {today: data['report'].get(today)}
 
         logging.debug('Dumping database to stdout (significant bits only)')
         logging.debug(pprint.pformat(data, indent=4))
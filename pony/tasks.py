@@ -1,34 +1,61 @@
 # coding=utf-8
+import time
 import logging
 import calendar
-import dateutil.tz
-import dateutil.parser
 
 from datetime import datetime, timedelta
+from functools import partial
 from collections import defaultdict
 
 from .dictionary import Dictionary
+from .directory import User, IMDirectory
+from .awaiting import AwaitingReports
+from .runtime import HIGH, NORMAL, LOW
 
 
 class Task(object):
-    """Single task."""
+    """Single task.
+
+    Tasks with the same key are considered equal, while one of them is
+    pending the others are not queued. Only housekeeping and events which
+    are not reports (low priority) might be dropped when a queue is full,
+    the rest is deferred.
+    """
+    key = None
+    priority = NORMAL
+    ordering_key = None
+
+    @property
+    def sheddable(self):
+        return self.priority == LOW
+
     def execute(self, bot, slack):
         pass
 
+    def overflowed(self, bot):
+        """Called when task is dropped or deferred as its queue is full."""
+        pass
+
 
 class SendMessage(Task):
-    """Sends a single message to channel or user."""
-    def __init__(self, to, text, attachments=None):
+    """Sends a single message to channel or user.
+
+    Optional `on_sent` callback is called once Slack accepts the message.
+    """
+    typing_time = 1.25
+
+    def __init__(self, to, text, attachments=None, on_sent=None):
         self.to = to
         self.text = text
         self.attachments = attachments
+        self.on_sent = on_sent
 
-    def get_im_channel(self, bot, to):
-        for im in bot.storage.get('ims', []):
-            if im.get('user', None) == self.to:
-                return im['id']
+    @property
+    def ordering_key(self):
+        return self.to
 
-        return to
+    def get_im_channel(self, bot, to):
+        return bot.get_im_directory().get_channel(to) or to
 
     def execute(self, bot, slack):
         im_channel = self.get_im_channel(bot, self.to)
@@ -36,9 +63,13 @@ class SendMessage(Task):
         logging.info(u'Sending message "{}" to {} (typing event to {})'.format(
             self.text, self.to, im_channel))
 
-        bot.send_typing(to=im_channel)
-        slack.api_call(
+        # message goes out after a typing event, without waiting for it here
+        bot.send_typing(to=im_channel, over_time=self.typing_time)
+        bot.dispatcher.api_call(
+            slack,
             'chat.postMessage',
+            delay=self.typing_time,
+            callback=self.on_sent,
             channel=self.to,
             text=self.text,
             attachments=self.attachments,
@@ -48,54 +79,97 @@ class SendMessage(Task):
 
 class UpdateUserList(Task):
     """Updates team user list."""
+    key = 'update_user_list'
+    priority = LOW
+
     def execute(self, bot, slack):
         logging.info('Updating user list')
-        user_list = slack.api_call('users.list', presence=1)
+
+        # keep refreshing, even if this time the list is not there
+        bot.slow_queue.append(UpdateUserList())
+
+        user_list = bot.dispatcher.call(slack, 'users.list', presence=1)
+        if not user_list.get('ok'):
+            logging.error('Failed to update user list: {}'.format(
+                user_list.get('error')))
+            return
+
         users = [
-            user for user in user_list['members']
-            if not user['deleted']
+            User.from_slack(member) for member in user_list['members']
+            if not member['deleted']
         ]
 
         bot.storage.set('users', users)
-        bot.slow_queue.append(UpdateUserList())
+        bot.profile_cache.update(users)
+
+        # presence change events might be missed, wake up users back online
+        now = time.time()
+        for user_id in bot.awaiting_reports.parked():
+            if bot.user_is_online(user_id):
+                bot.awaiting_reports.online(user_id, now)
 
 
 class UpdateIMList(Task):
     """Updates current IM list."""
+    key = 'update_im_list'
+    priority = LOW
+
     def execute(self, bot, slack):
         logging.info('Updating IM list')
+        im_list = bot.dispatcher.call(slack, 'im.list')
+        if not im_list.get('ok'):
+            logging.error('Failed to update IM list: {}'.format(
+                im_list.get('error')))
+            bot.slow_queue.append(UpdateIMList())
+            return
+
         ims = [
-            im for im in slack.api_call('im.list')['ims']
+            im for im in im_list['ims']
             if im['is_im'] and not im['is_user_deleted']
         ]
 
         bot.storage.set('ims', ims)
+        bot.im_directory = IMDirectory(ims)
 
 
 class SyncDB(Task):
     """Syncs in-memory database to file."""
+    key = 'sync_db'
+    priority = LOW
+
     def execute(self, bot, slack):
+        bot.storage.sweep()
         bot.storage.save()
         bot.slow_queue.append(SyncDB())
 
 
+class WriteMetrics(Task):
+    """Writes metrics to file, for scraping them from disk."""
+    key = 'write_metrics'
+    priority = LOW
+
+    def execute(self, bot, slack):
+        bot.slow_queue.append(WriteMetrics())
+        bot.metrics.write(bot.plugin_config['metrics_file'])
+
+
 class SendReportSummary(Task):
     """Sends a report summary to team channel."""
     def __init__(self, team):
         self.team = team
-        self.user_profiles = None
 
-    def get_user_avatar(self, slack, user_id):
-        # lazy load profiles once
-        if self.user_profiles is None:
-            self.user_profiles = slack.api_call('users.list')['members']
+    def get_user_avatar(self, bot, slack, user_id):
+        return bot.profile_cache.get_avatar(slack, user_id)
 
-        for user in self.user_profiles:
-            if user['id'] == user_id:
-                return user['profile']['image_192']
+    def record_latency(self, bot):
+        schedule = bot.get_schedules().get(self.team)
+        if schedule is not None:
+            # summaries posted before the deadline are on time
+            bot.latency.record(
+                'summary', max(time.time() - schedule.report_by, 0))
 
     def execute(self, bot, slack):
-        report = bot.storage.get('report')
+        report = bot.storage.view('report')
         today = datetime.utcnow().date()
         logging.info('Building report summary for {}'.format(self.team))
 
@@ -122,7 +196,7 @@ class SendReportSummary(Task):
             for user in team_config['users']
         ]
         user_ids = [
-            user['id'] for user in
+            user.id for user in
             filter(None, map(bot.get_user_by_name, user_names))
         ]
 
@@ -137,8 +211,8 @@ class SendReportSummary(Task):
                 logging.error('Unable to find user by id: {}'.format(user_id))
                 continue
 
-            full_name = user_data['profile'].get('real_name')
-            color = '#{}'.format(user_data.get('color'))
+            full_name = user_data.real_name
+            color = '#{}'.format(user_data.color)
 
             if not report_data.get('seen_online'):
                 offline_users.append(full_name)
@@ -151,7 +225,7 @@ class SendReportSummary(Task):
             user_report = {
                 'color': color,
                 'title': full_name,
-                'thumb_url': self.get_user_avatar(slack, user_id),
+                'thumb_url': self.get_user_avatar(bot, slack, user_id),
                 'ts': calendar.timegm(report_data['reported_at'].timetuple()),
                 'text': u'\n'.join(report_data['report'])[:1024]
             }
@@ -175,6 +249,14 @@ class SendReportSummary(Task):
             })
 
         if reports:
+            with bot.storage.transaction(
+                    'report', today, scopes=[self.team]) as day_report:
+                # summary might have been sent meanwhile
+                if day_report[self.team].get('reported_at') is not None:
+                    return
+
+                day_report[self.team]['reported_at'] = datetime.utcnow()
+
             channel = team_config['post_summary_to']
             bot.fast_queue.append(
                 SendMessage(
@@ -182,17 +264,26 @@ class SendReportSummary(Task):
                     text='Summary for {}: {}'.format(
                         team_config['name'], today.strftime('%A, %d %B')
                     ),
-                    attachments=reports
+                    attachments=reports,
+                    on_sent=partial(self.record_latency, bot)
                 )
             )
 
-            team_report['reported_at'] = datetime.utcnow()
-
             logging.info('Reported status for {}'.format(self.team))
 
 
 class CheckReports(Task):
     """Checks reports statuses."""
+    def __init__(self, teams=None):
+        self.teams = teams
+
+    @property
+    def key(self):
+        if self.teams is None:
+            return 'check_reports'
+
+        return 'check_reports', tuple(self.teams)
+
     def is_weekend(self, today):
         return today.isoweekday() in (6, 7)
 
@@ -204,28 +295,17 @@ class CheckReports(Task):
         is_holiday = self.is_holiday(bot, today)
         return not is_weekend and not is_holiday
 
-    def is_time_to_send_summary(self, bot, report_by):
-        tz = dateutil.tz.gettz(bot.plugin_config['timezone'])
-        report_by = dateutil.parser.parse(report_by).replace(tzinfo=tz)
-        now = datetime.now(dateutil.tz.tzlocal())
-        return now >= report_by
-
-    def is_last_call(self, bot, report_by):
-        tz = dateutil.tz.gettz(bot.plugin_config['timezone'])
-        report_by = dateutil.parser.parse(report_by).replace(tzinfo=tz)
-        last_call = dateutil.parser.parse(bot.plugin_config['last_call'])
-        last_call = timedelta(hours=last_call.hour, minutes=last_call.minute)
-        if not last_call:
+    def is_time_to_send_summary(self, schedule, now):
+        return now >= schedule.report_by
+
+    def is_last_call(self, schedule, now):
+        if schedule.last_call is None:
             return
 
-        now = datetime.now(dateutil.tz.tzlocal())
-        return report_by - now < last_call
+        return now >= schedule.last_call
 
-    def is_too_early_to_ask(self, bot, ask_earliest):
-        tz = dateutil.tz.gettz(bot.plugin_config['timezone'])
-        ask_earliest = dateutil.parser.parse(ask_earliest).replace(tzinfo=tz)
-        now = datetime.now(dateutil.tz.tzlocal())
-        return now < ask_earliest
+    def is_too_early_to_ask(self, schedule, now):
+        return now < schedule.ask_earliest
 
     def init_empty_report(self, bot, team_config):
         team_report = dict(reports={})
@@ -240,7 +320,7 @@ class CheckReports(Task):
                 logging.error('Unable to find user by name {}'.format(user))
                 continue
 
-            team_report['reports'][user_data['id']] = {
+            team_report['reports'][user_data.id] = {
                 'department': department,
                 'report': []
             }
@@ -248,8 +328,9 @@ class CheckReports(Task):
         return team_report
 
     def execute(self, bot, slack):
-        # schedule next check
-        bot.slow_queue.append(CheckReports())
+        # schedule next check, unless fired by a team deadline
+        if self.teams is None:
+            bot.slow_queue.append(CheckReports())
 
         today = datetime.utcnow().date()
 
@@ -258,44 +339,54 @@ class CheckReports(Task):
             UpdateUserList().execute(bot, slack)
 
             logging.info('Initializing empty report for {}'.format(today))
-            report[today] = dict()
 
         # ensure report entries exist for current day and all the teams
         teams = bot.plugin_config['active_teams']
+        new_teams = [
+            new_team for new_team in teams
+            if new_team not in report.get(today, {})
+        ]
+        if new_teams or today not in report:
+            with bot.storage.transaction(
+                    'report', today, default=dict()) as day_report:
+                for team in new_teams:
+                    logging.info(
+                        'Initializing empty report for {} {}'.format(
+                            team, today))
+                    day_report[team] = self.init_empty_report(
+                        bot, bot.plugin_config[team])
+
+        if new_teams or bot.awaiting_reports.day != today:
+            bot.awaiting_reports = self.index_awaiting_reports(
+                report[today], today)
+        awaiting_reports = bot.awaiting_reports
+
+        now = time.time()
+        schedules = bot.get_schedules(today)
+        is_reportable = self.is_reportable(bot, today)
+        askable_teams, ask_earliest, last_call_users = set(), {}, set()
         for team in teams:
-            team_config = bot.plugin_config[team]
-
-            if team not in report[today]:
-                logging.info(
-                    'Initializing empty report for {} {}'.format(
-                        team, today))
-                report[today][team] = self.init_empty_report(bot, team_config)
-
-        teams_by_user = defaultdict(list)
-        for team, users_data in report[today].items():
-            for user_id in users_data['reports'].keys():
-                teams_by_user[user_id].append(team)
-
-        for team in teams:
+            in_scope = self.teams is None or team in self.teams
             team_config = bot.plugin_config[team]
             team_report = report[today][team]
+            schedule = schedules[team]
 
             if team_report.get('reported_at'):
                 logging.debug('Team {} already reported'.format(team))
                 continue
 
-            is_reportable = self.is_reportable(bot, today)
             if not is_reportable:
                 logging.debug('Today is not reportable (weekend or holiday)')
 
                 report_holiday = (
+                    in_scope and
                     self.is_holiday(bot, today) and
-                    not self.is_too_early_to_ask(
-                        bot, team_config['ask_earliest']
-                    )
+                    not self.is_too_early_to_ask(schedule, now)
                 )
                 if report_holiday:
-                    team_report['reported_at'] = datetime.utcnow()
+                    with bot.storage.transaction(
+                            'report', today, scopes=[team]):
+                        team_report['reported_at'] = datetime.utcnow()
                     holiday = bot.plugin_config.get('holidays', []).get(today)
                     bot.fast_queue.append(
                         SendMessage(
@@ -308,61 +399,162 @@ class CheckReports(Task):
                     )
                 continue
 
-            if self.is_too_early_to_ask(bot, team_config['ask_earliest']):
+            if self.is_too_early_to_ask(schedule, now):
                 logging.debug('Too early to ask people on {}'.format(team))
+                ask_earliest[team] = schedule.ask_earliest
                 continue
 
-            if self.is_time_to_send_summary(bot, team_config['report_by']):
-                logging.debug('It is time to send summary for {}'.format(team))
-                bot.fast_queue.append(SendReportSummary(team))
+            if self.is_time_to_send_summary(schedule, now):
+                if in_scope:
+                    logging.debug(
+                        'It is time to send summary for {}'.format(team))
+                    bot.fast_queue.append(SendReportSummary(team))
                 continue
 
+            askable_teams.add(team)
+
             last_call = (
-                self.is_last_call(bot, team_config['report_by'])
+                in_scope
+                and self.is_last_call(schedule, now)
                 and team_report.get('last_call_at') is None
             )
             if last_call:
                 logging.debug('Sending last call for {}'.format(team))
-                team_report['last_call_at'] = datetime.utcnow()
+                with bot.storage.transaction('report', today, scopes=[team]):
+                    team_report['last_call_at'] = datetime.utcnow()
+
+                # last call goes to everyone who has not reported yet
+                for user_id in team_report['reports'].keys():
+                    if user_id in awaiting_reports:
+                        awaiting_reports.defer(user_id, now)
+                        last_call_users.add(user_id)
+
+        for user_id in awaiting_reports.pop_due(now):
+            user_teams = awaiting_reports.get_teams(user_id)
+            if user_teams is None:
+                # reported meanwhile
+                continue
 
-            for user_id in team_report['reports'].keys():
-                if team_report['reports'][user_id].get('reported_at'):
-                    continue
+            if not askable_teams.intersection(user_teams):
+                next_ask = [
+                    ask_earliest[team] for team in user_teams
+                    if team in ask_earliest
+                ]
+                if next_ask:
+                    awaiting_reports.defer(user_id, min(next_ask))
+                else:
+                    # nothing to ask this user about today
+                    awaiting_reports.reported(user_id)
+                continue
 
-                bot.fast_queue.append(
-                    AskStatus(
-                        teams=teams_by_user[user_id],
-                        user_id=user_id,
-                        last_call=last_call
-                    )
-                )
+            last_call = user_id in last_call_users
+
+            # one ask per user, covering all the teams they are in
+            ask = AskStatus(
+                teams=user_teams,
+                user_id=user_id,
+                last_call=last_call
+            )
+            if bot.pending_asks.add(ask):
+                bot.fast_queue.append(ask)
+
+    def index_awaiting_reports(self, day_report, today):
+        """Indexes users who have not reported yet, all of them due now."""
+        teams_by_user = defaultdict(list)
+        unreported = set()
+        for team, users_data in day_report.items():
+            for user_id, user_report in users_data['reports'].items():
+                teams_by_user[user_id].append(team)
+                if not user_report.get('reported_at'):
+                    unreported.add(user_id)
+
+        awaiting_reports = AwaitingReports(today)
+        for user_id in unreported:
+            awaiting_reports.add(user_id, teams_by_user[user_id])
+
+        return awaiting_reports
+
+
+class ScheduleDeadlines(Task):
+    """Schedules checks of every team exactly at their deadlines for today.
+
+    Runs again right after the next day starts.
+    """
+    priority = LOW
+
+    def execute(self, bot, slack):
+        now = time.time()
+        today = datetime.utcnow().date()
+        bot.latency.rollover(today)
+
+        for team, schedule in bot.get_schedules(today).items():
+            for deadline in schedule.deadlines():
+                if deadline > now:
+                    bot.runtime.call_at(
+                        deadline, bot.fast_queue, CheckReports(teams=[team]))
+
+        tomorrow = today + timedelta(days=1)
+        bot.runtime.call_at(
+            calendar.timegm(tomorrow.timetuple()) + 1,
+            bot.slow_queue,
+            ScheduleDeadlines()
+        )
 
 
 class AskStatus(Task):
     """Asks a single user their status."""
+    cancelled = False
+
     def __init__(self, teams, user_id, last_call):
         self.teams = teams
         self.user_id = user_id
         self.last_call = last_call
 
+    @property
+    def ordering_key(self):
+        return self.user_id
+
+    def overflowed(self, bot):
+        # user is asked by one of the next checks instead, when it is due
+        bot.pending_asks.cancel(self)
+        bot.awaiting_reports.defer(self.user_id, time.time())
+
     def execute(self, bot, slack):
+        # no upgrade to a last call is made after this, it needs a new ask
+        last_call = bot.pending_asks.take(self)
+        if self.cancelled:
+            logging.debug('Ask of {} was cancelled'.format(self.user_id))
+            return
+
         current_lock = bot.get_user_lock(self.user_id)
 
-        skip_user = current_lock and not self.last_call
+        skip_user = current_lock and not last_call
         if skip_user:
             logging.debug(
                 'User {} is already locked for {}, will wait for them to '
                 'respond'.format(self.user_id, current_lock))
+            bot.awaiting_reports.defer(
+                self.user_id, bot.get_user_lock_expiry(self.user_id))
             return
 
         today = datetime.utcnow().date()
-        report = bot.storage.get('report')[today]
+        report = bot.storage.view('report')[today]
         if bot.user_is_online(self.user_id):
-            for team in self.teams:
-                report[team]['reports'][self.user_id]['seen_online'] = True
+            unseen_teams = [
+                team for team in self.teams
+                if not report[team]['reports'][self.user_id].get(
+                    'seen_online')
+            ]
+            if unseen_teams:
+                with bot.storage.transaction(
+                        'report', today, scopes=unseen_teams) as day_report:
+                    for team in unseen_teams:
+                        user_report = day_report[team]['reports'][self.user_id]
+                        user_report['seen_online'] = True
         else:
             logging.debug(
                 'User {} is not online, will try later'.format(self.user_id))
+            bot.awaiting_reports.park(self.user_id)
             return
 
         # lock this user conversation, worst case till the end of day
@@ -379,7 +571,7 @@ class AskStatus(Task):
             phrases=Dictionary.PLEASE_REPORT,
             user_id=self.user_id
         )
-        if self.last_call:
+        if last_call:
             phrase = Dictionary.pick(
                 phrases=Dictionary.PLEASE_REPORT_LAST_CALL,
                 user_id=self.user_id
@@ -394,21 +586,36 @@ class AskStatus(Task):
 
 
 class ReadMessage(Task):
-    """Reads a single message."""
-    def __init__(self, data):
+    """Reads a single message.
+
+    Keeps the time its event was received at, to track report latency.
+    """
+    def __init__(self, data, received_at=None):
         self.data = data
+        self.received_at = received_at
+
+    @property
+    def priority(self):
+        # direct message channel ids start with D, these might be reports
+        if (self.data.get('channel') or '').startswith('D'):
+            return HIGH
+
+        return LOW
+
+    @property
+    def ordering_key(self):
+        # edits carry the author in the message itself
+        message = self.data.get('message', {})
+        return self.data.get('user') or message.get('user')
 
     def is_direct_message(self, bot):
         """Checks if this is a direct message."""
-        return all([
-            self.data.get('type', None) == 'message',
-            'user' in self.data,
-            'subtype' not in self.data,
-            any([
-                im['id'] == self.data['channel']
-                for im in bot.storage.get('ims')
-            ])
-        ])
+        return (
+            self.data.get('type', None) == 'message'
+            and 'user' in self.data
+            and 'subtype' not in self.data
+            and bot.get_im_directory().is_im(self.data.get('channel'))
+        )
 
     def is_bot_message(self):
         """Checks if it is a bot message."""
@@ -436,12 +643,14 @@ class ReadMessage(Task):
         if self.is_direct_message(bot):
             # in direct messages we only expect status messages
             bot.fast_queue.append(
-                ReadStatusMessage(self.data)
+                ReadStatusMessage(self.data, received_at=self.received_at)
             )
 
 
 class ReadMessageEdit(ReadMessage):
     """Reads a message edit."""
+    priority = HIGH
+
     def execute(self, bot, slack):
         new_message = self.data['message']
         previous_message = self.data['previous_message']
@@ -461,15 +670,23 @@ class ReadMessageEdit(ReadMessage):
                 continue
 
             if previous_message['text'] in user_report['report']:
-                msg_idx = user_report['report'].index(previous_message['text'])
-                user_report['report'][msg_idx] = new_message['text']
-                user_report['edited_at'] = datetime.utcnow()
+                with bot.storage.transaction('report', today, scopes=[team]):
+                    msg_idx = user_report['report'].index(
+                        previous_message['text'])
+                    user_report['report'][msg_idx] = new_message['text']
+                    user_report['edited_at'] = datetime.utcnow()
                 logging.info('Applied message edit for {} on {}'.format(
                     user_id, team))
 
 
 class ReadStatusMessage(ReadMessage):
     """Reads a status report from a user."""
+    priority = HIGH
+
+    def record_latency(self, bot, stage):
+        if self.received_at is not None:
+            bot.latency.record(stage, time.time() - self.received_at)
+
     def execute(self, bot, slack):
         user_id = self.data['user']
 
@@ -483,17 +700,26 @@ class ReadStatusMessage(ReadMessage):
             )
             return
 
+        self.record_latency(bot, 'read')
+
         # update status
         today = datetime.utcnow().date()
-        report, is_first_line = bot.storage.get('report'), False
-        for team in teams:
-            user_report = report[today][team]['reports'][user_id]
-            user_report['reported_at'] = datetime.utcnow()
-            is_first_line = len(user_report['report']) == 0
-            user_report['report'].append(self.data['text'])
+        is_first_line = False
+        with bot.storage.transaction(
+                'report', today, scopes=teams) as day_report:
+            for team in teams:
+                user_report = day_report[team]['reports'][user_id]
+                user_report['reported_at'] = datetime.utcnow()
+                is_first_line = len(user_report['report']) == 0
+                if is_first_line and self.received_at is not None:
+                    user_report['received_at'] = datetime.utcfromtimestamp(
+                        self.received_at)
+                user_report['report'].append(self.data['text'])
+        bot.awaiting_reports.reported(user_id)
 
         # give user extra 5 minutes to add more lines in context of this lock
         bot.lock_user(user_id, teams, expire_in=300)
+        on_sent = partial(self.record_latency, bot, 'acknowledged')
         if is_first_line:
             bot.fast_queue.append(
                 SendMessage(
@@ -501,12 +727,17 @@ class ReadStatusMessage(ReadMessage):
                     text=Dictionary.pick(
                         phrases=Dictionary.THANKS,
                         user_id=user_id
-                    )
+                    ),
+                    on_sent=on_sent
                 )
             )
         else:
             bot.fast_queue.append(
-                SendMessage(to=user_id, text="Ok, I'll add that too.")
+                SendMessage(
+                    to=user_id,
+                    text="Ok, I'll add that too.",
+                    on_sent=on_sent
+                )
             )
 
 
@@ -515,7 +746,14 @@ class ProcessPresenceChange(Task):
         self.user_id = user_id
         self.presence = presence
 
+    @property
+    def ordering_key(self):
+        return self.user_id
+
     def execute(self, bot, slack):
         user = bot.get_user_by_id(self.user_id)
         if user is not None:
-            user['presence'] = self.presence
+            user.presence = self.presence
+
+        if self.presence == 'active':
+            bot.awaiting_reports.online(self.user_id, time.time())
@@ -0,0 +1,91 @@
+from __future__ import absolute_import
+
+import unittest
+
+from flexmock import flexmock
+
+from pony.awaiting import AwaitingReports, PendingAsks
+
+
+class AwaitingReportsTest(unittest.TestCase):
+    def setUp(self):
+        self.awaiting = AwaitingReports()
+        self.awaiting.add('_id1', ['t1'])
+        self.awaiting.add('_id2', ['t1', 't2'], due_at=20)
+
+    def test_pop_due(self):
+        self.assertListEqual(self.awaiting.pop_due(10), ['_id1'])
+        self.assertListEqual(self.awaiting.pop_due(10), [])
+        self.assertListEqual(self.awaiting.pop_due(20), ['_id2'])
+
+        # popped users are still awaited
+        self.assertIn('_id1', self.awaiting)
+        self.assertEqual(len(self.awaiting), 2)
+
+    def test_defer(self):
+        self.awaiting.defer('_id1', 30)
+
+        self.assertListEqual(self.awaiting.pop_due(20), ['_id2'])
+        self.assertListEqual(self.awaiting.pop_due(30), ['_id1'])
+
+    def test_defer_unknown_user(self):
+        self.awaiting.defer('_id3', 0)
+        self.assertNotIn('_id3', self.awaiting)
+        self.assertListEqual(self.awaiting.pop_due(10), ['_id1'])
+
+    def test_park_till_online(self):
+        self.awaiting.park('_id1')
+        self.assertListEqual(self.awaiting.pop_due(10), [])
+        self.assertSetEqual(self.awaiting.offline, {'_id1'})
+
+        self.awaiting.online('_id1', 15)
+        self.assertListEqual(self.awaiting.pop_due(15), ['_id1'])
+        self.assertSetEqual(self.awaiting.offline, set())
+
+    def test_online_user_not_parked(self):
+        self.awaiting.online('_id2', 5)
+        self.assertListEqual(self.awaiting.pop_due(10), ['_id1'])
+
+    def test_reported(self):
+        self.awaiting.reported('_id2')
+
+        self.assertNotIn('_id2', self.awaiting)
+        self.assertListEqual(self.awaiting.pop_due(20), ['_id1'])
+
+
+class PendingAsksTest(unittest.TestCase):
+    def setUp(self):
+        self.pending_asks = PendingAsks()
+        self.ask = flexmock(user_id='_id1', last_call=False)
+
+    def test_add(self):
+        self.assertTrue(self.pending_asks.add(self.ask))
+        self.assertFalse(
+            self.pending_asks.add(flexmock(user_id='_id1', last_call=False)))
+
+        self.assertIn('_id1', self.pending_asks)
+        self.assertIs(self.pending_asks.get('_id1'), self.ask)
+        self.assertFalse(self.ask.last_call)
+
+    def test_add_upgrades_pending_ask(self):
+        self.pending_asks.add(self.ask)
+        self.pending_asks.add(flexmock(user_id='_id1', last_call=True))
+
+        self.assertTrue(self.pending_asks.take(self.ask))
+        self.assertNotIn('_id1', self.pending_asks)
+
+    def test_take_leaves_newer_ask(self):
+        self.pending_asks.add(self.ask)
+        self.pending_asks.take(self.ask)
+
+        ask = flexmock(user_id='_id1', last_call=True)
+        self.assertTrue(self.pending_asks.add(ask))
+        self.pending_asks.take(self.ask)
+        self.assertIs(self.pending_asks.get('_id1'), ask)
+
+    def test_cancel(self):
+        self.pending_asks.add(self.ask)
+        self.pending_asks.cancel(self.ask)
+
+        self.assertTrue(self.ask.cancelled)
+        self.assertNotIn('_id1', self.pending_asks)
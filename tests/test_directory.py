@@ -0,0 +1,95 @@
+from __future__ import absolute_import
+
+import pickle
+import unittest
+
+from pony.directory import User, UserDirectory, IMDirectory
+
+
+class UserDirectoryTest(unittest.TestCase):
+    def setUp(self):
+        self.users = [
+            User('_id1', 'user1'),
+            User('_id2', 'user2'),
+            User('_id3'),
+        ]
+        self.directory = UserDirectory(self.users)
+
+    def test_get_by_id(self):
+        self.assertIs(self.directory.get_by_id('_id2'), self.users[1])
+        self.assertIs(self.directory.get_by_id('_id3'), self.users[2])
+        self.assertIsNone(self.directory.get_by_id('_id4'))
+
+    def test_get_by_name(self):
+        self.assertIs(self.directory.get_by_name('user1'), self.users[0])
+        self.assertIsNone(self.directory.get_by_name('user3'))
+
+    def test_plain_dictionaries(self):
+        directory = UserDirectory([{'id': '_id1', 'name': 'user1'}])
+        self.assertEqual(directory.get_by_name('user1'), User('_id1', 'user1'))
+
+    def test_empty(self):
+        directory = UserDirectory(None)
+        self.assertIsNone(directory.get_by_id('_id1'))
+        self.assertIsNone(directory.get_by_name('user1'))
+
+
+class UserTest(unittest.TestCase):
+    def test_from_slack(self):
+        user = User.from_slack({
+            'id': '_id1',
+            'name': 'user1',
+            'deleted': False,
+            'color': 'aabbcc',
+            'presence': 'away',
+            'profile': {
+                'real_name': 'User One',
+                'image_24': '_image_24_url',
+                'image_192': '_image_192_url',
+            }
+        })
+
+        self.assertEqual(user.id, '_id1')
+        self.assertEqual(user.name, 'user1')
+        self.assertEqual(user.real_name, 'User One')
+        self.assertEqual(user.image_192, '_image_192_url')
+        self.assertEqual(user.color, 'aabbcc')
+        self.assertEqual(user.presence, 'away')
+
+    def test_pickle(self):
+        user = User('_id1', 'user1', presence='active')
+        self.assertEqual(pickle.loads(pickle.dumps(user)), user)
+        self.assertEqual(
+            pickle.loads(pickle.dumps(user, pickle.HIGHEST_PROTOCOL)), user)
+
+    def test_equality(self):
+        self.assertEqual(User('_id1', 'user1'), User('_id1', 'user1'))
+        self.assertNotEqual(
+            User('_id1', 'user1'), User('_id1', 'user1', presence='active'))
+
+
+class IMDirectoryTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = IMDirectory([
+            {'id': '_im1', 'user': '_id1'},
+            {'id': '_im2', 'user': '_id2'},
+        ])
+
+    def test_is_im(self):
+        self.assertTrue(self.directory.is_im('_im1'))
+        self.assertFalse(self.directory.is_im('_channel'))
+
+    def test_get_channel(self):
+        self.assertEqual(self.directory.get_channel('_id2'), '_im2')
+        self.assertIsNone(self.directory.get_channel('_id3'))
+
+    def test_empty(self):
+        directory = IMDirectory(None)
+        self.assertFalse(directory.is_im('_im1'))
+        self.assertIsNone(directory.get_channel('_id1'))
+
+    def test_add(self):
+        self.directory.add({'id': '_im3', 'user': '_id3'})
+
+        self.assertTrue(self.directory.is_im('_im3'))
+        self.assertEqual(self.directory.get_channel('_id3'), '_im3')
@@ -0,0 +1,265 @@
+from __future__ import absolute_import
+
+import time
+import threading
+import unittest
+from datetime import timedelta
+
+import freezegun
+from flexmock import flexmock
+
+from pony.dispatcher import Dispatcher, TokenBucket
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_take(self):
+        bucket = TokenBucket(rate=60, burst=2)
+        now = bucket.updated_at
+
+        self.assertEqual(bucket.take(now), 0)
+        self.assertEqual(bucket.take(now), 0)
+        self.assertAlmostEqual(bucket.take(now), 1.0)
+
+        # a token per second
+        self.assertEqual(bucket.take(now + 1), 0)
+        self.assertAlmostEqual(bucket.take(now + 1.5), 0.5)
+
+    def test_pause(self):
+        bucket = TokenBucket(rate=60, burst=2)
+        now = bucket.updated_at
+
+        bucket.pause(now, 30)
+        self.assertAlmostEqual(bucket.take(now + 10), 20)
+        self.assertEqual(bucket.take(now + 31), 0)
+
+
+class DispatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.dispatcher = Dispatcher(workers=2)
+        self.calls = []
+
+    def test_run_pending_in_due_order(self):
+        self.dispatcher.call_later(2, self.calls.append, 'second')
+        self.dispatcher.call_later(1, self.calls.append, 'first')
+        self.dispatcher.call_later(2, self.calls.append, 'third')
+
+        self.dispatcher.run_pending()
+        self.assertListEqual(self.calls, ['first', 'second', 'third'])
+
+    def test_run_pending_is_failsafe(self):
+        self.dispatcher.call_later(0, lambda: 1 / 0)
+        self.dispatcher.call_later(0, self.calls.append, 'next')
+
+        self.dispatcher.run_pending()
+        self.assertListEqual(self.calls, ['next'])
+
+    def test_workers(self):
+        done = threading.Event()
+        self.dispatcher.workers = 1
+        self.dispatcher.start()
+        self.dispatcher.call_later(0.01, self.calls.append, 'called')
+        self.dispatcher.call_later(0.02, done.set)
+
+        self.assertTrue(done.wait(5))
+        self.assertListEqual(self.calls, ['called'])
+
+    def test_api_call(self):
+        slack = flexmock()
+        (slack
+         .should_receive('api_call')
+         .with_args('chat.postMessage', channel='_to', text='_text')
+         .and_return(dict(ok=True))
+         .once())
+
+        self.dispatcher.api_call(
+            slack, 'chat.postMessage', channel='_to', text='_text')
+        self.dispatcher.run_pending()
+        self.assertEqual(self.dispatcher.pending(), 0)
+
+    def test_api_call_callback(self):
+        slack = flexmock()
+        (slack
+         .should_receive('api_call')
+         .with_args('chat.postMessage', channel='_to')
+         .and_return(dict(ok=True))
+         .and_return(dict(ok=False, error='channel_not_found')))
+
+        for _ in range(2):
+            self.dispatcher.api_call(
+                slack, 'chat.postMessage',
+                callback=lambda: self.calls.append('sent'), channel='_to')
+            self.dispatcher.run_pending()
+
+        self.assertListEqual(self.calls, ['sent'])
+
+    def test_api_call_records_latency(self):
+        self.dispatcher.metrics = flexmock()
+        slack = flexmock()
+        slack.should_receive('api_call').and_return(dict(ok=True))
+
+        (self.dispatcher.metrics
+         .should_receive('observe')
+         .with_args('pony_slack_api_seconds', float, method='users.info')
+         .once())
+
+        self.dispatcher.api_call(slack, 'users.info', user='_id1')
+        self.dispatcher.run_pending()
+
+    def test_call(self):
+        slack = flexmock()
+        (slack
+         .should_receive('api_call')
+         .with_args('users.info', user='_id1')
+         .and_return(dict(ok=True))
+         .times(11))
+
+        with freezegun.freeze_time('2017-01-02 10:00') as frozen:
+            (flexmock(time)
+             .should_receive('sleep')
+             .with_args(float)
+             .replace_with(lambda seconds: frozen.tick(timedelta(seconds=1)))
+             .once())
+
+            # burst of ten, the eleventh call waits for a token
+            for x in range(11):
+                self.assertDictEqual(
+                    self.dispatcher.call(slack, 'users.info', user='_id1'),
+                    dict(ok=True))
+        self.assertAlmostEqual(
+            self.dispatcher.stats()['throttled_seconds'], 0.6, places=3)
+
+    def test_call_retries_rate_limited(self):
+        slack = flexmock()
+        responses = [
+            dict(ok=False, error='ratelimited', headers={'Retry-After': '30'}),
+            dict(ok=True),
+        ]
+        (slack
+         .should_receive('api_call')
+         .with_args('users.list', presence=1)
+         .replace_with(lambda method, **kwargs: responses.pop(0))
+         .twice())
+
+        with freezegun.freeze_time('2017-01-02 10:00') as frozen:
+            (flexmock(time)
+             .should_receive('sleep')
+             .with_args(30.0)
+             .replace_with(lambda seconds: frozen.tick(
+                 timedelta(seconds=seconds)))
+             .once())
+
+            self.assertDictEqual(
+                self.dispatcher.call(slack, 'users.list', presence=1),
+                dict(ok=True))
+
+        stats = self.dispatcher.stats()
+        self.assertEqual(stats['rate_limited'], 1)
+        self.assertEqual(stats['retried'], 1)
+
+    def test_call_gives_up_rate_limited(self):
+        self.dispatcher.max_retries = 1
+        slack = flexmock()
+        (slack
+         .should_receive('api_call')
+         .and_return(dict(ok=False, error='ratelimited'))
+         .twice())
+
+        with freezegun.freeze_time('2017-01-02 10:00') as frozen:
+            (flexmock(time)
+             .should_receive('sleep')
+             .replace_with(lambda seconds: frozen.tick(
+                 timedelta(seconds=seconds))))
+
+            self.assertEqual(
+                self.dispatcher.call(slack, 'im.list')['error'],
+                'ratelimited')
+
+        stats = self.dispatcher.stats()
+        self.assertEqual(stats['rate_limited'], 2)
+        self.assertEqual(stats['dropped'], 1)
+
+    def test_api_call_is_throttled(self):
+        slack = flexmock()
+        (slack
+         .should_receive('api_call')
+         .and_return(dict(ok=True))
+         .times(4))
+
+        for x in range(4):
+            self.dispatcher.api_call(slack, 'chat.postMessage', channel='_to')
+        self.dispatcher.api_call(slack, 'chat.postMessage', channel='_other')
+
+        # burst of three messages per channel, the rest waits for a token,
+        # messages to a channel go one after another
+        for x in range(4):
+            self.dispatcher.run_pending()
+        self.assertEqual(self.dispatcher.pending(), 1)
+        self.assertGreater(self.dispatcher.stats()['throttled_seconds'], 0)
+
+    def test_api_call_retries_after_rate_limit(self):
+        slack = flexmock()
+        (slack
+         .should_receive('api_call')
+         .and_return(dict(
+            ok=False, error='ratelimited', headers={'Retry-After': '30'}))
+         .once())
+
+        self.dispatcher.api_call(slack, 'users.info', user='_id1')
+        self.dispatcher.run_pending()
+
+        self.assertEqual(self.dispatcher.pending(), 1)
+        self.assertGreater(self.dispatcher._calls[0][0], time.time() + 29)
+        self.assertEqual(self.dispatcher.stats()['rate_limited'], 1)
+        self.assertEqual(self.dispatcher.stats()['retried'], 1)
+
+    def test_api_call_keeps_channel_order(self):
+        slack, sent = flexmock(), []
+        responses = [
+            dict(ok=False, error='ratelimited', headers={'Retry-After': '30'}),
+            dict(ok=True),
+            dict(ok=True),
+        ]
+
+        def api_call(method, channel, text):
+            sent.append(text)
+            return responses.pop(0)
+
+        slack.should_receive('api_call').replace_with(api_call)
+
+        with freezegun.freeze_time('2017-01-02 10:00') as frozen:
+            for text in ('first', 'second'):
+                self.dispatcher.api_call(
+                    slack, 'chat.postMessage', channel='_to', text=text)
+
+            # second message waits for the first one, even though it has
+            # a token to go
+            self.dispatcher.run_pending()
+            self.assertListEqual(sent, ['first'])
+            self.assertEqual(self.dispatcher.pending(), 2)
+
+            frozen.tick(timedelta(seconds=31))
+            self.dispatcher.run_pending()
+            self.dispatcher.run_pending()
+
+        self.assertListEqual(sent, ['first', 'first', 'second'])
+        self.assertEqual(self.dispatcher.pending(), 0)
+
+    def test_api_call_gives_up(self):
+        self.dispatcher.max_retries = 0
+        slack = flexmock()
+        (slack
+         .should_receive('api_call')
+         .and_return(dict(ok=False, error='ratelimited'))
+         .once())
+
+        self.dispatcher.api_call(slack, 'users.info', user='_id1')
+        self.dispatcher.run_pending()
+
+        self.assertEqual(self.dispatcher.pending(), 0)
+        self.assertEqual(self.dispatcher.stats()['dropped'], 1)
+
+    def test_get_retry_after(self):
+        self.assertEqual(
+            Dispatcher.get_retry_after({'headers': {'retry-after': '5'}}, 0),
+            5)
+        self.assertEqual(Dispatcher.get_retry_after({}, 3), 8)
@@ -1,21 +1,20 @@
 from __future__ import absolute_import
 
-import collections
 import unittest
 from flexmock import flexmock
 
 from pony.jobs import WorldTick
+from pony.runtime import TaskQueue
 
 
 class WorldTickTest(unittest.TestCase):
     def setUp(self):
-        queue = collections.deque()
+        queue = TaskQueue()
         self.fake_bot = flexmock()
-        self.job = WorldTick(self.fake_bot, queue, interval=5)
+        self.job = WorldTick(self.fake_bot, queue)
 
     def test_init(self):
-        self.assertEqual(self.job.interval, 5)
-        self.assertIsInstance(self.job.queue, collections.deque)
+        self.assertIsInstance(self.job.queue, TaskQueue)
         self.assertIsNotNone(self.job.bot)
 
     def test_run(self):
@@ -28,5 +27,90 @@ class WorldTickTest(unittest.TestCase):
          .once())
 
         self.job.queue.append(fake_task)
-        self.assertListEqual(self.job.run(fake_slack), list())
+        self.assertEqual(self.job.run(fake_slack), 1)
         self.assertEqual(len(self.job.queue), 0)
+
+    def test_run_skips_tasks_not_due(self):
+        fake_task = flexmock()
+        fake_task.should_receive('execute').never()
+
+        self.job.queue.append(fake_task, delay=60)
+        self.assertEqual(self.job.run(flexmock()), 0)
+        self.assertEqual(len(self.job.queue), 1)
+
+    def test_run_survives_failing_task(self):
+        failing_task = flexmock()
+        failing_task.should_receive('execute').and_raise(ValueError).once()
+        fake_task = flexmock()
+        fake_task.should_receive('execute').once()
+
+        self.job.queue.append(failing_task)
+        self.job.queue.append(fake_task)
+        self.assertEqual(self.job.run(flexmock()), 2)
+        self.assertEqual(len(self.job.queue), 0)
+
+    def test_run_submits_keyed_tasks_to_executor(self):
+        self.job.executor = flexmock(saturated=lambda: False)
+        keyed_task = flexmock(ordering_key='_id1')
+        fake_task = flexmock()
+        fake_task.should_receive('execute').once()
+        fake_slack = flexmock()
+
+        (self.job.executor
+         .should_receive('submit')
+         .with_args('_id1', self.job.execute, keyed_task, fake_slack)
+         .once())
+
+        self.job.queue.append(keyed_task)
+        self.job.queue.append(fake_task)
+        self.assertEqual(self.job.run(fake_slack), 2)
+
+    def test_run_leaves_tasks_queued_while_executor_saturated(self):
+        saturated = []
+        self.job.executor = flexmock(saturated=lambda: bool(saturated))
+        first, second = flexmock(ordering_key='_id1'), flexmock()
+        second.should_receive('execute').never()
+
+        (self.job.executor
+         .should_receive('submit')
+         .replace_with(lambda *args: saturated.append(args))
+         .once())
+
+        self.job.queue.append(first)
+        self.job.queue.append(second)
+        self.assertEqual(self.job.ready(), 2)
+        self.assertEqual(self.job.run(flexmock()), 1)
+        self.assertListEqual(list(self.job.queue), [second])
+        self.assertEqual(self.job.ready(), 0)
+        self.assertIsNone(self.job.next_due())
+
+    def test_run_records_metrics(self):
+        self.job.metrics = flexmock()
+        fake_task = flexmock()
+        fake_task.should_receive('execute').once()
+        self.job.queue.name = 'fast'
+
+        (self.job.metrics
+         .should_receive('observe')
+         .with_args('pony_task_seconds', float, task='MockClass')
+         .once())
+        (self.job.metrics
+         .should_receive('observe')
+         .with_args('pony_tick_seconds', float, queue='fast')
+         .once())
+
+        self.job.queue.append(fake_task)
+        self.job.run(flexmock())
+
+    def test_run_profiles_tick_and_tasks(self):
+        fake_task = flexmock()
+        fake_task.should_receive('execute').once()
+        self.job.queue.name = 'fast'
+        self.job.profiler.start()
+        try:
+            self.job.queue.append(fake_task)
+            self.job.run(flexmock())
+
+            self.assertListEqual(self.job.profiler._stats.keys(), ['MockClass'])
+        finally:
+            self.job.profiler.active = False
@@ -0,0 +1,174 @@
+from __future__ import absolute_import
+
+import os
+import logging
+import shutil
+import tempfile
+import unittest
+import urllib2
+
+import freezegun
+
+from datetime import date
+
+from flexmock import flexmock
+
+from pony.metrics import (
+    Histogram, Metrics, LatencyTracker, format_labels, percentile)
+
+
+class HistogramTest(unittest.TestCase):
+    def test_observe(self):
+        histogram = Histogram(buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 5):
+            histogram.observe(value)
+
+        self.assertListEqual(histogram.counts, [2, 1, 1])
+        self.assertEqual(histogram.count, 4)
+        self.assertAlmostEqual(histogram.sum, 5.65)
+
+    def test_render(self):
+        histogram = Histogram(buckets=(0.1, 1.0))
+        histogram.observe(0.5)
+
+        self.assertListEqual(
+            histogram.render('pony_x', (('task', 'A'), )),
+            [
+                'pony_x_bucket{task="A",le="0.1"} 0',
+                'pony_x_bucket{task="A",le="1.0"} 1',
+                'pony_x_bucket{task="A",le="+Inf"} 1',
+                'pony_x_sum{task="A"} 0.5',
+                'pony_x_count{task="A"} 1',
+            ]
+        )
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics()
+
+    def test_format_labels(self):
+        self.assertEqual(format_labels(()), '')
+        self.assertEqual(
+            format_labels((('a', 'x"y'), ('b', 1))), '{a="x\\"y",b="1"}')
+
+    def test_timed(self):
+        with freezegun.freeze_time('2016-12-23 11:00:00') as frozen_time:
+            with self.metrics.timed('pony_task_seconds', task='A'):
+                frozen_time.tick()
+
+        rendered = self.metrics.render()
+        self.assertIn('pony_task_seconds_sum{task="A"} 1.0', rendered)
+        self.assertIn('pony_task_seconds_count{task="A"} 1', rendered)
+
+    def test_render(self):
+        self.metrics.describe('pony_task_seconds', 'Task time')
+        self.metrics.observe('pony_task_seconds', 0.2, task='A')
+        self.metrics.observe('pony_task_seconds', 0.2, task='B')
+        self.metrics.add_gauge(
+            'pony_queue_depth', lambda: [({'queue': 'fast'}, 3)], 'Depth')
+
+        lines = self.metrics.render().splitlines()
+        self.assertEqual(lines[0], '# HELP pony_task_seconds Task time')
+        self.assertEqual(lines[1], '# TYPE pony_task_seconds histogram')
+        self.assertIn('pony_task_seconds_count{task="B"} 1', lines)
+        self.assertListEqual(lines[-3:], [
+            '# HELP pony_queue_depth Depth',
+            '# TYPE pony_queue_depth gauge',
+            'pony_queue_depth{queue="fast"} 3',
+        ])
+
+    def test_render_counter(self):
+        self.metrics.add_counter(
+            'pony_tasks_total', lambda: [({'outcome': 'dropped'}, 2)])
+
+        self.assertListEqual(self.metrics.render().splitlines(), [
+            '# TYPE pony_tasks_total counter',
+            'pony_tasks_total{outcome="dropped"} 2',
+        ])
+
+    def test_render_skips_failing_gauge(self):
+        self.metrics.add_gauge('pony_broken', lambda: 1 / 0)
+        self.assertEqual(self.metrics.render(), '\n')
+
+    def test_write(self):
+        directory = tempfile.mkdtemp()
+        try:
+            file_name = os.path.join(directory, 'pony.prom')
+            self.metrics.observe('pony_task_seconds', 0.2, task='A')
+            self.metrics.write(file_name)
+
+            with open(file_name) as f:
+                self.assertEqual(f.read(), self.metrics.render())
+            self.assertListEqual(os.listdir(directory), ['pony.prom'])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_serve(self):
+        self.metrics.observe('pony_task_seconds', 0.2, task='A')
+        server = self.metrics.serve(0)
+        try:
+            response = urllib2.urlopen(
+                'http://127.0.0.1:{}/metrics'.format(server.server_port))
+            self.assertEqual(response.read(), self.metrics.render())
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class LatencyTrackerTest(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics()
+        self.latency = LatencyTracker(self.metrics)
+
+    def test_percentile(self):
+        samples = range(1, 101)
+        self.assertEqual(percentile(samples, 0.5), 50)
+        self.assertEqual(percentile(samples, 0.99), 99)
+        self.assertEqual(percentile([7], 0.9), 7)
+
+    def test_record(self):
+        for seconds in (1, 2, 3, 4):
+            self.latency.record('read', seconds)
+
+        self.assertDictEqual(self.latency.percentiles(), {
+            'read': ({0.5: 2, 0.9: 4, 0.99: 4}, 4)
+        })
+        output = self.metrics.render()
+        self.assertIn(
+            'pony_report_stage_seconds_count{stage="read"} 4', output)
+        self.assertIn(
+            'pony_report_latency_seconds{quantile="0.5",stage="read"} 2',
+            output)
+
+    def test_record_in_stage_buckets(self):
+        self.latency.record('summary', 600)
+
+        self.assertIn(
+            'pony_report_stage_seconds_bucket{stage="summary",le="900.0"} 1',
+            self.metrics.render())
+
+    def test_record_keeps_max_samples(self):
+        self.latency.max_samples = 10
+        for seconds in range(100):
+            self.latency.record('read', seconds)
+
+        self.assertEqual(len(self.latency._samples['read']), 10)
+        self.assertEqual(self.latency.percentiles()['read'][1], 100)
+
+    @freezegun.freeze_time('2017-01-02 00:00:01')
+    def test_rollover(self):
+        self.latency.record('summary', 30)
+        self.assertEqual(self.latency.day, date(2017, 1, 2))
+
+        (flexmock(logging)
+         .should_receive('info')
+         .with_args(
+            'Report latency for 2017-01-02: '
+            'summary p50=30.00s p90=30.00s p99=30.00s (n=1)')
+         .once())
+
+        self.latency.rollover(date(2017, 1, 2))
+        self.latency.rollover(date(2017, 1, 3))
+        self.assertEqual(self.latency.day, date(2017, 1, 3))
+        self.assertDictEqual(self.latency.percentiles(), {})
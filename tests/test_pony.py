@@ -1,6 +1,9 @@
 from __future__ import absolute_import
 
+from flexmock import flexmock
+
 import pony.tasks
+from pony.directory import User, IMDirectory
 from tests.test_base import BaseTest
 
 
@@ -8,22 +11,22 @@ class PonyTest(BaseTest):
     def setUp(self):
         super(PonyTest, self).setUp()
         self.bot.storage.set('users', [
-            {'id': '_id1', 'name': 'user1', 'presence': 'active'}
+            User('_id1', 'user1', presence='active')
         ])
 
     def test_get_user_by_id(self):
-        self.assertDictEqual(
+        self.assertEqual(
             self.bot.get_user_by_id('_id1'),
-            {'id': '_id1', 'name': 'user1', 'presence': 'active'}
+            User('_id1', 'user1', presence='active')
         )
 
     def test_get_user_by_id_no_such_user(self):
         self.assertIsNone(self.bot.get_user_by_id('_id2'))
 
     def test_get_user_by_name(self):
-        self.assertDictEqual(
+        self.assertEqual(
             self.bot.get_user_by_name('user1'),
-            {'id': '_id1', 'name': 'user1', 'presence': 'active'}
+            User('_id1', 'user1', presence='active')
         )
 
     def test_get_user_by_name_no_such_user(self):
@@ -37,6 +40,77 @@ class PonyTest(BaseTest):
 
     def test_user_is_online_user_away(self):
         self.bot.storage.set('users', [
-            {'id': '_id1', 'name': 'user1', 'presence': 'away'}
+            User('_id1', 'user1', presence='away')
         ])
         self.assertFalse(self.bot.user_is_online('_id1'))
+
+    def test_user_directory_follows_user_list_updates(self):
+        directory = self.bot.get_user_directory()
+        self.assertIs(self.bot.get_user_directory(), directory)
+
+        self.bot.storage.set('users', [
+            User('_id2', 'user2', presence='active')
+        ])
+        self.assertIsNot(self.bot.get_user_directory(), directory)
+        self.assertIsNone(self.bot.get_user_by_id('_id1'))
+        self.assertEqual(self.bot.get_user_by_name('@user2').id, '_id2')
+
+    def test_process_im_created_burst_queues_single_update(self):
+        for x in range(10):
+            self.bot.process_im_created({'type': 'im_created'})
+
+        self.assertEqual(len(self.bot.fast_queue), 1)
+        self.assertIsInstance(
+            self.bot.fast_queue.pop(), pony.tasks.UpdateIMList)
+
+    def test_process_message_skips_irrelevant_events(self):
+        self.bot.im_directory = IMDirectory([{'id': 'D0001', 'user': '_id1'}])
+
+        self.bot.process_message({'channel': 'C0001', 'user': '_id1'})
+        self.bot.process_message({'channel': 'D0001', 'bot_id': 'B0001'})
+        self.bot.process_message(
+            {'channel': 'D0001', 'subtype': 'channel_join'})
+        self.bot.process_message({})
+
+        self.assertEqual(len(self.bot.fast_queue), 0)
+
+    def test_process_message_queues_direct_messages_and_edits(self):
+        self.bot.im_directory = IMDirectory([{'id': 'D0001', 'user': '_id1'}])
+        # events are filtered without waiting for the storage lock
+        flexmock(self.bot.storage).should_receive('get').never()
+
+        self.bot.process_message({'channel': 'D0001', 'user': '_id1'})
+        self.bot.process_message(
+            {'channel': 'D0001', 'subtype': 'message_changed'})
+
+        self.assertEqual(len(self.bot.fast_queue), 2)
+        self.assertIsInstance(
+            self.bot.fast_queue.pop(), pony.tasks.ReadMessage)
+
+    def test_process_im_created_registers_channel(self):
+        self.bot.im_directory = IMDirectory([])
+        self.bot.process_im_created({
+            'type': 'im_created',
+            'channel': {'id': 'D0002', 'user': '_id1'}
+        })
+
+        self.bot.process_message({'channel': 'D0002', 'user': '_id1'})
+        self.assertIsInstance(
+            self.bot.fast_queue.pop(), pony.tasks.ReadMessage)
+
+    def test_metrics_report_queues(self):
+        rendered = self.bot.metrics.render()
+
+        self.assertIn(
+            'pony_queue_depth{{queue="slow"}} {}'.format(
+                len(self.bot.slow_queue)),
+            rendered)
+        self.assertIn('pony_queue_depth{queue="fast"} 0', rendered)
+        self.assertIn('# TYPE pony_queue_tasks_total counter', rendered)
+        self.assertIn(
+            'pony_queue_tasks_total{outcome="dropped",queue="fast"} 0',
+            rendered)
+        self.assertIn('pony_dispatcher_pending 0', rendered)
+        self.assertIn(
+            'pony_dispatcher_calls_total{outcome="retried"} 0', rendered)
+        self.assertIn('pony_dispatcher_throttled_seconds_total 0', rendered)
@@ -0,0 +1,95 @@
+from __future__ import absolute_import
+
+import os
+import time
+import pstats
+import shutil
+import tempfile
+import unittest
+
+from pony.profiling import Profiler
+
+
+def busy(seconds):
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        pass
+
+
+class ProfilerTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.profiler = Profiler(
+            directory=self.directory, window=60, interval=0.001)
+
+    def tearDown(self):
+        self.profiler.stop()
+        shutil.rmtree(self.directory)
+
+    def test_profile_inactive(self):
+        with self.profiler.profile('CheckReports'):
+            pass
+
+        self.assertFalse(self.profiler.active)
+        self.assertDictEqual(self.profiler._stats, {})
+        self.assertListEqual(os.listdir(self.directory), [])
+
+    def test_profile_writes_stats_and_stacks(self):
+        self.profiler.start()
+        with self.profiler.profile('tick:fast', cprofile=False):
+            with self.profiler.profile('CheckReports'):
+                busy(0.05)
+            with self.profiler.profile('CheckReports'):
+                busy(0.01)
+
+        directory = self.profiler.stop()
+        self.assertFalse(self.profiler.active)
+        self.assertItemsEqual(
+            os.listdir(directory), ['CheckReports.prof', 'stacks.folded'])
+
+        stats = pstats.Stats(os.path.join(directory, 'CheckReports.prof'))
+        self.assertIn(
+            'busy', [function for (f, l, function) in stats.stats])
+
+        with open(os.path.join(directory, 'stacks.folded')) as f:
+            stacks = f.read().splitlines()
+        self.assertTrue(stacks)
+        for stack in stacks:
+            self.assertTrue(stack.startswith('tick:fast;'))
+        self.assertTrue(any(
+            stack.startswith('tick:fast;CheckReports;')
+            and 'busy (test_profiling.py:' in stack
+            for stack in stacks
+        ))
+
+    def test_nested_profiles_share_outer_cprofile(self):
+        self.profiler.start()
+        with self.profiler.profile('SendReportSummary'):
+            with self.profiler.profile('UpdateUserList'):
+                busy(0.01)
+
+        self.assertListEqual(
+            self.profiler._stats.keys(), ['SendReportSummary'])
+
+    def test_profile_stopped_meanwhile_raises(self):
+        self.profiler.start()
+        with self.assertRaises(ValueError):
+            with self.profiler.profile('CheckReports'):
+                self.profiler.stop()
+                raise ValueError('task failed')
+
+        self.assertDictEqual(self.profiler._stats, {})
+
+    def test_window_stops_profiling(self):
+        self.profiler.start(window=0.01)
+        self.profiler._sampler.join(5)
+
+        self.assertFalse(self.profiler.active)
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+
+    def test_toggle(self):
+        self.profiler.toggle()
+        self.assertTrue(self.profiler.active)
+
+        self.profiler.toggle()
+        self.assertFalse(self.profiler.active)
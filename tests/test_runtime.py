@@ -0,0 +1,433 @@
+from __future__ import absolute_import
+
+import time
+import select
+import logging
+import unittest
+import threading
+from flexmock import flexmock
+from freezegun import freeze_time
+
+from pony.jobs import WorldTick
+from pony.runtime import (
+    Condition, TaskQueue, Runtime, KeyedExecutor, HIGH, NORMAL, LOW)
+
+
+class TaskQueueTest(unittest.TestCase):
+    def test_append_notifies_condition(self):
+        condition = threading.Condition()
+        queue = TaskQueue(condition=condition)
+        flexmock(condition).should_receive('notify').once()
+
+        queue.append('task')
+
+    @freeze_time('2016-01-01 10:00:00')
+    def test_ready_honours_delay(self):
+        queue = TaskQueue(delay=60)
+        queue.append('first', delay=0)
+        queue.append('second')
+
+        self.assertEqual(queue.ready(), 1)
+        self.assertEqual(queue.next_due(), 1451642400.0)
+
+        with freeze_time('2016-01-01 10:01:00'):
+            self.assertEqual(queue.ready(), 2)
+
+    def test_ready_in_order_of_being_due(self):
+        queue = TaskQueue(delay=60)
+        queue.append('late')
+        queue.append('early', delay=0)
+
+        self.assertEqual(queue.ready(), 1)
+        self.assertEqual(queue.popleft(), 'early')
+        self.assertEqual(queue.ready(), 0)
+
+    def test_pop(self):
+        queue = TaskQueue()
+        queue.append('first')
+        queue.append('second')
+
+        self.assertListEqual(list(queue), ['first', 'second'])
+        self.assertEqual(queue.pop(), 'second')
+        self.assertEqual(queue.popleft(), 'first')
+        self.assertEqual(len(queue), 0)
+        self.assertIsNone(queue.next_due())
+
+
+class ConditionTest(unittest.TestCase):
+    def setUp(self):
+        self.condition = Condition()
+
+    def test_wait_times_out(self):
+        # a single sleep, rather than polling till the timeout passes
+        (flexmock(select)
+         .should_call('select')
+         .with_args(list, [], [], 0.01)
+         .once())
+
+        with self.condition:
+            started_at = time.time()
+            self.condition.wait(0.01)
+
+        self.assertGreaterEqual(time.time() - started_at, 0.01)
+
+    def test_notify_wakes_up_waiting_thread(self):
+        waiting, woken = threading.Event(), threading.Event()
+
+        def wait():
+            with self.condition:
+                waiting.set()
+                self.condition.wait()
+            woken.set()
+
+        thread = threading.Thread(target=wait)
+        thread.start()
+        self.assertTrue(waiting.wait(5))
+        with self.condition:
+            self.condition.notify()
+
+        self.assertTrue(woken.wait(5))
+        thread.join()
+
+    def test_notify_without_waiting_threads(self):
+        with self.condition:
+            self.condition.notify()
+            self.condition.wait(0)
+            self.condition.notify()
+
+
+class RuntimeTest(unittest.TestCase):
+    def setUp(self):
+        self.runtime = Runtime()
+        self.queue = TaskQueue(condition=self.runtime.condition)
+        self.job = WorldTick(flexmock(), self.queue)
+        self.runtime.add_job(self.job)
+
+    def test_wait_for_jobs_returns_due_jobs(self):
+        self.queue.append(flexmock())
+        flexmock(self.runtime.condition).should_receive('wait').never()
+
+        self.assertListEqual(self.runtime.wait_for_jobs(), [self.job])
+
+    @freeze_time('2016-01-01 10:00:00')
+    def test_wait_for_jobs_sleeps_till_next_due(self):
+        self.queue.append(flexmock(), delay=30)
+
+        def wait(timeout):
+            self.assertEqual(timeout, 30)
+            self.queue.append(flexmock(), delay=0)
+
+        flexmock(self.runtime.condition).should_receive('wait').replace_with(
+            wait).once()
+
+        self.assertListEqual(self.runtime.wait_for_jobs(), [self.job])
+
+    def test_wait_for_jobs_sleeps_without_timeout_when_idle(self):
+        def wait(timeout):
+            self.assertIsNone(timeout)
+            self.queue.append(flexmock())
+
+        flexmock(self.runtime.condition).should_receive('wait').replace_with(
+            wait).once()
+
+        self.assertListEqual(self.runtime.wait_for_jobs(), [self.job])
+
+    def test_runs_appended_task(self):
+        done = threading.Event()
+        task = flexmock()
+        task.should_receive('execute').replace_with(
+            lambda bot, slack: done.set())
+
+        self.runtime.start(flexmock())
+        self.queue.append(task)
+
+        self.assertTrue(done.wait(5))
+
+    def test_run_survives_failing_job(self):
+        (flexmock(self.job)
+         .should_receive('run')
+         .and_raise(ValueError)
+         .and_return(None))
+        (flexmock(self.runtime)
+         .should_receive('wait_for_jobs')
+         .and_return([self.job])
+         .and_return([self.job])
+         .and_raise(SystemExit))
+        (flexmock(logging)
+         .should_receive('exception')
+         .with_args('Problem in job run')
+         .once())
+
+        # second run goes on after the first one failed
+        with self.assertRaises(SystemExit):
+            self.runtime.run(flexmock())
+
+    @freeze_time('2016-01-01 10:00:00')
+    def test_call_at_queues_task_at_deadline(self):
+        self.runtime.call_at(1451642410, self.queue, 'task')
+
+        def wait(timeout):
+            self.assertEqual(timeout, 10)
+            self.runtime.fire_timers(1451642410)
+
+        flexmock(self.runtime.condition).should_receive('wait').replace_with(
+            wait).once()
+
+        self.assertListEqual(self.runtime.wait_for_jobs(), [self.job])
+        self.assertListEqual(list(self.queue), ['task'])
+        self.assertListEqual(self.runtime.timers, [])
+
+    def test_fire_timers_in_deadline_order(self):
+        self.runtime.call_at(20, self.queue, 'second')
+        self.runtime.call_at(10, self.queue, 'first')
+        self.runtime.call_at(30, self.queue, 'third')
+
+        self.runtime.fire_timers(25)
+        self.assertListEqual(list(self.queue), ['first', 'second'])
+        self.assertEqual(len(self.runtime.timers), 1)
+
+
+class TaskQueueCoalescingTest(unittest.TestCase):
+    def setUp(self):
+        self.queue = TaskQueue()
+
+    def test_append_coalesces_pending_task(self):
+        first, second = flexmock(key='refresh'), flexmock(key='refresh')
+
+        self.assertTrue(self.queue.append(first))
+        self.assertFalse(self.queue.append(second))
+        self.assertListEqual(list(self.queue), [first])
+        self.assertEqual(self.queue.coalesced, 1)
+
+    def test_append_after_pending_task_is_taken(self):
+        self.queue.append(flexmock(key='refresh'))
+        self.queue.popleft()
+
+        self.assertTrue(self.queue.append(flexmock(key='refresh')))
+        self.assertEqual(len(self.queue), 1)
+
+    def test_append_tasks_without_key(self):
+        self.assertTrue(self.queue.append(flexmock(key=None)))
+        self.assertTrue(self.queue.append(flexmock(key=None)))
+        self.assertTrue(self.queue.append('task'))
+        self.assertEqual(len(self.queue), 3)
+
+
+class TaskQueuePriorityTest(unittest.TestCase):
+    def test_popleft_takes_higher_priority_first(self):
+        queue = TaskQueue()
+        low = flexmock(priority=LOW)
+        normal = flexmock(priority=NORMAL)
+        high = flexmock(priority=HIGH)
+        for task in (low, normal, high):
+            queue.append(task)
+
+        self.assertEqual(queue.ready(), 3)
+        self.assertListEqual(list(queue), [low, normal, high])
+        self.assertListEqual(
+            [queue.popleft() for x in range(3)], [high, normal, low])
+
+    def test_popleft_skips_priority_not_due(self):
+        queue = TaskQueue()
+        high = flexmock(priority=HIGH)
+        low = flexmock(priority=LOW)
+        queue.append(high, delay=60)
+        queue.append(low)
+
+        self.assertEqual(queue.ready(), 1)
+        self.assertIs(queue.popleft(), low)
+
+    def test_pop_takes_last_appended(self):
+        queue = TaskQueue()
+        queue.append(flexmock(priority=HIGH))
+        low = flexmock(priority=LOW)
+        queue.append(low)
+
+        self.assertIs(queue.pop(), low)
+
+    def test_pop_from_empty_queue(self):
+        with self.assertRaises(IndexError):
+            TaskQueue().pop()
+
+        with self.assertRaises(IndexError):
+            TaskQueue().popleft()
+
+
+class TaskQueueOverflowTest(unittest.TestCase):
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            TaskQueue(overflow='panic')
+
+    def test_shed_oldest_of_lowest_priority(self):
+        queue = TaskQueue(maxlen=2)
+        first, second = flexmock(priority=LOW), flexmock(priority=LOW)
+        high = flexmock(priority=HIGH)
+        queue.append(first)
+        queue.append(second)
+
+        self.assertTrue(queue.append(high))
+        self.assertListEqual(list(queue), [second, high])
+        self.assertEqual(queue.dropped, 1)
+
+    def test_shed_incoming_when_least_important(self):
+        queue = TaskQueue(maxlen=1)
+        high = flexmock(priority=HIGH)
+        queue.append(high)
+
+        self.assertFalse(queue.append(flexmock(priority=LOW)))
+        self.assertListEqual(list(queue), [high])
+        self.assertEqual(queue.dropped, 1)
+
+    def test_shed_incoming_when_as_important(self):
+        queue = TaskQueue(maxlen=1)
+        first, second = flexmock(priority=HIGH), flexmock(priority=HIGH)
+        queue.append(first)
+
+        self.assertFalse(queue.append(second))
+        self.assertListEqual(list(queue), [first])
+
+    def test_defer_ordered_tasks_in_order(self):
+        slow_queue = TaskQueue(delay=60)
+        queue = TaskQueue(maxlen=2, overflow_queue=slow_queue)
+        first, second, third, fourth = [
+            flexmock(priority=HIGH, sheddable=False, ordering_key='_id1')
+            for x in range(4)
+        ]
+        queue.append(first)
+        queue.append(second)
+        queue.append(third)
+
+        # deferred right away, along with the tasks queued before it
+        self.assertListEqual(list(queue), [])
+        self.assertListEqual(list(slow_queue), [first, second, third])
+        self.assertEqual(slow_queue.ready(), 3)
+
+        # and the ones appended later follow them
+        queue.append(fourth)
+        self.assertListEqual(list(slow_queue), [first, second, third, fourth])
+        self.assertEqual(queue.deferred, 4)
+
+    def test_defer_ordered_tasks_of_other_keys_stay(self):
+        slow_queue = TaskQueue(delay=60)
+        queue = TaskQueue(maxlen=1, overflow_queue=slow_queue)
+        other = flexmock(priority=HIGH, sheddable=False, ordering_key='_id2')
+        queue.append(other)
+        queue.append(
+            flexmock(priority=HIGH, sheddable=False, ordering_key='_id1'))
+        slow_queue.popleft()
+
+        # overflows on its own, the other key is left queued
+        task = flexmock(priority=NORMAL, sheddable=False, ordering_key='_id1')
+        queue.append(task)
+        self.assertListEqual(list(queue), [other])
+        self.assertListEqual(list(slow_queue), [task])
+
+    def test_shed_releases_key(self):
+        queue = TaskQueue(maxlen=1)
+        queue.append(flexmock(priority=LOW, key='refresh'))
+        queue.append(flexmock(priority=NORMAL))
+
+        self.assertTrue(queue.append(flexmock(priority=HIGH, key='refresh')))
+
+    def test_defer_tasks_which_are_not_sheddable(self):
+        slow_queue = TaskQueue(delay=60)
+        queue = TaskQueue(maxlen=1, overflow_queue=slow_queue)
+        normal = flexmock(priority=NORMAL, sheddable=False)
+        queue.append(normal)
+        queue.append(flexmock(priority=HIGH))
+        queue.append(flexmock(priority=LOW, sheddable=True))
+
+        self.assertListEqual(list(slow_queue), [normal])
+        self.assertEqual(queue.deferred, 1)
+        self.assertEqual(queue.dropped, 1)
+
+    def test_on_overflow(self):
+        overflowed = []
+        queue = TaskQueue(maxlen=1, on_overflow=overflowed.append)
+        low, high = flexmock(priority=LOW), flexmock(priority=HIGH)
+        queue.append(low)
+        queue.append(high)
+        queue.append(high)
+
+        self.assertListEqual(overflowed, [low, high])
+
+    def test_defer_to_overflow_queue(self):
+        slow_queue = TaskQueue(delay=60)
+        queue = TaskQueue(
+            maxlen=1, overflow='defer', overflow_queue=slow_queue)
+        low = flexmock(priority=LOW)
+        queue.append(low)
+        queue.append(flexmock(priority=NORMAL))
+
+        self.assertListEqual(list(slow_queue), [low])
+        self.assertDictEqual(
+            queue.stats(),
+            dict(size=1, coalesced=0, dropped=0, deferred=1)
+        )
+
+
+class KeyedExecutorTest(unittest.TestCase):
+    def test_submit_runs_inline_until_started(self):
+        executor = KeyedExecutor()
+        calls = []
+        executor.submit('_id1', calls.append, 'first')
+
+        self.assertListEqual(calls, ['first'])
+        self.assertEqual(executor.pending(), 0)
+
+    def test_submit_keeps_order_within_key(self):
+        executor = KeyedExecutor(workers=4)
+        executor.start()
+        calls, done = [], threading.Event()
+
+        def call(value):
+            calls.append(value)
+            if len(calls) == 20:
+                done.set()
+
+        for x in range(20):
+            executor.submit('_id1', call, x)
+
+        self.assertTrue(done.wait(5))
+        self.assertListEqual(calls, range(20))
+
+    def test_submit_runs_keys_in_parallel(self):
+        executor = KeyedExecutor(workers=2)
+        executor.start()
+        blocked, released = threading.Event(), threading.Event()
+
+        # first key holds a worker until the second one gets through
+        executor.submit('_id1', lambda: blocked.wait(5))
+        executor.submit('_id2', released.set)
+
+        self.assertTrue(released.wait(5))
+        blocked.set()
+
+    def test_saturated_till_worker_is_free(self):
+        condition = Condition()
+        executor = KeyedExecutor(workers=1, condition=condition)
+        self.assertFalse(executor.saturated())
+
+        executor.start()
+        released = threading.Event()
+        executor.submit('_id1', released.wait, 5)
+        self.assertTrue(executor.saturated())
+        self.assertEqual(executor.pending(), 1)
+
+        with condition:
+            released.set()
+            condition.wait(5)
+            self.assertFalse(executor.saturated())
+
+    def test_failing_call_does_not_stop_key(self):
+        executor = KeyedExecutor(workers=1)
+        executor.start()
+        done = threading.Event()
+
+        def fail():
+            raise ValueError
+
+        executor.submit('_id1', fail)
+        executor.submit('_id1', done.set)
+
+        self.assertTrue(done.wait(5))
@@ -0,0 +1,79 @@
+from __future__ import absolute_import
+
+import unittest
+from datetime import date, timedelta
+
+import dateutil.tz
+
+from pony.schedule import (
+    TeamSchedule, compile_schedules, parse_duration, parse_time)
+
+
+class ScheduleTest(unittest.TestCase):
+    def setUp(self):
+        self.config = {
+            'timezone': 'UTC',
+            'last_call': '5 minutes',
+            'active_teams': ['dev_team1'],
+            'dev_team1': {
+                'report_by': '16:00',
+                'ask_earliest': '09:00',
+            },
+            'dev_team2': {
+                'report_by': '16:00',
+                'ask_earliest': '09:00',
+            }
+        }
+
+    def test_parse_time(self):
+        self.assertEqual(parse_time('16:30').hour, 16)
+        self.assertEqual(parse_time('16:30').minute, 30)
+
+    def test_parse_duration(self):
+        self.assertEqual(parse_duration('5 minutes'), timedelta(minutes=5))
+        self.assertFalse(parse_duration('0 minutes'))
+
+    def test_compile_schedules(self):
+        schedules = compile_schedules(self.config, date(2016, 12, 23))
+
+        self.assertListEqual(schedules.keys(), ['dev_team1'])
+        self.assertEqual(
+            schedules['dev_team1'],
+            TeamSchedule(
+                team='dev_team1',
+                day=date(2016, 12, 23),
+                ask_earliest=1482483600,
+                last_call=1482508500,
+                report_by=1482508800
+            )
+        )
+
+    def test_compile_schedule_in_team_timezone(self):
+        schedule = TeamSchedule.compile(
+            'dev_team1', self.config['dev_team1'], date(2016, 12, 23),
+            dateutil.tz.gettz('Europe/Bucharest'), timedelta(minutes=5))
+
+        # 09:00 in Bucharest is 07:00 UTC
+        self.assertEqual(schedule.ask_earliest, 1482476400)
+
+    def test_compile_schedule_without_last_call(self):
+        self.config['last_call'] = '0 minutes'
+        schedule = compile_schedules(
+            self.config, date(2016, 12, 23))['dev_team1']
+
+        self.assertIsNone(schedule.last_call)
+        self.assertListEqual(schedule.deadlines(), [1482483600, 1482508800])
+
+    def test_deadlines(self):
+        schedule = compile_schedules(
+            self.config, date(2016, 12, 23))['dev_team1']
+
+        self.assertListEqual(
+            schedule.deadlines(), [1482483600, 1482508500, 1482508800])
+
+    def test_schedule_is_immutable(self):
+        schedule = compile_schedules(
+            self.config, date(2016, 12, 23))['dev_team1']
+
+        with self.assertRaises(AttributeError):
+            schedule.report_by = 0
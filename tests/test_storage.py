@@ -1,18 +1,25 @@
 from __future__ import absolute_import
 
 import os
+import Queue
+import shutil
 import contextlib
 import freezegun
 import tempfile
+import threading
 import unittest
-from datetime import datetime, timedelta
+from flexmock import flexmock
+from datetime import date, datetime, timedelta
 
 import pony.storage
 
 
 class StorageTest(unittest.TestCase):
+    engine = 'pickle'
+    dummy_file = '_dummy_file'
+
     def setUp(self):
-        self.storage = pony.storage.Storage('_dummy_file')
+        self.storage = pony.storage.Storage(self.dummy_file, self.engine)
 
     @contextlib.contextmanager
     def temp_file(self):
@@ -23,7 +30,13 @@ class StorageTest(unittest.TestCase):
         try:
             yield temp_file
         finally:
-            os.remove(temp_file)
+            for suffix in ('', '.journal', '.sqlite', '.sqlite-wal',
+                           '.sqlite-shm'):
+                file_name = '{}{}'.format(temp_file, suffix)
+                if os.path.exists(file_name):
+                    os.remove(file_name)
+
+            shutil.rmtree('{}.report'.format(temp_file), ignore_errors=True)
 
     def test_set_get(self):
         self.storage.set('_key', '_test_value')
@@ -41,28 +54,567 @@ class StorageTest(unittest.TestCase):
         self.storage.unset('_key')
         self.assertIsNone(self.storage.get('_key'))
 
+    def test_sweep_evicts_expired_keys(self):
+        self.storage.set('_key', '_test_value', expire_in=10)
+        self.storage.set('_key_2', '_test_value', expire_in=20)
+        self.storage.set('_key_3', '_test_value')
+
+        with freezegun.freeze_time(datetime.utcnow() + timedelta(seconds=15)):
+            self.assertDictEqual(
+                self.storage.expiry_stats(),
+                dict(live=1, expired=1, swept=0))
+
+            self.assertEqual(self.storage.sweep(), 1)
+            self.assertNotIn('_key', self.storage._data)
+            self.assertEqual(self.storage.get('_key_2'), '_test_value')
+            self.assertEqual(self.storage.get('_key_3'), '_test_value')
+
+            self.assertDictEqual(
+                self.storage.expiry_stats(),
+                dict(live=1, expired=0, swept=1))
+
+    def test_sweep_respects_extended_expiration(self):
+        self.storage.set('_key', '_test_value', expire_in=10)
+        self.storage.set('_key', '_test_value', expire_in=30)
+
+        with freezegun.freeze_time(datetime.utcnow() + timedelta(seconds=15)):
+            self.assertEqual(self.storage.sweep(), 0)
+            self.assertEqual(self.storage.get('_key'), '_test_value')
+
+        with freezegun.freeze_time(datetime.utcnow() + timedelta(seconds=35)):
+            self.assertEqual(self.storage.sweep(), 1)
+
+    def test_sweep_skips_unset_keys(self):
+        self.storage.set('_key', '_test_value', expire_in=10)
+        self.storage.unset('_key')
+
+        with freezegun.freeze_time(datetime.utcnow() + timedelta(seconds=15)):
+            self.assertEqual(self.storage.sweep(), 0)
+
     def test_get_with_default_sets(self):
         self.storage.get('_key', default='_test_value')
         self.assertEqual(self.storage.get('_key'), '_test_value')
 
     def test_load_save(self):
         with self.temp_file() as storage_file:
-            self.storage = pony.storage.Storage(storage_file)
+            self.storage = pony.storage.Storage(storage_file, self.engine)
             self.storage.set('test_key', 'test_value')
             self.storage.save()
+            self.storage.wait()
 
-            self.storage = pony.storage.Storage(storage_file)
+            self.storage = pony.storage.Storage(storage_file, self.engine)
             self.assertEqual(self.storage.get('test_key'), 'test_value')
 
     def test_load_save_respects_expiration(self):
         with self.temp_file() as storage_file:
-            self.storage = pony.storage.Storage(storage_file)
+            self.storage = pony.storage.Storage(storage_file, self.engine)
             self.storage.set('test_key', 'test_value', expire_in=10)
             self.storage.set('test_key_2', 'test_value')
             self.storage.save()
+            self.storage.wait()
 
             with freezegun.freeze_time(
                 datetime.utcnow() + timedelta(seconds=15)):
-                self.storage = pony.storage.Storage(storage_file)
+                self.storage = pony.storage.Storage(storage_file, self.engine)
                 self.assertIsNone(self.storage.get('test_key'))
                 self.assertEqual(self.storage.get('test_key_2'), 'test_value')
+
+    def test_touch_marks_change(self):
+        self.storage.set('_key', {'a': 1})
+        self.storage._changes.clear()
+
+        self.storage.touch('_key', 'a')
+        self.assertDictEqual(self.storage._changes, {'_key': {'a'}})
+
+        self.storage.touch('_key')
+        self.assertDictEqual(self.storage._changes, {'_key': None})
+
+    def test_transaction_marks_change(self):
+        self.storage.set('_key', {'a': {'b': 1}})
+        self.storage._changes.clear()
+
+        with self.storage.transaction('_key', 'a') as value:
+            value['b'] = 2
+
+        self.assertDictEqual(self.storage.get('_key'), {'a': {'b': 2}})
+        self.assertDictEqual(self.storage._changes, {'_key': {'a'}})
+
+    def test_transaction_sets_default(self):
+        self.storage.set('_key', {})
+
+        with self.storage.transaction('_key', 'a', default={}) as value:
+            value['b'] = 1
+
+        self.assertDictEqual(self.storage.get('_key'), {'a': {'b': 1}})
+
+    def test_transaction_marks_change_on_error(self):
+        self.storage.set('_key', {'a': {}})
+        self.storage._changes.clear()
+
+        with self.assertRaises(ValueError):
+            with self.storage.transaction('_key', 'a') as value:
+                value['b'] = 1
+                raise ValueError
+
+        self.assertDictEqual(self.storage._changes, {'_key': {'a'}})
+
+    def test_update(self):
+        self.storage.set('_key', {'a': [1]})
+
+        result = self.storage.update(
+            '_key', lambda value: value.append(2) or len(value), subkey='a')
+        self.assertEqual(result, 2)
+        self.assertDictEqual(self.storage.get('_key'), {'a': [1, 2]})
+
+    def test_transactions_of_other_scopes_run_together(self):
+        self.storage.set('_key', {'a': {}})
+        entered = threading.Event()
+
+        def change_other_scope():
+            with self.storage.transaction('_key', 'a', scopes=['t2']):
+                entered.set()
+
+        with self.storage.transaction('_key', 'a', scopes=['t1']):
+            thread = threading.Thread(target=change_other_scope)
+            thread.start()
+            self.assertTrue(entered.wait(5))
+
+        thread.join()
+
+    def test_transactions_of_same_scope_are_serialized(self):
+        self.storage.set('_key', {'a': {}})
+        entered = threading.Event()
+
+        def change_same_scope():
+            with self.storage.transaction('_key', 'a', scopes=['t1', 't2']):
+                entered.set()
+
+        with self.storage.transaction('_key', 'a', scopes=['t1']):
+            thread = threading.Thread(target=change_same_scope)
+            thread.start()
+            self.assertFalse(entered.wait(0.1))
+
+        thread.join()
+        self.assertTrue(entered.is_set())
+
+    def test_save_waits_for_transaction(self):
+        self.storage.set('_key', {'a': {}})
+        saved = threading.Event()
+        flexmock(self.storage._engine).should_receive('flush')
+
+        def save():
+            self.storage.save()
+            saved.set()
+
+        with self.storage.transaction('_key', 'a', scopes=['t1']):
+            thread = threading.Thread(target=save)
+            thread.start()
+            self.assertFalse(saved.wait(0.1))
+
+        thread.join()
+        self.assertTrue(saved.is_set())
+        self.storage.wait()
+
+    def test_save_queues_snapshot_while_locked(self):
+        self.storage.set('_key', {'a': {}})
+        flexmock(self.storage._engine).should_receive('flush')
+
+        def put(item):
+            # a concurrent save would have to wait for this one to be queued
+            self.assertFalse(self.storage._lock.acquire(False))
+            Queue.Queue.put(self.storage._queue, item)
+
+        flexmock(self.storage._queue).should_receive('put').replace_with(put)
+
+        self.storage.save()
+        self.storage.wait()
+
+    def test_view_is_read_only(self):
+        self.storage.set('_key', {'a': {'b': [1, {'c': 2}]}})
+        view = self.storage.view('_key')
+
+        self.assertEqual(view['a']['b'][1]['c'], 2)
+        self.assertIsInstance(view['a']['b'], tuple)
+        self.assertDictEqual(dict(view['a']['b'][1]), {'c': 2})
+        with self.assertRaises(TypeError):
+            view['a']['d'] = 1
+
+    def test_set_equal_value_is_not_a_change(self):
+        self.storage.set('_key', ['_test_value'])
+        self.storage._changes.clear()
+
+        self.storage.set('_key', ['_test_value'])
+        self.assertFalse(self.storage.is_dirty())
+
+    def test_set_same_object_is_a_change(self):
+        value = ['_test_value']
+        self.storage.set('_key', value)
+        self.storage._changes.clear()
+
+        value.append('_other_value')
+        self.storage.set('_key', value)
+        self.assertTrue(self.storage.is_dirty())
+
+    def test_save_skips_flush_when_nothing_changed(self):
+        with self.temp_file() as storage_file:
+            self.storage = pony.storage.Storage(storage_file, self.engine)
+            self.storage.set('test_key', 'test_value')
+            self.storage.save()
+            self.storage.wait()
+            self.assertFalse(self.storage.is_dirty())
+
+            (flexmock(self.storage._engine)
+             .should_receive('flush')
+             .never())
+            (flexmock(self.storage)
+             .should_receive('debug')
+             .never())
+
+            self.storage.get('test_key')
+            self.storage.save()
+            self.storage.wait()
+
+    def test_expired_key_is_a_change(self):
+        self.storage.set('_key', '_test_value', expire_in=10)
+        self.storage._changes.clear()
+
+        with freezegun.freeze_time(datetime.utcnow() + timedelta(seconds=15)):
+            self.assertIsNone(self.storage.get('_key'))
+
+        self.assertTrue(self.storage.is_dirty())
+
+    def test_snapshot_is_isolated_from_changes(self):
+        self.storage.set('_key', {'a': ['_test_value'], 'b': []})
+        snapshot = self.storage._snapshot({'_key': None})
+
+        self.storage.get('_key')['a'].append('_other_value')
+        self.storage.touch('_key', 'a')
+        self.assertListEqual(snapshot['_key']['a'], ['_test_value'])
+
+        next_snapshot = self.storage._snapshot({'_key': {'a'}})
+        self.assertListEqual(
+            next_snapshot['_key']['a'], ['_test_value', '_other_value'])
+        self.assertIs(next_snapshot['_key']['b'], snapshot['_key']['b'])
+
+    def test_save_leaves_no_temp_file(self):
+        with self.temp_file() as storage_file:
+            self.storage = pony.storage.Storage(storage_file, 'pickle')
+            self.storage.set('test_key', 'test_value')
+            self.storage.save()
+            self.storage.wait()
+
+            self.assertTrue(os.path.exists(storage_file))
+            self.assertFalse(os.path.exists('{}.tmp'.format(storage_file)))
+
+    def test_failed_save_keeps_changes(self):
+        self.storage.set('test_key', 'test_value')
+
+        (flexmock(self.storage._engine)
+         .should_receive('flush')
+         .and_raise(IOError)
+         .once())
+
+        self.storage.save()
+        self.storage.wait()
+        self.assertTrue(self.storage.is_dirty())
+
+    def test_partitions_load_on_access(self):
+        with self.temp_file() as storage_file:
+            self.storage = pony.storage.Storage(
+                storage_file, self.engine, partitioned=('report',))
+            self.storage.set('report', {
+                date(2016, 12, 22): {'first': {}},
+                date(2016, 12, 23): {'second': {}},
+            })
+            self.storage.save()
+            self.storage.wait()
+
+            self.storage = pony.storage.Storage(
+                storage_file, self.engine, partitioned=('report',))
+            report = self.storage.get('report')
+            self.assertIsInstance(report, pony.storage.Partitions)
+            self.assertIn(date(2016, 12, 22), report)
+            self.assertDictEqual(report.resident(), {})
+
+            self.assertDictEqual(report[date(2016, 12, 22)], {'first': {}})
+            self.assertListEqual(
+                report.resident().keys(), [date(2016, 12, 22)])
+            self.assertListEqual(
+                list(report), [date(2016, 12, 22), date(2016, 12, 23)])
+
+    def test_partitions_keep_few_items_in_memory(self):
+        days = [date(2016, 12, day) for day in range(1, 11)]
+        with self.temp_file() as storage_file:
+            self.storage = pony.storage.Storage(
+                storage_file, self.engine, partitioned=('report',),
+                cache_size=2)
+            self.storage.set('report', {day: {} for day in days})
+            self.assertEqual(len(self.storage.get('report').resident()), 10)
+
+            self.storage.save()
+            self.storage.wait()
+
+            # written items are evicted, except for the newest one
+            report = self.storage.get('report')
+            self.assertEqual(len(report.resident()), 3)
+            self.assertIn(date(2016, 12, 10), report.resident())
+
+            for day in days:
+                self.assertDictEqual(report[day], {})
+            self.assertEqual(len(report.resident()), 3)
+
+    def test_partitions_write_changed_items_only(self):
+        with self.temp_file() as storage_file:
+            self.storage = pony.storage.Storage(
+                storage_file, self.engine, partitioned=('report',))
+            self.storage.set('report', {
+                date(2016, 12, 22): {'first': {}},
+                date(2016, 12, 23): {'second': {}},
+            })
+            self.storage.save()
+            self.storage.wait()
+
+            written = []
+            dump = self.storage._engine.dump
+            self.storage._engine.dump = lambda data, file_name=None: (
+                written.append(file_name) or dump(data, file_name))
+
+            self.storage.get('report')[date(2016, 12, 23)] = {'third': {}}
+            self.storage.touch('report', date(2016, 12, 23))
+            self.storage.save()
+            self.storage.wait()
+
+            self.assertIn(
+                self.storage._engine.partition_file_name(
+                    'report', date(2016, 12, 23)),
+                written)
+            self.assertNotIn(
+                self.storage._engine.partition_file_name(
+                    'report', date(2016, 12, 22)),
+                written)
+
+            self.storage = pony.storage.Storage(
+                storage_file, self.engine, partitioned=('report',))
+            self.assertDictEqual(
+                self.storage.get('report')[date(2016, 12, 23)],
+                {'third': {}})
+
+    def test_partitions_migrate_plain_dictionary(self):
+        with self.temp_file() as storage_file:
+            self.storage = pony.storage.Storage(storage_file, self.engine)
+            self.storage.set('report', {date(2016, 12, 22): {'first': {}}})
+            self.storage.save()
+            self.storage.wait()
+
+            self.storage = pony.storage.Storage(
+                storage_file, self.engine, partitioned=('report',))
+            self.storage.save()
+            self.storage.wait()
+
+            self.storage = pony.storage.Storage(
+                storage_file, self.engine, partitioned=('report',))
+            self.assertDictEqual(
+                self.storage.get('report')[date(2016, 12, 22)],
+                {'first': {}})
+
+
+class JournalStorageTest(StorageTest):
+    engine = 'journal'
+
+    def test_journal_load_save(self):
+        with self.temp_file() as storage_file:
+            self.storage = pony.storage.Storage(storage_file, self.engine)
+            self.storage.set('test_key', 'test_value')
+            self.storage.set('test_dict', {'a': [], 'b': []})
+            self.storage.save()
+            self.storage.wait()
+
+            self.storage.get('test_dict')['a'].append(1)
+            self.storage.touch('test_dict', 'a')
+            self.storage.unset('test_key')
+            self.storage.save()
+            self.storage.wait()
+
+            self.assertFalse(os.path.exists(storage_file))
+
+            self.storage = pony.storage.Storage(storage_file, self.engine)
+            self.assertIsNone(self.storage.get('test_key'))
+            self.assertDictEqual(
+                self.storage.get('test_dict'), {'a': [1], 'b': []})
+
+    def test_journal_appends_changed_items_only(self):
+        with self.temp_file() as storage_file:
+            self.storage = pony.storage.Storage(storage_file, self.engine)
+            self.storage.set('test_dict', {'a': 'x' * 1024, 'b': []})
+            self.storage.save()
+            self.storage.wait()
+            journal_size = self.storage._engine.journal_size
+
+            self.storage.get('test_dict')['b'].append(1)
+            self.storage.touch('test_dict', 'b')
+            self.storage.save()
+            self.storage.wait()
+
+            self.assertLess(
+                self.storage._engine.journal_size - journal_size, 128)
+
+    def test_journal_compacts(self):
+        with self.temp_file() as storage_file:
+            self.storage = pony.storage.Storage(storage_file, self.engine)
+            self.storage._engine.compact_at = 0
+            self.storage.set('test_key', 'test_value')
+            self.storage.save()
+            self.storage.wait()
+
+            self.assertTrue(os.path.exists(storage_file))
+            self.assertEqual(self.storage._engine.journal_size, 0)
+
+            self.storage.set('test_key_2', 'test_value_2')
+            self.storage.save()
+            self.storage.wait()
+
+            self.storage = pony.storage.Storage(storage_file, self.engine)
+            self.assertEqual(self.storage.get('test_key'), 'test_value')
+            self.assertEqual(self.storage.get('test_key_2'), 'test_value_2')
+
+    def test_journal_drops_broken_tail(self):
+        with self.temp_file() as storage_file:
+            self.storage = pony.storage.Storage(storage_file, self.engine)
+            self.storage.set('test_key', 'test_value')
+            self.storage.save()
+            self.storage.wait()
+
+            with open('{}.journal'.format(storage_file), 'ab') as f:
+                f.write(b'\x80\x02(U')
+
+            self.storage = pony.storage.Storage(storage_file, self.engine)
+            self.assertEqual(self.storage.get('test_key'), 'test_value')
+
+            self.storage.set('test_key_2', 'test_value_2')
+            self.storage.save()
+            self.storage.wait()
+
+            self.storage = pony.storage.Storage(storage_file, self.engine)
+            self.assertEqual(self.storage.get('test_key_2'), 'test_value_2')
+
+
+class SQLiteStorageTest(StorageTest):
+    engine = 'sqlite'
+    dummy_file = ':memory:'
+
+    def test_imports_pickle_database(self):
+        with self.temp_file() as storage_file:
+            self.storage = pony.storage.Storage(
+                storage_file, 'journal', partitioned=('report',))
+            self.storage.set('test_key', 'test_value', expire_in=3600)
+            self.storage.set('report', {
+                date(2016, 12, 23): {
+                    'team': {'reports': {'user1': {'report': ['_line']}}}
+                }
+            })
+            self.storage.save()
+            self.storage.wait()
+
+            self.storage = pony.storage.Storage(
+                storage_file, self.engine, partitioned=('report',))
+            self.assertTrue(os.path.exists('{}.sqlite'.format(storage_file)))
+            self.assertEqual(self.storage.get('test_key'), 'test_value')
+            self.assertDictEqual(
+                self.storage.get('report')[date(2016, 12, 23)],
+                {'team': {'reports': {'user1': {'report': ['_line']}}}})
+
+            # imported once, the pickle database is left as is
+            self.storage.set('test_key', 'test_value_2')
+            self.storage.save()
+            self.storage.wait()
+
+            self.storage = pony.storage.Storage(
+                storage_file, self.engine, partitioned=('report',))
+            self.assertEqual(self.storage.get('test_key'), 'test_value_2')
+
+    def test_partitions_write_changed_items_only(self):
+        with self.temp_file() as storage_file:
+            self.storage = pony.storage.Storage(
+                storage_file, self.engine, partitioned=('report',))
+            self.storage.set('report', {
+                date(2016, 12, 23): {
+                    'team': {
+                        'reports': {
+                            'user1': {'report': []},
+                            'user2': {'report': []},
+                        }
+                    }
+                }
+            })
+            self.storage.save()
+            self.storage.wait()
+
+            connection = self.storage._engine.connection
+            total_changes = connection.total_changes
+
+            report = self.storage.get('report')[date(2016, 12, 23)]
+            report['team']['reports']['user2']['report'].append('_line')
+            self.storage.touch('report', date(2016, 12, 23))
+            self.storage.save()
+            self.storage.wait()
+
+            # report index and a single user report row
+            self.assertEqual(connection.total_changes - total_changes, 2)
+
+            self.storage = pony.storage.Storage(
+                storage_file, self.engine, partitioned=('report',))
+            self.assertDictEqual(
+                self.storage.get('report')[date(2016, 12, 23)],
+                {
+                    'team': {
+                        'reports': {
+                            'user1': {'report': []},
+                            'user2': {'report': ['_line']},
+                        }
+                    }
+                })
+
+    def test_reports_are_queryable(self):
+        with self.temp_file() as storage_file:
+            self.storage = pony.storage.Storage(
+                storage_file, self.engine, partitioned=('report',))
+            self.storage.set('report', {
+                date(2016, 12, 23): {
+                    'team': {
+                        'reported_at': datetime(2016, 12, 23, 12),
+                        'reports': {
+                            'user1': {
+                                'report': ['_line'],
+                                'reported_at': datetime(2016, 12, 23, 10)
+                            },
+                        }
+                    }
+                }
+            })
+            self.storage.save()
+            self.storage.wait()
+
+            rows = self.storage._engine.connection.execute(
+                'SELECT day, team, user, reported_at, report '
+                'FROM user_report').fetchall()
+            self.assertListEqual(rows, [(
+                date(2016, 12, 23), 'team', 'user1',
+                datetime(2016, 12, 23, 10), '["_line"]'
+            )])
+
+    def test_expiration_is_stored(self):
+        with self.temp_file() as storage_file:
+            self.storage = pony.storage.Storage(storage_file, self.engine)
+            self.storage.set('test_key', 'test_value', expire_in=10)
+            self.storage.save()
+            self.storage.wait()
+
+            self.storage.set('test_key', 'test_value', expire_in=20)
+            self.storage.save()
+            self.storage.wait()
+
+            expire_at = self.storage._engine.connection.execute(
+                'SELECT expire_at FROM kv WHERE key = ?',
+                ('test_key', )).fetchone()[0]
+            self.assertEqual(
+                expire_at, self.storage.get('_expire')['test_key'])
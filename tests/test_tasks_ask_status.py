@@ -1,5 +1,6 @@
 from __future__ import absolute_import
 
+import time
 from datetime import date, datetime
 
 import freezegun
@@ -91,3 +92,48 @@ class AskStatusTest(BaseTest):
         self.assertIsInstance(task, pony.tasks.SendMessage)
         self.assertEqual(task.to, 'U023BECGF')
         self.assertIn(task.text, Dictionary.PLEASE_REPORT_LAST_CALL)
+
+    def test_execute_clears_pending_ask(self):
+        self.bot.lock_user('U023BECGF', ['t1', 't2'], 10)
+        task = pony.tasks.AskStatus(['t1', 't2'], 'U023BECGF', last_call=False)
+        self.bot.pending_asks.add(task)
+        task.execute(self.bot, self.slack)
+
+        self.assertNotIn('U023BECGF', self.bot.pending_asks)
+
+    def test_overflow_puts_user_back(self):
+        self.bot.fast_queue.maxlen = 1
+        self.bot.awaiting_reports.add('U023BECGF', ['t1', 't2'])
+        self.assertListEqual(
+            self.bot.awaiting_reports.pop_due(time.time()), ['U023BECGF'])
+
+        task = pony.tasks.AskStatus(['t1', 't2'], 'U023BECGF', last_call=False)
+        self.bot.pending_asks.add(task)
+        self.bot.fast_queue.append(task)
+        self.bot.fast_queue.append(
+            pony.tasks.ReadStatusMessage({'user': '_other'}))
+
+        # ask is not dropped, it is cancelled and the user is due again
+        self.assertEqual(self.bot.fast_queue.dropped, 0)
+        self.assertNotIn('U023BECGF', self.bot.pending_asks)
+        self.assertListEqual(
+            self.bot.awaiting_reports.pop_due(time.time()), ['U023BECGF'])
+
+        # deferred ask does nothing, the next check asks the user again
+        (flexmock(self.bot)
+         .should_receive('lock_user')
+         .never())
+        task.execute(self.bot, self.slack)
+        self.assertEqual(len(self.bot.fast_queue), 1)
+
+    def test_execute_user_locked_defers_till_lock_expiry(self):
+        self.bot.awaiting_reports.add('U023BECGF', ['t1', 't2'])
+        with freezegun.freeze_time('2016-12-23 11:00'):
+            self.bot.lock_user('U023BECGF', ['t1', 't2'], 60)
+
+            task = pony.tasks.AskStatus(
+                ['t1', 't2'], 'U023BECGF', last_call=False)
+            task.execute(self.bot, self.slack)
+
+        self.assertDictEqual(
+            self.bot.awaiting_reports.due_at, {'U023BECGF': 1482490860})
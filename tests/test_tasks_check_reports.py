@@ -6,6 +6,8 @@ import freezegun
 from flexmock import flexmock
 
 import pony.tasks
+from pony.dictionary import Dictionary
+from pony.directory import User
 from tests.test_base import BaseTest
 
 
@@ -33,7 +35,7 @@ class CheckReportsTest(BaseTest):
         (flexmock(self.bot)
          .should_receive('get_user_by_name')
          .with_args('@sasha')
-         .and_return({'id': '_sasha_id'}))
+         .and_return(User('_sasha_id', 'sasha')))
 
         # check reports might call the UserList update
         # but we are not interested in that in scope of this test
@@ -222,3 +224,131 @@ class CheckReportsTest(BaseTest):
                     date(2016, 12, 1)
                 ]['dev_team1'].get('reported_at')
             )
+
+    def test_execute_is_last_call_exactly_at_deadline(self):
+        with freezegun.freeze_time('2016-12-23 15:55'):
+            self.task.execute(self.bot, self.slack)
+
+            task = self.bot.fast_queue.pop()
+            self.assertTrue(task.last_call)
+
+    def test_execute_for_team_does_not_schedule_next_check(self):
+        queued = len(self.bot.slow_queue)
+        with freezegun.freeze_time('2016-12-23 20:00'):
+            pony.tasks.CheckReports(teams=['dev_team1']).execute(
+                self.bot, self.slack)
+
+            # user list update on a new day joins the pending one
+            self.assertEqual(len(self.bot.slow_queue), queued)
+            self.assertEqual(self.bot.slow_queue.coalesced, 1)
+            task = self.bot.fast_queue.pop()
+            self.assertIsInstance(task, pony.tasks.SendReportSummary)
+
+    def test_execute_compiles_schedules_once_a_day(self):
+        with freezegun.freeze_time('2016-12-23 11:00'):
+            self.task.execute(self.bot, self.slack)
+            schedules = self.bot.get_schedules()
+
+            self.task.execute(self.bot, self.slack)
+            self.assertIs(self.bot.get_schedules(), schedules)
+
+        with freezegun.freeze_time('2016-12-26 11:00'):
+            self.assertIsNot(self.bot.get_schedules(), schedules)
+
+    def test_execute_asks_user_once_across_teams(self):
+        self.bot.plugin_config['active_teams'] = ['dev_team1', 'dev_team2']
+        self.bot.plugin_config['dev_team2'] = dict(
+            self.bot.plugin_config['dev_team1'], name='Dev Team 2')
+
+        with freezegun.freeze_time('2016-12-23 11:00'):
+            self.task.execute(self.bot, self.slack)
+            self.task.execute(self.bot, self.slack)
+
+            self.assertEqual(len(self.bot.fast_queue), 1)
+            task = self.bot.fast_queue.pop()
+            self.assertIsInstance(task, pony.tasks.AskStatus)
+            self.assertItemsEqual(task.teams, ['dev_team1', 'dev_team2'])
+            self.assertIs(self.bot.pending_asks.get('_sasha_id'), task)
+
+    def test_execute_upgrades_pending_ask_to_last_call(self):
+        with freezegun.freeze_time('2016-12-23 15:00'):
+            self.task.execute(self.bot, self.slack)
+
+        with freezegun.freeze_time('2016-12-23 15:56'):
+            self.task.execute(self.bot, self.slack)
+
+            self.assertEqual(len(self.bot.fast_queue), 1)
+            self.assertTrue(self.bot.fast_queue.pop().last_call)
+
+    def test_execute_last_call_before_pending_ask_runs(self):
+        flexmock(self.bot).should_receive('user_is_online').and_return(True)
+        with freezegun.freeze_time('2016-12-23 15:00'):
+            self.task.execute(self.bot, self.slack)
+        ask = self.bot.fast_queue.pop()
+
+        with freezegun.freeze_time('2016-12-23 15:56'):
+            self.task.execute(self.bot, self.slack)
+            self.assertEqual(len(self.bot.fast_queue), 0)
+
+            (flexmock(Dictionary)
+             .should_receive('pick')
+             .replace_with(lambda phrases, user_id: (
+                '_last_call'
+                if phrases == Dictionary.PLEASE_REPORT_LAST_CALL else '_ask')))
+            ask.execute(self.bot, self.slack)
+
+        self.assertEqual(self.bot.fast_queue.pop().text, '_last_call')
+
+    def test_execute_last_call_after_pending_ask_is_taken(self):
+        with freezegun.freeze_time('2016-12-23 15:00'):
+            self.task.execute(self.bot, self.slack)
+        ask = self.bot.fast_queue.pop()
+        self.assertFalse(self.bot.pending_asks.take(ask))
+
+        # the ask about to run is not upgraded, last call is a new one
+        with freezegun.freeze_time('2016-12-23 15:56'):
+            self.task.execute(self.bot, self.slack)
+
+        self.assertFalse(ask.last_call)
+        last_call = self.bot.fast_queue.pop()
+        self.assertIsInstance(last_call, pony.tasks.AskStatus)
+        self.assertTrue(last_call.last_call)
+        self.assertIs(self.bot.pending_asks.get('_sasha_id'), last_call)
+
+    def test_execute_indexes_awaiting_reports(self):
+        with freezegun.freeze_time('2016-12-23 11:00'):
+            self.task.execute(self.bot, self.slack)
+
+        awaiting = self.bot.awaiting_reports
+        self.assertEqual(awaiting.day, date(2016, 12, 23))
+        self.assertDictEqual(awaiting.teams, {'_sasha_id': ['dev_team1']})
+
+    def test_execute_skips_users_not_due(self):
+        with freezegun.freeze_time('2016-12-23 11:00'):
+            self.task.execute(self.bot, self.slack)
+            self.bot.fast_queue.pop().execute(self.bot, self.slack)
+
+        # user is offline and parked till they come online
+        self.assertSetEqual(self.bot.awaiting_reports.offline, {'_sasha_id'})
+        with freezegun.freeze_time('2016-12-23 11:02'):
+            self.task.execute(self.bot, self.slack)
+            self.assertEqual(len(self.bot.fast_queue), 0)
+
+            pony.tasks.ProcessPresenceChange(
+                '_sasha_id', 'active').execute(self.bot, self.slack)
+            self.task.execute(self.bot, self.slack)
+            self.assertIsInstance(
+                self.bot.fast_queue.pop(), pony.tasks.AskStatus)
+
+    def test_execute_defers_users_till_ask_earliest(self):
+        with freezegun.freeze_time('2016-12-23 02:00'):
+            self.task.execute(self.bot, self.slack)
+
+        self.assertDictEqual(
+            self.bot.awaiting_reports.due_at, {'_sasha_id': 1482483600})
+
+    def test_execute_drops_users_on_weekend(self):
+        with freezegun.freeze_time('2016-12-24 11:00'):
+            self.task.execute(self.bot, self.slack)
+
+        self.assertEqual(len(self.bot.awaiting_reports), 0)
@@ -1,20 +1,21 @@
 from __future__ import absolute_import
 
 import pony.tasks
+from pony.directory import User
 from tests.test_base import BaseTest
 
 
 class ProcessPresenceChangeTest(BaseTest):
     def setUp(self):
         super(ProcessPresenceChangeTest, self).setUp()
-        self.bot.storage.set('users', [{'id': '_id1', 'deleted': False}])
+        self.bot.storage.set('users', [User('_id1')])
 
     def test_execute_user_is_now_active(self):
         task = pony.tasks.ProcessPresenceChange('_id1', presence='active')
         task.execute(self.bot, self.slack)
 
         user = self.bot.get_user_by_id('_id1')
-        self.assertEqual(user.get('presence'), 'active')
+        self.assertEqual(user.presence, 'active')
 
     def test_execute_is_online(self):
         self.assertFalse(self.bot.user_is_online('_id1'))
@@ -1,15 +1,20 @@
 from __future__ import absolute_import
 
+import time
 from datetime import datetime
 
+from flexmock import flexmock
+
 import pony.tasks
+from pony.directory import IMDirectory
+from pony.runtime import HIGH, LOW
 from tests.test_base import BaseTest
 
 
 class ReadMessageTest(BaseTest):
     def setUp(self):
         super(ReadMessageTest, self).setUp()
-        self.bot.storage.set('ims', [])
+        self.bot.im_directory = IMDirectory([])
 
     def test_is_not_a_bot_message(self):
         task = pony.tasks.ReadMessage({})
@@ -28,7 +33,7 @@ class ReadMessageTest(BaseTest):
         self.assertFalse(task.is_direct_message(self.bot))
 
     def test_is_direct_message(self):
-        self.bot.storage.set('ims', [{'id': '_im_channel_id'}])
+        self.bot.im_directory = IMDirectory([{'id': '_im_channel_id'}])
 
         task = pony.tasks.ReadMessage({
             'type': 'message',
@@ -37,6 +42,22 @@ class ReadMessageTest(BaseTest):
         })
         self.assertTrue(task.is_direct_message(self.bot))
 
+    def test_priority(self):
+        direct = pony.tasks.ReadMessage({'channel': 'D3AV4E6BZ'})
+        self.assertEqual(direct.priority, HIGH)
+
+        channel = pony.tasks.ReadMessage({'channel': 'C024BE91L'})
+        self.assertEqual(channel.priority, LOW)
+        self.assertEqual(pony.tasks.ReadMessage({}).priority, LOW)
+
+    def test_ordering_key(self):
+        message = pony.tasks.ReadMessage({'user': 'U04RVVBAY'})
+        self.assertEqual(message.ordering_key, 'U04RVVBAY')
+
+        edit = pony.tasks.ReadMessageEdit({'message': {'user': 'U04RVVBAY'}})
+        self.assertEqual(edit.ordering_key, 'U04RVVBAY')
+        self.assertIsNone(pony.tasks.ReadMessage({}).ordering_key)
+
     def test_execute_empty_payload(self):
         task = pony.tasks.ReadMessage({})
         self.assertIsNone(task.execute(self.bot, self.slack))
@@ -46,7 +67,7 @@ class ReadMessageTest(BaseTest):
         self.assertIsNone(task.execute(self.bot, self.slack))
 
     def test_execute_reads_status_message(self):
-        self.bot.storage.set('ims', [{'id': '_im_channel_id'}])
+        self.bot.im_directory = IMDirectory([{'id': '_im_channel_id'}])
         data = {
             'type': 'message',
             'user': '_user_id',
@@ -176,3 +197,69 @@ class ReadMessageEditTest(BaseTest):
                 'Worked hard the rest of the day'
             ]
         )
+
+
+class ReadStatusMessageTest(BaseTest):
+    def setUp(self):
+        super(ReadStatusMessageTest, self).setUp()
+        self.bot.storage.set('report', {
+            datetime.utcnow().date(): {
+                'dev_team1': {
+                    'reports': {
+                        'U04RVVBAY': {'report': []}
+                    }
+                }
+            }
+        })
+        self.bot.awaiting_reports.add('U04RVVBAY', ['dev_team1'])
+        self.bot.lock_user('U04RVVBAY', ['dev_team1'], expire_in=60)
+
+    def test_execute_marks_user_reported(self):
+        task = pony.tasks.ReadStatusMessage(
+            {'user': 'U04RVVBAY', 'text': 'Worked hard'})
+        task.execute(self.bot, self.slack)
+
+        user_report = self.bot.storage.get('report')[
+            datetime.utcnow().date()]['dev_team1']['reports']['U04RVVBAY']
+        self.assertListEqual(user_report['report'], ['Worked hard'])
+        self.assertIsNotNone(user_report['reported_at'])
+        self.assertNotIn('U04RVVBAY', self.bot.awaiting_reports)
+        self.assertIsInstance(
+            self.bot.fast_queue.pop(), pony.tasks.SendMessage)
+
+    def test_execute_records_latency(self):
+        received_at = time.time() - 2
+        task = pony.tasks.ReadStatusMessage(
+            {'user': 'U04RVVBAY', 'text': 'Worked hard'},
+            received_at=received_at)
+
+        (flexmock(self.bot.latency)
+         .should_receive('record')
+         .with_args('read', float)
+         .once()
+         .ordered())
+        (flexmock(self.bot.latency)
+         .should_receive('record')
+         .with_args('acknowledged', float)
+         .once()
+         .ordered())
+
+        task.execute(self.bot, self.slack)
+
+        user_report = self.bot.storage.get('report')[
+            datetime.utcnow().date()]['dev_team1']['reports']['U04RVVBAY']
+        self.assertEqual(
+            user_report['received_at'],
+            datetime.utcfromtimestamp(received_at))
+
+        # acknowledgement latency is known once Slack accepts the reply
+        self.bot.fast_queue.pop().on_sent()
+
+    def test_execute_skips_latency_of_other_messages(self):
+        task = pony.tasks.ReadStatusMessage(
+            {'user': '_other_user', 'text': 'Hello'},
+            received_at=time.time())
+        flexmock(self.bot.latency).should_receive('record').never()
+
+        task.execute(self.bot, self.slack)
+        self.assertEqual(len(self.bot.fast_queue), 0)
@@ -0,0 +1,69 @@
+from __future__ import absolute_import
+
+from datetime import date
+
+import freezegun
+from flexmock import flexmock
+
+import pony.tasks
+from tests.test_base import BaseTest
+
+
+class ScheduleDeadlinesTest(BaseTest):
+    def setUp(self):
+        super(ScheduleDeadlinesTest, self).setUp()
+        self.bot.plugin_config = {
+            'timezone': 'UTC',
+            'last_call': '5 minutes',
+            'active_teams': ['dev_team1'],
+            'dev_team1': {
+                'report_by': '16:00',
+                'ask_earliest': '09:00',
+            }
+        }
+
+    def test_execute(self):
+        with freezegun.freeze_time('2016-12-23 11:00'):
+            pony.tasks.ScheduleDeadlines().execute(self.bot, self.slack)
+
+        timers = sorted(self.bot.runtime.timers)
+        self.assertListEqual(
+            [(at, queue) for at, seq, queue, task in timers],
+            [
+                (1482508500, self.bot.fast_queue),
+                (1482508800, self.bot.fast_queue),
+                (1482537601, self.bot.slow_queue),
+            ]
+        )
+
+        checks = [task for at, seq, queue, task in timers[:2]]
+        for task in checks:
+            self.assertIsInstance(task, pony.tasks.CheckReports)
+            self.assertListEqual(task.teams, ['dev_team1'])
+
+        self.assertIsInstance(timers[2][3], pony.tasks.ScheduleDeadlines)
+
+    def test_execute_on_host_west_of_utc(self):
+        # local date is still the previous one at UTC midnight
+        with freezegun.freeze_time('2016-12-24 00:00:01', tz_offset=-8):
+            pony.tasks.ScheduleDeadlines().execute(self.bot, self.slack)
+
+        timers = sorted(self.bot.runtime.timers)
+        self.assertListEqual(
+            [(at, queue) for at, seq, queue, task in timers],
+            [
+                (1482570000, self.bot.fast_queue),
+                (1482594900, self.bot.fast_queue),
+                (1482595200, self.bot.fast_queue),
+                (1482624001, self.bot.slow_queue),
+            ]
+        )
+
+    def test_execute_rolls_latency_over(self):
+        (flexmock(self.bot.latency)
+         .should_receive('rollover')
+         .with_args(date(2016, 12, 24))
+         .once())
+
+        with freezegun.freeze_time('2016-12-24 00:00:01'):
+            pony.tasks.ScheduleDeadlines().execute(self.bot, self.slack)
@@ -4,6 +4,7 @@ import time
 from flexmock import flexmock
 
 import pony.tasks
+from pony.directory import IMDirectory
 from tests.test_base import BaseTest
 
 
@@ -13,12 +14,9 @@ class SendMessageTest(BaseTest):
 
         (flexmock(self.bot.slack_client.server)
          .should_receive('send_to_websocket')
-         .with_args(dict(type='typing', channel='_to')))
-
-        # send typing does imitate human typing by waiting up to 2 seconds
-        (flexmock(time)
-         .should_receive('sleep')
-         .times(2))
+         .with_args(dict(type='typing', channel='_to'))
+         .once()
+         .ordered())
 
         (flexmock(self.slack)
          .should_receive('api_call')
@@ -28,6 +26,29 @@ class SendMessageTest(BaseTest):
             text='_text',
             attachments=[1, 2, 3],
             as_user=True
-        ))
+        )
+         .and_return(dict(ok=True))
+         .once()
+         .ordered())
+
+        # send typing does imitate human typing, but does not wait for it
+        (flexmock(time)
+         .should_receive('sleep')
+         .never())
 
         task.execute(self.bot, self.slack)
+        self.assertEqual(self.bot.dispatcher.pending(), 2)
+
+        self.bot.dispatcher.run_pending()
+        self.assertEqual(self.bot.dispatcher.pending(), 0)
+
+    def test_get_im_channel(self):
+        self.bot.im_directory = IMDirectory([{'id': '_im_id', 'user': '_to'}])
+        task = pony.tasks.SendMessage('_to', '_text')
+        self.assertEqual(task.get_im_channel(self.bot, '_to'), '_im_id')
+
+    def test_get_im_channel_no_im(self):
+        self.bot.im_directory = IMDirectory([])
+        task = pony.tasks.SendMessage('#channel', '_text')
+        self.assertEqual(
+            task.get_im_channel(self.bot, '#channel'), '#channel')
@@ -1,10 +1,13 @@
 from __future__ import absolute_import
 
-from datetime import datetime
+from datetime import datetime, timedelta
 
+import freezegun
 from flexmock import flexmock
 
 import pony.tasks
+from pony.directory import User
+from pony.schedule import TeamSchedule
 from tests.test_base import BaseTest
 
 
@@ -22,62 +25,96 @@ class SendReportSummaryTest(BaseTest):
         (flexmock(self.bot)
          .should_receive('get_user_by_id')
          .with_args('_user_id')
-         .and_return({
-            'id': '_user_id',
-            'color': 'aabbcc',
-            'profile': {
-                'real_name': 'Dummy User'
-            }
-        }))
+         .and_return(User(
+            '_user_id', color='aabbcc', real_name='Dummy User')))
 
         (flexmock(self.bot)
             .should_receive('get_user_by_name')
             .with_args('@user')
-            .and_return({
-            'id': '_user_id',
-            'color': 'aabbcc',
-            'profile': {
-                'real_name': 'Dummy User'
-            }
-        }))
+            .and_return(User(
+            '_user_id', color='aabbcc', real_name='Dummy User')))
 
     def test_get_user_avatar_is_failsafe(self):
         (flexmock(self.slack)
          .should_receive('api_call')
-         .with_args('users.list')
-         .and_return(dict(members=[])))
+         .with_args('users.info', user='_user_id')
+         .and_return(dict(ok=False, error='user_not_found')))
 
         task = pony.tasks.SendReportSummary('_dummy_team')
-        self.assertIsNone(task.get_user_avatar(self.slack, '_user_id'))
+        self.assertIsNone(
+            task.get_user_avatar(self.bot, self.slack, '_user_id'))
 
     def test_get_user_avatar(self):
         (flexmock(self.slack)
          .should_receive('api_call')
-         .with_args('users.list')
+         .with_args('users.info', user='_user_id')
          .and_return({
-            'members': [{
+            'ok': True,
+            'user': {
                 'id': '_user_id',
                 'profile': {
                     'image_192': '_image_192_url',
                 }
-            }]
-        }))
+            }
+        })
+         .once())
 
         task = pony.tasks.SendReportSummary('_dummy_team')
         self.assertEqual(
-            task.get_user_avatar(self.slack, '_user_id'), '_image_192_url')
+            task.get_user_avatar(self.bot, self.slack, '_user_id'),
+            '_image_192_url')
+        self.assertEqual(
+            task.get_user_avatar(self.bot, self.slack, '_user_id'),
+            '_image_192_url')
+
+    def test_get_user_avatar_is_rate_limited(self):
+        (flexmock(self.bot.dispatcher)
+         .should_receive('call')
+         .with_args(self.slack, 'users.info', user='_user_id')
+         .and_return(dict(ok=False, error='user_not_found'))
+         .once())
+
+        task = pony.tasks.SendReportSummary('_dummy_team')
+        self.assertIsNone(
+            task.get_user_avatar(self.bot, self.slack, '_user_id'))
 
-    def test_get_user_avatar_lazy_loads_profiles(self):
+    def test_get_user_avatar_uses_user_list(self):
         (flexmock(self.slack)
          .should_receive('api_call')
-         .with_args('users.list')
-         .and_return(dict(members=[]))
-         .times(1))
+         .never())
+
+        self.bot.profile_cache.update([
+            User('_user_id', image_192='_image_192_url')
+        ])
 
         task = pony.tasks.SendReportSummary('_dummy_team')
-        self.assertIsNone(task.get_user_avatar(self.slack, '_user_id'))
-        self.assertIsNone(task.get_user_avatar(self.slack, '_user_id'))
-        self.assertIsNone(task.get_user_avatar(self.slack, '_user_id'))
+        self.assertEqual(
+            task.get_user_avatar(self.bot, self.slack, '_user_id'),
+            '_image_192_url')
+
+    def test_get_user_avatar_expires(self):
+        self.bot.profile_cache.update([
+            User('_user_id', image_192='_image_192_url')
+        ])
+
+        (flexmock(self.slack)
+         .should_receive('api_call')
+         .with_args('users.info', user='_user_id')
+         .and_return({
+            'ok': True,
+            'user': {
+                'id': '_user_id',
+                'profile': {
+                    'image_192': '_new_image_192_url',
+                }
+            }
+        }))
+
+        task = pony.tasks.SendReportSummary('_dummy_team')
+        with freezegun.freeze_time(datetime.utcnow() + timedelta(hours=2)):
+            self.assertEqual(
+                task.get_user_avatar(self.bot, self.slack, '_user_id'),
+                '_new_image_192_url')
 
     def test_execute_no_reports(self):
         self.bot.storage.set('report', {})
@@ -181,7 +218,7 @@ class SendReportSummaryTest(BaseTest):
 
         (flexmock(task)
          .should_receive('get_user_avatar')
-         .with_args(self.slack, '_user_id')
+         .with_args(self.bot, self.slack, '_user_id')
          .and_return('_dummy_user_avatar_url'))
 
         self.assertIsNone(task.execute(self.bot, self.slack))
@@ -197,6 +234,22 @@ class SendReportSummaryTest(BaseTest):
         self.assertEqual(report_line['thumb_url'], '_dummy_user_avatar_url')
         self.assertIsNotNone(report_line['ts'])
 
+    @freezegun.freeze_time('2016-12-23 16:10')
+    def test_record_latency(self):
+        task = pony.tasks.SendReportSummary('_dummy_team')
+        schedule = TeamSchedule(
+            '_dummy_team', None, None, None, 1482508800)
+        (flexmock(self.bot)
+         .should_receive('get_schedules')
+         .and_return({'_dummy_team': schedule}))
+
+        (flexmock(self.bot.latency)
+         .should_receive('record')
+         .with_args('summary', 600)
+         .once())
+
+        task.record_latency(self.bot)
+
     def test_execute_when_user_has_department_assigned(self):
         self.bot.plugin_config['_dummy_team']['users'] = ['@user']
         self.bot.storage.set('report', {
@@ -221,7 +274,7 @@ class SendReportSummaryTest(BaseTest):
 
         (flexmock(task)
          .should_receive('get_user_avatar')
-         .with_args(self.slack, '_user_id')
+         .with_args(self.bot, self.slack, '_user_id')
          .and_return('_dummy_user_avatar_url'))
 
         self.assertIsNone(task.execute(self.bot, self.slack))
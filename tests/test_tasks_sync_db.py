@@ -10,9 +10,15 @@ class SyncDBTest(BaseTest):
     def test_execute(self):
         task = pony.tasks.SyncDB()
 
+        (flexmock(self.bot.storage)
+         .should_receive('sweep')
+         .once()
+         .ordered())
+
         (flexmock(self.bot.storage)
          .should_receive('save')
-         .once())
+         .once()
+         .ordered())
 
         task.execute(self.bot, self.slack)
         self.assertIsInstance(self.bot.slow_queue.pop(), pony.tasks.SyncDB)
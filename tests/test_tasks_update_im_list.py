@@ -3,17 +3,20 @@ from __future__ import absolute_import
 from flexmock import flexmock
 
 import pony.tasks
+from pony.runtime import TaskQueue
 from tests.test_base import BaseTest
 
 
 class UpdateIMListTest(BaseTest):
     def test_execute(self):
         task = pony.tasks.UpdateIMList()
+        self.bot.slow_queue = TaskQueue()
 
         (flexmock(self.slack)
          .should_receive('api_call')
          .with_args('im.list')
          .and_return(dict(
+            ok=True,
             ims=[
                 {'id': '_id1', 'is_im': True, 'is_user_deleted': False},
                 {'id': '_id2', 'is_im': False, 'is_user_deleted': False},
@@ -26,3 +29,21 @@ class UpdateIMListTest(BaseTest):
             self.bot.storage.get('ims'),
             [{'id': '_id1', 'is_im': True, 'is_user_deleted': False}]
         )
+        self.assertTrue(self.bot.get_im_directory().is_im('_id1'))
+        self.assertFalse(self.bot.get_im_directory().is_im('_id2'))
+        self.assertEqual(len(self.bot.slow_queue), 0)
+
+    def test_execute_failed_is_requeued(self):
+        task = pony.tasks.UpdateIMList()
+        self.bot.slow_queue = TaskQueue()
+
+        (flexmock(self.slack)
+         .should_receive('api_call')
+         .with_args('im.list')
+         .and_return(dict(ok=False, error='account_inactive'))
+         .once())
+
+        task.execute(self.bot, self.slack)
+        self.assertIsNone(self.bot.storage.get('ims'))
+        self.assertIsInstance(
+            self.bot.slow_queue.pop(), pony.tasks.UpdateIMList)
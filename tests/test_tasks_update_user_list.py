@@ -3,25 +3,58 @@ from __future__ import absolute_import
 from flexmock import flexmock
 
 import pony.tasks
+from pony.runtime import TaskQueue
+from pony.directory import User
 from tests.test_base import BaseTest
 
 
 class UpdateUserListTest(BaseTest):
     def test_execute(self):
         task = pony.tasks.UpdateUserList()
+        self.bot.slow_queue = TaskQueue()
 
         (flexmock(self.slack)
          .should_receive('api_call')
          .with_args('users.list', presence=1)
          .and_return(dict(
+            ok=True,
             members=[
-                {'id': '_id1', 'deleted': False},
+                {
+                    'id': '_id1',
+                    'deleted': False,
+                    'profile': {'image_192': '_image_192_url'}
+                },
                 {'id': '_id2', 'deleted': True},
             ]
         )))
+        (flexmock(self.bot.metrics)
+         .should_call('observe')
+         .with_args('pony_slack_api_seconds', float, method='users.list')
+         .once())
 
         task.execute(self.bot, self.slack)
         self.assertEqual(
             self.bot.storage.get('users'),
-            [{'id': '_id1', 'deleted': False}]
+            [User('_id1', image_192='_image_192_url')]
         )
+        self.assertEqual(
+            self.bot.profile_cache.get_avatar(self.slack, '_id1'),
+            '_image_192_url')
+        self.assertIsInstance(
+            self.bot.slow_queue.pop(), pony.tasks.UpdateUserList)
+
+    def test_execute_failed_is_requeued(self):
+        task = pony.tasks.UpdateUserList()
+        self.bot.slow_queue = TaskQueue()
+        self.bot.storage.set('users', [User('_id1')])
+
+        (flexmock(self.slack)
+         .should_receive('api_call')
+         .with_args('users.list', presence=1)
+         .and_return(dict(ok=False, error='account_inactive'))
+         .once())
+
+        task.execute(self.bot, self.slack)
+        self.assertEqual(self.bot.storage.get('users'), [User('_id1')])
+        self.assertIsInstance(
+            self.bot.slow_queue.pop(), pony.tasks.UpdateUserList)
@@ -0,0 +1,20 @@
+from __future__ import absolute_import
+
+from flexmock import flexmock
+
+import pony.tasks
+from tests.test_base import BaseTest
+
+
+class WriteMetricsTest(BaseTest):
+    def test_execute(self):
+        self.bot.plugin_config = {'metrics_file': 'pony.prom'}
+        task = pony.tasks.WriteMetrics()
+
+        (flexmock(self.bot.metrics)
+         .should_receive('write')
+         .with_args('pony.prom')
+         .once())
+
+        task.execute(self.bot, self.slack)
+        self.assertIsInstance(self.bot.slow_queue.pop(), pony.tasks.WriteMetrics)